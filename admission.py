@@ -0,0 +1,98 @@
+"""
+入库请求的准入控制
+同时处理中的写请求数有上限，超过时立即返回 429；数据库忙（写锁等待超时）或正在备份/导出/归档时返回 503，
+都带 Retry-After，设备按提示稍后重试，而不是在写锁后面排队直到自己的HTTP超时
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+def is_busy_error(error):
+    """sqlite3.OperationalError 是否为写锁等待超时"""
+    message = str(error).lower()
+    return 'database is locked' in message or 'database is busy' in message
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=8, retry_after=5, busy_cooldown=5.0):
+        """
+        max_in_flight: 同时处理的入库请求上限
+        retry_after: 过载时建议设备等待的秒数
+        busy_cooldown: 出现一次写锁超时后，在这段时间内直接拒绝新的写请求
+        """
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.busy_cooldown = busy_cooldown
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.busy_until = 0.0
+        self.maintenance_tasks = {}     # 任务名 -> 正在运行的数量
+        self.admitted = 0
+        self.rejected_overload = 0
+        self.rejected_busy = 0
+        self.rejected_maintenance = 0
+        self.busy_timeouts = 0
+
+    def admit(self):
+        """
+        尝试占用一个处理名额，成功返回None（之后必须调用release）
+        被拒绝时返回 (HTTP状态码, Retry-After秒数, 原因)
+        """
+        with self.lock:
+            if self.maintenance_tasks:
+                self.rejected_maintenance += 1
+                return 503, self.retry_after, 'maintenance: ' + ', '.join(sorted(self.maintenance_tasks))
+            remaining = self.busy_until - time.monotonic()
+            if remaining > 0:
+                self.rejected_busy += 1
+                return 503, max(1, math.ceil(remaining)), 'database busy'
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected_overload += 1
+            return 429, self.retry_after, 'too many in-flight requests'
+        with self.lock:
+            self.in_flight += 1
+            self.admitted += 1
+        return None
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def record_busy(self):
+        """记录一次写锁等待超时，进入冷却期，返回建议的 Retry-After"""
+        with self.lock:
+            self.busy_timeouts += 1
+            self.busy_until = time.monotonic() + self.busy_cooldown
+        return max(1, math.ceil(self.busy_cooldown))
+
+    @contextmanager
+    def maintenance(self, name):
+        """备份、导出、归档等长时间占用数据库的操作期间，入库请求直接返回503"""
+        with self.lock:
+            self.maintenance_tasks[name] = self.maintenance_tasks.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.maintenance_tasks[name] -= 1
+                if not self.maintenance_tasks[name]:
+                    del self.maintenance_tasks[name]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_in_flight': self.max_in_flight,
+                'in_flight': self.in_flight,
+                'admitted': self.admitted,
+                'rejected_overload': self.rejected_overload,
+                'rejected_busy': self.rejected_busy,
+                'rejected_maintenance': self.rejected_maintenance,
+                'busy_timeouts': self.busy_timeouts,
+                'busy_cooldown_remaining': round(max(0.0, self.busy_until - time.monotonic()), 2),
+                'maintenance': sorted(self.maintenance_tasks)
+            }
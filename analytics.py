@@ -0,0 +1,163 @@
+"""
+传感器数据向量化分析
+所有计算都基于NumPy数组完成，不做逐行Python循环
+"""
+import itertools
+
+import numpy as np
+
+METRICS = ('humidity', 'temperature', 'light_intensity', 'servo_angle')
+
+
+def load_arrays(rows):
+    """
+    将 get_numeric_series 返回的行一次性转换为NumPy数组
+    返回: (ids, epochs, values)，values形状为 (行数, len(METRICS))
+    """
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty((0, len(METRICS)))
+    width = 2 + len(METRICS)
+    # fromiter 直接从扁平迭代器填充，避免先构造嵌套列表的中间对象
+    table = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.float64,
+                        count=len(rows) * width).reshape(-1, width)
+    return table[:, 0].astype(np.int64), table[:, 1].astype(np.int64), table[:, 2:]
+
+
+def rolling_mean_std(values, window):
+    """
+    基于累加和的滑动平均/标准差，O(n)
+    前 window-1 个点窗口不完整，结果为NaN
+    """
+    n = values.shape[0]
+    mean = np.full(values.shape, np.nan)
+    std = np.full(values.shape, np.nan)
+    if window < 1 or n < window:
+        return mean, std
+
+    # 先减去整体均值再累加，降低大数相减带来的精度损失
+    centered = values - values.mean(axis=0)
+    zeros = np.zeros((1,) + values.shape[1:])
+    csum = np.concatenate([zeros, np.cumsum(centered, axis=0)])
+    csum_sq = np.concatenate([zeros, np.cumsum(centered * centered, axis=0)])
+
+    window_sum = csum[window:] - csum[:-window]
+    window_sum_sq = csum_sq[window:] - csum_sq[:-window]
+    window_mean = window_sum / window
+    variance = np.maximum(window_sum_sq / window - window_mean * window_mean, 0.0)
+
+    mean[window - 1:] = window_mean + values.mean(axis=0)
+    std[window - 1:] = np.sqrt(variance)
+    return mean, std
+
+
+def rate_of_change(values, epochs):
+    """每分钟变化率，第一个点及时间差为0的点为NaN"""
+    rate = np.full(values.shape, np.nan)
+    if values.shape[0] < 2:
+        return rate
+    dt = np.diff(epochs).astype(np.float64)
+    dt[dt <= 0] = np.nan
+    rate[1:] = np.diff(values, axis=0) / (dt[:, None] / 60.0)
+    return rate
+
+
+def correlation_matrix(values):
+    """各指标两两之间的皮尔逊相关系数，常数列对应NaN"""
+    if values.shape[0] < 2:
+        return np.full((values.shape[1], values.shape[1]), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.corrcoef(values, rowvar=False)
+
+
+def zscore_flags(values, threshold):
+    """|z| 超过阈值的点"""
+    mean = values.mean(axis=0)
+    std = values.std(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.abs(values - mean) / std
+    return np.nan_to_num(z, nan=0.0) > threshold
+
+
+def iqr_flags(values, k=1.5):
+    """超出 [Q1 - k*IQR, Q3 + k*IQR] 的点"""
+    q1, q3 = np.percentile(values, [25, 75], axis=0)
+    iqr = q3 - q1
+    return (values < q1 - k * iqr) | (values > q3 + k * iqr)
+
+
+def _to_json_list(array, decimals=4):
+    """NaN/inf 转为 None，其余四舍五入，便于JSON序列化"""
+    rounded = np.round(array, decimals)
+    return np.where(np.isfinite(rounded), rounded, None).tolist()
+
+
+def _epochs_to_text(epochs):
+    """epoch秒转为 'YYYY-MM-DD HH:MM:SS' 字符串列表"""
+    text = np.datetime_as_string(epochs.astype('datetime64[s]'), unit='s')
+    return np.char.replace(text, 'T', ' ').tolist()
+
+
+def analyze(rows, window=10, z_threshold=3.0, iqr_k=1.5, max_points=1000):
+    """
+    对一批行做完整分析
+    window: 滑动窗口点数
+    max_points: 返回的序列最多包含的点数，超过时等间隔抽样（统计计算仍基于全量数据）
+    """
+    ids, epochs, values = load_arrays(rows)
+    n = ids.shape[0]
+
+    result = {
+        'count': int(n),
+        'window': window,
+        'time_range': {
+            'start': _epochs_to_text(epochs[:1])[0] if n else None,
+            'end': _epochs_to_text(epochs[-1:])[0] if n else None
+        },
+        'metrics': {},
+        'correlation': {},
+        'series': None
+    }
+    if n == 0:
+        return result
+
+    mean, std = rolling_mean_std(values, window)
+    rate = rate_of_change(values, epochs)
+    z_flags = zscore_flags(values, z_threshold)
+    q_flags = iqr_flags(values, iqr_k)
+    corr = correlation_matrix(values)
+
+    for i, metric in enumerate(METRICS):
+        column = values[:, i]
+        result['metrics'][metric] = {
+            'mean': _to_json_list(column.mean()),
+            'std': _to_json_list(column.std()),
+            'min': _to_json_list(column.min()),
+            'max': _to_json_list(column.max()),
+            'max_rate_per_minute': _to_json_list(np.nanmax(np.abs(rate[:, i]))) if np.isfinite(rate[:, i]).any() else None,
+            'anomalies': {
+                'zscore_count': int(z_flags[:, i].sum()),
+                'iqr_count': int(q_flags[:, i].sum()),
+                'zscore_ids': ids[z_flags[:, i]].tolist(),
+                'iqr_ids': ids[q_flags[:, i]].tolist()
+            }
+        }
+        result['correlation'][metric] = {
+            other: _to_json_list(corr[i, j]) for j, other in enumerate(METRICS)
+        }
+
+    step = max(1, int(np.ceil(n / max_points))) if max_points else 1
+    sample = slice(None, None, step)
+    series = {
+        'id': ids[sample].tolist(),
+        'time': _epochs_to_text(epochs[sample]),
+        'step': step
+    }
+    for i, metric in enumerate(METRICS):
+        series[metric] = {
+            'rolling_mean': _to_json_list(mean[sample, i]),
+            'rolling_std': _to_json_list(std[sample, i]),
+            'rate_per_minute': _to_json_list(rate[sample, i])
+        }
+    result['series'] = series
+
+    return result
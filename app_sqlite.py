@@ -1,14 +1,95 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, g, send_file
+from collections import namedtuple
 from datetime import datetime
+import functools
+import heapq
+import itertools
 import json
-from database import SensorDatabase
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from database import SensorDatabase, GAP_THRESHOLD_SECONDS, epoch_created_at
+import analytics
+from rules import RuleEngine, COMMAND_PREFIXES
+from admission import AdmissionController, is_busy_error
+from response_cache import ResponseCache, period_closed, BEIJING_TZ
+from snapshots import SnapshotStore
+from jobs import JobManager
+from line_ingest import LineIngestServer
+from hot_store import HotWindowStore, METRICS as WINDOW_METRICS, parse_time, format_time
+from log_pipeline import setup_logging, log_event
+
+try:
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+except ImportError:  # 未安装 flask-sock 时只提供HTTP接口
+    Sock = None
 
 app = Flask(__name__)
 # 允许Flask处理text/plain内容类型
 app.config['JSON_AS_ASCII'] = False
 
-# 初始化数据库
-db = SensorDatabase("sensor_data.db")
+# 设备长连接（WebSocket），每个连接占用一个线程，部署时使用 gthread worker
+sock = Sock(app) if Sock else None
+DEVICE_COMMAND_POLL_INTERVAL = float(os.environ.get('DEVICE_COMMAND_POLL_INTERVAL', 0.5))
+
+# 后台任务的进程池用spawn启动子进程；直接运行 python app_sqlite.py 时，子进程会以 __mp_main__ 重新导入本模块
+# （此时 multiprocessing.parent_process() 尚未设置）。子进程只需要 jobs._run_job，不执行迁移、日志管道、后台线程和端口监听等启动动作
+IS_JOB_WORKER = __name__ == '__mp_main__'
+
+# 初始化日志管道（后台线程写出，热路径不做I/O）
+if not IS_JOB_WORKER:
+    setup_logging()
+
+# 初始化数据库（已结束月份可归档到 ARCHIVE_DIR，查询时自动合并；配置 SHARD_DIR 时数据按月写入分片文件）
+db = SensorDatabase("sensor_data.db", archive_dir=os.environ.get('ARCHIVE_DIR', 'archive'),
+                    write_timeout=float(os.environ.get('INGEST_WRITE_TIMEOUT', 2.0)),
+                    read_only=IS_JOB_WORKER,
+                    shard_dir=os.environ.get('SHARD_DIR') or None,
+                    gap_threshold=int(os.environ.get('GAP_THRESHOLD_SECONDS', GAP_THRESHOLD_SECONDS)))
+
+# 导出、全量统计、长时间范围查询和备份的后台任务，在独立进程中用只读连接执行
+job_manager = JobManager(db.db_path, archive_dir=db.archive.archive_dir if db.archive else None,
+                         result_dir=os.environ.get('JOB_RESULT_DIR', 'job_results'),
+                         max_workers=int(os.environ.get('JOB_WORKERS', 2)),
+                         shard_dir=db.shards.shard_dir if db.shards else None)
+
+# 入库准入控制：限制同时处理的写请求，数据库忙时快速返回429/503并带Retry-After
+admission = AdmissionController(
+    max_in_flight=int(os.environ.get('INGEST_MAX_IN_FLIGHT', 8)),
+    retry_after=int(os.environ.get('INGEST_RETRY_AFTER', 5)),
+    busy_cooldown=float(os.environ.get('INGEST_BUSY_COOLDOWN', 5.0))
+)
+
+def dispatch_rule_command(command, rule_name):
+    """自动化规则触发时通过指令管理器下发指令"""
+    log_event('automation.fired', 'Automation rule fired', rule=rule_name, command=command)
+    command_manager.set_command(command, source=f'rule:{rule_name}')
+
+# 自动化规则引擎：每条读数入库后求值，触发时下发指令
+rule_engine = RuleEngine(os.environ.get('AUTOMATION_RULES', 'automation_rules.json'),
+                         dispatch=dispatch_rule_command)
+
+# 按日期/小时查询的响应缓存，数据变更时由数据库回调失效
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get('RESPONSE_CACHE_ENTRIES', 256)),
+    max_bytes=int(os.environ.get('RESPONSE_CACHE_BYTES', 16 * 1024 * 1024))
+)
+db.add_listener(response_cache.on_data_change)
+
+# 已结束日期的预渲染快照，后台线程定期生成，数据被删除时清理
+# 已结束日期的数据仍可能被保留期清理、清空或归档改变，浏览器缓存较短时间后用ETag重新验证
+SNAPSHOT_MAX_AGE = int(os.environ.get('SNAPSHOT_MAX_AGE', 300))
+snapshot_store = SnapshotStore(os.environ.get('SNAPSHOT_DIR', 'snapshots'),
+                               render=lambda date_key: render_date_snapshot(date_key),
+                               interval=int(os.environ.get('SNAPSHOT_INTERVAL', 300)))
+db.add_listener(snapshot_store.on_data_change)
+
+# 最近N天数据的内存压缩存储，窗口查询时从数据库增量同步
+hot_store = HotWindowStore(window_days=float(os.environ.get('HOT_WINDOW_DAYS', 3)))
 
 def parse_sensor_string(data_string):
     """
@@ -55,39 +136,151 @@ def parse_sensor_string(data_string):
     except Exception as e:
         raise ValueError(f'Failed to parse sensor string: {str(e)}')
 
-@app.route('/sensor-data', methods=['POST'])
-def receive_sensor_data():
+def get_cached_response():
+    """按请求路径查找缓存的响应，未命中返回None；同时记下查询开始时的失效代数和时间"""
+    g.cache_generation = response_cache.generation
+    g.cache_started_at = datetime.now(BEIJING_TZ)
+    body = response_cache.get(request.path)
+    if body is None:
+        return None
+    response = app.response_class(body, mimetype=app.json.mimetype)
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+def cache_response(response, date_key, hour=None):
+    """缓存序列化后的响应；查询开始前就已结束的时段一直保留到被淘汰"""
+    response_cache.put(request.path, response.get_data(), date_key,
+                       period_closed(date_key, hour, g.get('cache_started_at')), g.get('cache_generation'))
+    response.headers['X-Cache'] = 'MISS'
+    return response
+
+def retry_later_response(status, retry_after, reason):
+    """过载/数据库忙时的快速拒绝响应，数据没有入库，设备应在 Retry-After 秒后用同一个幂等键重试"""
+    response = jsonify({
+        'error': 'Server busy, retry later',
+        'reason': reason,
+        'retry_after': retry_after
+    })
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def admission_controlled(view):
+    """入库接口的准入控制装饰器"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        rejection = admission.admit()
+        if rejection is not None:
+            status, retry_after, reason = rejection
+            log_event('sensor.rejected', 'Sensor data rejected by admission control', logging.WARNING,
+                      status=status, reason=reason)
+            return retry_later_response(status, retry_after, reason)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission.release()
+    return wrapper
+
+def idempotency_key_for(data, header_key=None):
+    """幂等键: Idempotency-Key 请求头，或请求体中的 request_id，或 device_id + seq；超长时抛出 ValueError"""
+    idempotency_key = header_key or data.get('request_id')
+    if not idempotency_key and data.get('seq') is not None:
+        idempotency_key = f"{data.get('device_id', '')}:{data['seq']}"
+    if idempotency_key is not None:
+        idempotency_key = str(idempotency_key)
+        if len(idempotency_key) > 128:
+            raise ValueError('Idempotency key too long (max 128 characters)')
+    return idempotency_key
+
+def reading_number(data, field, default=None):
+    """
+    读数字段转换为数值：接受数字和数字字符串（原来由SQLite按列类型转换），整数值的字符串转换为int
+    字段缺失或为null时返回 default（default 为None时视为缺失）；无法转换或不是有限数时抛出 ValueError
+    """
+    value = data.get(field)
+    if value is None:
+        if default is None:
+            raise ValueError(f'Missing required field: {field}')
+        return default
+    if isinstance(value, bool):
+        raise ValueError(f'Invalid value for {field}: {value!r}')
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            raise ValueError(f'Invalid value for {field}: {value!r}')
+        value = int(number) if number.is_integer() else number
+    if not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f'Invalid value for {field}: {value!r}')
+    return value
+
+def ingest_reading(data, idempotency_key=None):
+    """
+    HTTP上传和设备长连接共用的入库流程：校验、写库（按幂等键去重）、记录日志、自动化规则求值
+    返回 (状态码, 响应体)；数据库忙时状态码为503，响应体带 reason 和 retry_after
+    调用方负责准入控制
+    """
     try:
-        # 接收JSON格式数据
-        data = request.get_json()
-        
         if not data:
-            return jsonify({'error': 'No JSON data received'}), 400
+            return 400, {'error': 'No JSON data received'}
 
         # 验证必需字段
         required_fields = ['humidity', 'temperature', 'light_intensity']
         for field in required_fields:
             if field not in data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
-        
-        # 获取servo_angle字段（可选，默认为0）
-        servo_angle = data.get('servo_angle', 0)
+                return 400, {'error': f'Missing required field: {field}'}
+
+        # 在写库之前转换为数值，servo_angle可选（缺失或null时为0）；格式错误的读数不进入写事务
+        try:
+            humidity = reading_number(data, 'humidity')
+            temperature = reading_number(data, 'temperature')
+            light_intensity = reading_number(data, 'light_intensity')
+            servo_angle = reading_number(data, 'servo_angle', default=0)
+        except ValueError as e:
+            return 400, {'error': str(e)}
 
         # 保存数据到SQLite数据库
         sensor_reading = db.add_sensor_data(
-            humidity=data['humidity'],
-            temperature=data['temperature'],
-            light_intensity=data['light_intensity'],
-            servo_angle=servo_angle
+            humidity=humidity,
+            temperature=temperature,
+            light_intensity=light_intensity,
+            servo_angle=servo_angle,
+            idempotency_key=idempotency_key
         )
 
-        print(f"Received and saved sensor data: ID={sensor_reading['id']}, "
-              f"H={sensor_reading['humidity']}%, T={sensor_reading['temperature']}°C, "
-              f"L={sensor_reading['light_intensity']} lux, S={sensor_reading['servo_angle']}°")
+        if sensor_reading.get('duplicate'):
+            log_event('sensor.duplicate', 'Duplicate sensor data ignored',
+                      id=sensor_reading['id'], key=idempotency_key)
+            return 200, {
+                'status': 'success',
+                'message': 'Duplicate submission, returning the original record',
+                'duplicate': True,
+                'data': {
+                    'id': sensor_reading['id'],
+                    'humidity': sensor_reading.get('humidity'),
+                    'temperature': sensor_reading.get('temperature'),
+                    'light_intensity': sensor_reading.get('light_intensity'),
+                    'servo_angle': sensor_reading.get('servo_angle'),
+                    'timestamp': sensor_reading.get('timestamp')
+                }
+            }
+
+        log_event('sensor.received', 'Received and saved sensor data',
+                  id=sensor_reading['id'], humidity=sensor_reading['humidity'],
+                  temperature=sensor_reading['temperature'],
+                  light_intensity=sensor_reading['light_intensity'],
+                  servo_angle=sensor_reading['servo_angle'])
 
-        return jsonify({
+        # 自动化规则求值失败不影响入库结果
+        try:
+            rule_engine.evaluate(sensor_reading)
+        except Exception as e:
+            log_event('automation.error', 'Error evaluating automation rules', logging.ERROR, error=str(e))
+
+        return 200, {
             'status': 'success',
             'message': 'Sensor data received and saved successfully',
+            'duplicate': False,
             'data': {
                 'id': sensor_reading['id'],
                 'humidity': sensor_reading['humidity'],
@@ -96,42 +289,91 @@ def receive_sensor_data():
                 'servo_angle': sensor_reading['servo_angle'],
                 'timestamp': sensor_reading['timestamp']
             }
-        }), 200
+        }
 
     except ValueError as e:
-        print(f"Error parsing sensor data: {str(e)}")
+        log_event('sensor.invalid', 'Error parsing sensor data', logging.WARNING, error=str(e))
+        return 400, {'error': str(e)}
+    except sqlite3.OperationalError as e:
+        if is_busy_error(e):
+            retry_after = admission.record_busy()
+            log_event('sensor.busy', 'Database busy, sensor data rejected', logging.WARNING, error=str(e))
+            return 503, {'error': 'Server busy, retry later', 'reason': 'database busy', 'retry_after': retry_after}
+        log_event('sensor.error', 'Error saving sensor data', logging.ERROR, error=str(e))
+        return 500, {'error': str(e)}
+    except Exception as e:
+        log_event('sensor.error', 'Error saving sensor data', logging.ERROR, error=str(e))
+        return 500, {'error': str(e)}
+
+@app.route('/sensor-data', methods=['POST'])
+@admission_controlled
+def receive_sensor_data():
+    try:
+        # 接收JSON格式数据
+        data = request.get_json()
+        idempotency_key = idempotency_key_for(data or {}, request.headers.get('Idempotency-Key'))
+    except ValueError as e:
         return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print(f"Error saving sensor data: {str(e)}")
+        log_event('sensor.error', 'Error saving sensor data', logging.ERROR, error=str(e))
         return jsonify({'error': str(e)}), 500
 
+    status, body = ingest_reading(data, idempotency_key)
+    if status == 503 and 'retry_after' in body:
+        return retry_later_response(status, body['retry_after'], body['reason'])
+    return jsonify(body), status
+
+# 返回给前端的读数字段
+READING_FIELDS = ('id', 'humidity', 'temperature', 'light_intensity', 'servo_angle', 'timestamp')
+DATED_READING_FIELDS = READING_FIELDS + ('date_key', 'datetime_key')
+
+def stream_all_sensor_data():
+    """
+    不带 limit/since_id 的 GET /sensor-data：按id升序逐页输出JSON，字段与分页响应一致
+    内存占用只与页大小有关，首字节不等待全表查询；count 为本次返回的条数（即开始时的全部数据）
+    """
+    yield '{"status": "success", "since_id": null, "data": ['
+    returned = 0
+    try:
+        for rows in db.iter_all_data():
+            # 行的列顺序即 READING_FIELDS，与分页响应的 to_dicts 同样按字段原值输出（空值为null）
+            page = json.dumps([dict(zip(READING_FIELDS, row)) for row in rows], ensure_ascii=False)
+            yield (',' if returned else '') + page[1:-1]
+            returned += len(rows)
+    except Exception as e:
+        # 响应头已经发出，无法再返回500；截断的JSON会让客户端解析失败
+        print(f"Error streaming sensor data: {str(e)}")
+        raise
+    yield f'], "returned": {returned}, "count": {returned}}}'
+
 @app.route('/sensor-data', methods=['GET'])
 def get_sensor_data():
     try:
         # 获取查询参数
         limit = request.args.get('limit', type=int)
         offset = request.args.get('offset', default=0, type=int)
-
-        # 从数据库获取数据
-        data = db.get_all_data(limit=limit, offset=offset)
-        total_count = db.get_data_count()
-
-        # 转换数据格式以保持与前端的兼容性，并且反转顺序（最新数据在后）
-        formatted_data = []
-        for item in reversed(data):
-            formatted_data.append({
-                'id': item['id'],
-                'humidity': item['humidity'],
-                'temperature': item['temperature'],
-                'light_intensity': item['light_intensity'],
-                'servo_angle': item.get('servo_angle', 0),
-                'timestamp': item['timestamp']
-            })
+        since_id = request.args.get('since_id', type=int)
+
+        # 不分页时流式输出全部数据
+        if not limit and since_id is None:
+            return app.response_class(stream_all_sensor_data(), mimetype='application/json')
+
+        # 从数据库获取数据；给出since_id时只返回更新的数据（增量同步）
+        # 转换数据格式以保持与前端的兼容性，最新数据在后（get_data_since 已是id升序，get_all_data 需要反转）
+        # 增量同步时 count 只统计到最后返回的id为止，与客户端缓存加上本次返回的数据一致，
+        # 不受查询之后新写入的数据影响；不一致只说明服务器数据被删除、清空
+        if since_id is not None:
+            formatted_data = db.get_data_since(since_id, limit=limit).to_dicts(READING_FIELDS)
+            total_count = db.get_data_count(max_id=formatted_data[-1]['id'] if formatted_data else since_id)
+        else:
+            formatted_data = db.get_all_data(limit=limit, offset=offset).to_dicts(READING_FIELDS, reverse=True)
+            total_count = db.get_data_count()
 
         return jsonify({
             'status': 'success',
             'count': total_count,
             'returned': len(formatted_data),
+            'since_id': since_id,
             'data': formatted_data
         }), 200
 
@@ -153,14 +395,7 @@ def get_latest_sensor_data():
 
         return jsonify({
             'status': 'success',
-            'data': {
-                'id': latest_data['id'],
-                'humidity': latest_data['humidity'],
-                'temperature': latest_data['temperature'],
-                'light_intensity': latest_data['light_intensity'],
-                'servo_angle': latest_data.get('servo_angle', 0),
-                'timestamp': latest_data['timestamp']
-            }
+            'data': latest_data.to_dict(READING_FIELDS)
         }), 200
 
     except Exception as e:
@@ -180,10 +415,205 @@ def get_statistics():
         print(f"Error retrieving statistics: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/sensor-data/percentiles', methods=['GET'])
+def get_percentiles():
+    """
+    按天合并分位数草图，返回各指标的 p50/p90/p99
+    参数: date_key (单日) 或 start/end (YYYY-MM-DD，含两端)，q (如 0.5,0.9,0.99)
+    """
+    try:
+        date_key = request.args.get('date_key')
+        start = request.args.get('start', date_key)
+        end = request.args.get('end', date_key)
+        q_param = request.args.get('q')
+        quantiles = tuple(float(q) for q in q_param.split(',')) if q_param else (0.5, 0.9, 0.99)
+        if any(q < 0 or q > 1 for q in quantiles):
+            return jsonify({'error': 'Quantiles must be between 0 and 1'}), 400
+
+        result = db.get_percentiles(start, end, quantiles)
+        return jsonify({
+            'status': 'success',
+            'start': start,
+            'end': end,
+            'days': result['days'],
+            'percentiles': result['metrics']
+        }), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error retrieving percentiles: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/sensor-data/analytics', methods=['GET'])
+def get_analytics():
+    """
+    时间范围内的向量化分析：滑动均值/标准差、变化率、相关系数、异常点
+    参数: start/end (YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS), window, z, max_points
+    """
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        # 只给日期时包含结束当天全天
+        if end and len(end) == 10:
+            end = f"{end} 23:59:59"
+        window = request.args.get('window', default=10, type=int)
+        z_threshold = request.args.get('z', default=3.0, type=float)
+        max_points = request.args.get('max_points', default=1000, type=int)
+
+        rows = db.get_numeric_series(start, end)
+        result = analytics.analyze(rows, window=window, z_threshold=z_threshold, max_points=max_points)
+
+        return jsonify({
+            'status': 'success',
+            'start': start,
+            'end': end,
+            'analytics': result
+        }), 200
+
+    except Exception as e:
+        print(f"Error computing analytics: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/sensor-data/gaps', methods=['GET'])
+def get_gaps():
+    """
+    断线记录和在线率，只读取断线索引，不扫描数据表
+    参数: start/end (YYYY-MM-DD 或 YYYY-MM-DD HH:MM:SS，默认最近 days 天), days (默认7),
+          min_seconds (只返回不短于该秒数的断线), limit (默认100)
+    """
+    try:
+        now = time.time()
+        days = request.args.get('days', default=7, type=float)
+        start = request.args.get('start') or epoch_created_at(int(now - days * 86400))
+        end = request.args.get('end') or epoch_created_at(int(now))
+        # 只给日期时从开始当天0点到结束当天结束
+        if len(start) == 10:
+            start = f"{start} 00:00:00"
+        if len(end) == 10:
+            end = f"{end} 23:59:59"
+        min_seconds = request.args.get('min_seconds', type=int)
+        limit = request.args.get('limit', default=100, type=int)
+
+        return jsonify({
+            'status': 'success',
+            'gaps': db.get_gaps(start, end, min_seconds=min_seconds, limit=limit),
+            'uptime': db.get_uptime(start, end, now=now),
+            'liveness': db.get_liveness(now)
+        }), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error getting gaps: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/sensor-data/liveness', methods=['GET'])
+def get_liveness():
+    """设备在线状态：最后一条读数时间、距今秒数，超过断线阈值为离线"""
+    try:
+        return jsonify({'status': 'success', 'liveness': db.get_liveness()}), 200
+    except Exception as e:
+        print(f"Error getting liveness: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/sensor-data/window/stats', methods=['GET'])
+def get_window_stats():
+    """内存窗口的块数、压缩后字节数和解码缓存命中情况"""
+    try:
+        hot_store.sync(db)
+        return jsonify({'status': 'success', 'window': hot_store.stats()}), 200
+
+    except Exception as e:
+        print(f"Error getting window stats: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/sensor-data/window/<metric>', methods=['GET'])
+def get_window_series(metric):
+    """
+    从内存窗口读取单个指标
+    参数: start/end (YYYY-MM-DD HH:MM:SS)，bucket (秒，给出时降采样)，agg (mean/min/max/sum/count/last)
+    """
+    try:
+        if metric not in WINDOW_METRICS:
+            return jsonify({'error': f'Unknown metric: {metric}'}), 400
+        start = parse_time(request.args.get('start'))
+        end = request.args.get('end')
+        if end and len(end) == 10:
+            end = f"{end} 23:59:59"
+        end = parse_time(end)
+        bucket = request.args.get('bucket', type=int)
+        agg = request.args.get('agg', default='mean')
+
+        hot_store.sync(db)
+        if bucket:
+            points = hot_store.downsample(metric, start, end, bucket=bucket, agg=agg)
+        else:
+            timestamps, values = hot_store.range(metric, start, end)
+            points = list(zip(timestamps, values))
+
+        return jsonify({
+            'status': 'success',
+            'metric': metric,
+            'bucket': bucket,
+            'agg': agg if bucket else None,
+            'count': len(points),
+            'data': [{'time': format_time(ts), 'value': value} for ts, value in points]
+        }), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error reading window series: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/sensor-data/window/<metric>/aggregate', methods=['GET'])
+def get_window_aggregate(metric):
+    """内存窗口内单个指标的 count/sum/mean/min/max，参数: start/end"""
+    try:
+        if metric not in WINDOW_METRICS:
+            return jsonify({'error': f'Unknown metric: {metric}'}), 400
+        start = parse_time(request.args.get('start'))
+        end = request.args.get('end')
+        if end and len(end) == 10:
+            end = f"{end} 23:59:59"
+        end = parse_time(end)
+
+        hot_store.sync(db)
+        return jsonify({
+            'status': 'success',
+            'metric': metric,
+            'aggregate': hot_store.aggregate(metric, start, end)
+        }), 200
+
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error aggregating window: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/sensor-data/admission', methods=['GET'])
+def get_admission_stats():
+    """入库准入控制的计数：放行、各类拒绝、写锁超时次数"""
+    return jsonify({'status': 'success', 'admission': admission.stats()}), 200
+
+@app.route('/sensor-data/line-ingest', methods=['GET'])
+def get_line_ingest_stats():
+    """TCP/UDP行协议入库的监听端口和各连接计数"""
+    if line_ingest is None:
+        return jsonify({'status': 'success', 'enabled': False}), 200
+    return jsonify({'status': 'success', 'enabled': True, 'line_ingest': line_ingest.stats()}), 200
+
+@app.route('/sensor-data/cache', methods=['GET'])
+def get_cache_stats():
+    """按日期/小时查询的响应缓存命中情况"""
+    return jsonify({'status': 'success', 'cache': response_cache.stats()}), 200
+
 @app.route('/sensor-data/export', methods=['GET'])
 def export_data():
     try:
-        file_path, count = db.export_to_json()
+        with admission.maintenance('export'):
+            file_path, count = db.export_to_json()
         return jsonify({
             'status': 'success',
             'message': f'Data exported successfully',
@@ -195,10 +625,29 @@ def export_data():
         print(f"Error exporting data: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/sensor-data/export/npz', methods=['GET'])
+def export_data_npz():
+    """
+    列式二进制导出：id/epoch(int64)、humidity/temperature(float32)、light_intensity/servo_angle(int32)
+    不压缩的 .npz，可用 columnar.load_npz 内存映射读取，或直接 numpy.load
+    """
+    try:
+        with admission.maintenance('export'):
+            file_path, count = db.export_to_npz()
+        response = send_file(os.path.abspath(file_path), mimetype='application/octet-stream',
+                             as_attachment=True, download_name=os.path.basename(file_path))
+        response.headers['X-Exported-Count'] = str(count)
+        return response
+
+    except Exception as e:
+        print(f"Error exporting npz data: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/sensor-data/backup', methods=['POST'])
 def backup_database():
     try:
-        backup_path = db.backup_database()
+        with admission.maintenance('backup'):
+            backup_path = db.backup_database()
         return jsonify({
             'status': 'success',
             'message': 'Database backup created successfully',
@@ -209,10 +658,93 @@ def backup_database():
         print(f"Error creating backup: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/sensor-data/archive', methods=['POST'])
+def archive_data():
+    """将已结束月份的数据移入压缩归档"""
+    try:
+        with admission.maintenance('archive'):
+            result = db.archive_closed_months()
+        return jsonify({
+            'status': 'success',
+            'message': 'Closed months archived successfully',
+            'archived_days': result['archived_days'],
+            'archived_rows': result['archived_rows']
+        }), 200
+
+    except Exception as e:
+        print(f"Error archiving data: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    提交后台任务，立即返回任务id，用 /jobs/<id> 查询状态、/jobs/<id>/result 获取结果
+    请求体: {"kind": "export|statistics|year|month|date_range|analytics|backup", "params": {...}}
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        job = job_manager.submit(data.get('kind'), data.get('params'))
+        return jsonify({
+            'status': 'accepted',
+            'job': job,
+            'status_url': f"/jobs/{job['id']}",
+            'result_url': f"/jobs/{job['id']}/result"
+        }), 202
+
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error submitting job: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'status': 'success', 'jobs': job_manager.list_jobs()}), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'status': 'success', 'job': job}), 200
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """任务完成后以文件流返回结果JSON；未完成返回202，失败返回500"""
+    job = job_manager.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] == 'failed':
+        return jsonify({'error': job['error'], 'job': job}), 500
+    result_path = job_manager.result_path(job_id)
+    if result_path is None:
+        return jsonify({'status': job['status'], 'job': job}), 202
+    return send_file(result_path, mimetype='application/json', conditional=True)
+
+@app.route('/sensor-data/archive', methods=['GET'])
+def get_archive_info():
+    """归档概况: 天数、记录数、时间范围"""
+    try:
+        summary = db.archive.summary() if db.archive else None
+        return jsonify({
+            'status': 'success',
+            'archive': {
+                'days': summary['days'],
+                'count': summary['count'],
+                'first_record': summary['first_record'],
+                'last_record': summary['last_record']
+            } if summary else None
+        }), 200
+
+    except Exception as e:
+        print(f"Error retrieving archive info: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/sensor-data/clear', methods=['DELETE'])
 def clear_all_data():
     try:
         deleted_count = db.clear_all_data()
+        hot_store.sync(db)
         return jsonify({
             'status': 'success',
             'message': f'All data cleared successfully',
@@ -241,19 +773,8 @@ def get_data_by_year(year):
     try:
         data = db.get_data_by_year(year)
 
-        # 转换数据格式以保持与前端的兼容性
-        formatted_data = []
-        for item in reversed(data):
-            formatted_data.append({
-                'id': item['id'],
-                'humidity': item['humidity'],
-                'temperature': item['temperature'],
-                'light_intensity': item['light_intensity'],
-                'servo_angle': item.get('servo_angle', 0),
-                'timestamp': item['timestamp'],
-                'date_key': item['date_key'],
-                'datetime_key': item.get('datetime_key', '')
-            })
+        # 转换数据格式以保持与前端的兼容性，反转顺序（最新数据在后）
+        formatted_data = data.to_dicts(DATED_READING_FIELDS, reverse=True)
 
         return jsonify({
             'status': 'success',
@@ -271,19 +792,8 @@ def get_data_by_month(year, month):
     try:
         data = db.get_data_by_month(year, month)
 
-        # 转换数据格式以保持与前端的兼容性
-        formatted_data = []
-        for item in reversed(data):
-            formatted_data.append({
-                'id': item['id'],
-                'humidity': item['humidity'],
-                'temperature': item['temperature'],
-                'light_intensity': item['light_intensity'],
-                'servo_angle': item.get('servo_angle', 0),
-                'timestamp': item['timestamp'],
-                'date_key': item['date_key'],
-                'datetime_key': item.get('datetime_key', '')
-            })
+        # 转换数据格式以保持与前端的兼容性，反转顺序（最新数据在后）
+        formatted_data = data.to_dicts(DATED_READING_FIELDS, reverse=True)
 
         return jsonify({
             'status': 'success',
@@ -300,60 +810,74 @@ def get_data_by_month(year, month):
 @app.route('/sensor-data/day/<int:year>/<int:month>/<int:day>', methods=['GET'])
 def get_data_by_day(year, month, day):
     try:
+        cached = get_cached_response()
+        if cached is not None:
+            return cached, 200
+
         data = db.get_data_by_day(year, month, day)
 
-        # 转换数据格式以保持与前端的兼容性
-        formatted_data = []
-        for item in reversed(data):
-            formatted_data.append({
-                'id': item['id'],
-                'humidity': item['humidity'],
-                'temperature': item['temperature'],
-                'light_intensity': item['light_intensity'],
-                'servo_angle': item.get('servo_angle', 0),
-                'timestamp': item['timestamp'],
-                'date_key': item['date_key'],
-                'datetime_key': item.get('datetime_key', '')
-            })
+        # 转换数据格式以保持与前端的兼容性，反转顺序（最新数据在后）
+        formatted_data = data.to_dicts(DATED_READING_FIELDS, reverse=True)
 
-        return jsonify({
+        return cache_response(jsonify({
             'status': 'success',
             'year': year,
             'month': month,
             'day': day,
             'count': len(formatted_data),
             'data': formatted_data
-        }), 200
+        }), f"{year:04d}-{month:02d}-{day:02d}"), 200
 
     except Exception as e:
         print(f"Error retrieving data by day: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def build_date_key_payload(date_key):
+    """/sensor-data/date/<date_key> 的响应内容，接口和快照共用"""
+    data = db.get_data_by_date_key(date_key)
+
+    # 转换数据格式以保持与前端的兼容性，反转顺序（最新数据在后）
+    formatted_data = data.to_dicts(DATED_READING_FIELDS, reverse=True)
+
+    return {
+        'status': 'success',
+        'date_key': date_key,
+        'count': len(formatted_data),
+        'data': formatted_data
+    }
+
+def render_date_snapshot(date_key):
+    with app.app_context():
+        return jsonify(build_date_key_payload(date_key)).get_data()
+
+def send_snapshot(date_key):
+    """已结束日期的快照文件存在时直接发送（支持gzip、ETag和短期缓存），否则返回None"""
+    # 按q值判断，"gzip;q=0" 表示不接受
+    gzip_ok = request.accept_encodings['gzip'] > 0
+    path = snapshot_store.path_for(date_key, compressed=gzip_ok)
+    if path is None:
+        return None
+    response = send_file(path, mimetype='application/json', conditional=True, etag=True,
+                         max_age=SNAPSHOT_MAX_AGE)
+    if gzip_ok:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.headers['X-Cache'] = 'SNAPSHOT'
+    return response
+
 @app.route('/sensor-data/date/<date_key>', methods=['GET'])
 def get_data_by_date_key(date_key):
     try:
-        data = db.get_data_by_date_key(date_key)
-
-        # 转换数据格式以保持与前端的兼容性
-        formatted_data = []
-        for item in reversed(data):
-            formatted_data.append({
-                'id': item['id'],
-                'humidity': item['humidity'],
-                'temperature': item['temperature'],
-                'light_intensity': item['light_intensity'],
-                'servo_angle': item.get('servo_angle', 0),
-                'timestamp': item['timestamp'],
-                'date_key': item['date_key'],
-                'datetime_key': item.get('datetime_key', '')
-            })
+        snapshot = send_snapshot(date_key)
+        if snapshot is not None:
+            return snapshot
 
-        return jsonify({
-            'status': 'success',
-            'date_key': date_key,
-            'count': len(formatted_data),
-            'data': formatted_data
-        }), 200
+        cached = get_cached_response()
+        if cached is not None:
+            return cached, 200
+
+        return cache_response(jsonify(build_date_key_payload(date_key)), date_key), 200
 
     except Exception as e:
         print(f"Error retrieving data by date key: {str(e)}")
@@ -362,23 +886,16 @@ def get_data_by_date_key(date_key):
 @app.route('/sensor-data/hour/<int:year>/<int:month>/<int:day>/<int:hour>', methods=['GET'])
 def get_data_by_hour(year, month, day, hour):
     try:
+        cached = get_cached_response()
+        if cached is not None:
+            return cached, 200
+
         data = db.get_data_by_hour(year, month, day, hour)
 
-        # 转换数据格式以保持与前端的兼容性
-        formatted_data = []
-        for item in reversed(data):
-            formatted_data.append({
-                'id': item['id'],
-                'humidity': item['humidity'],
-                'temperature': item['temperature'],
-                'light_intensity': item['light_intensity'],
-                'servo_angle': item.get('servo_angle', 0),
-                'timestamp': item['timestamp'],
-                'date_key': item['date_key'],
-                'datetime_key': item['datetime_key']
-            })
+        # 转换数据格式以保持与前端的兼容性，反转顺序（最新数据在后）
+        formatted_data = data.to_dicts(DATED_READING_FIELDS, reverse=True)
 
-        return jsonify({
+        return cache_response(jsonify({
             'status': 'success',
             'year': year,
             'month': month,
@@ -386,7 +903,7 @@ def get_data_by_hour(year, month, day, hour):
             'hour': hour,
             'count': len(formatted_data),
             'data': formatted_data
-        }), 200
+        }), f"{year:04d}-{month:02d}-{day:02d}", hour), 200
 
     except Exception as e:
         print(f"Error retrieving data by hour: {str(e)}")
@@ -395,28 +912,22 @@ def get_data_by_hour(year, month, day, hour):
 @app.route('/sensor-data/datetime/<datetime_key>', methods=['GET'])
 def get_data_by_datetime_key(datetime_key):
     try:
+        cached = get_cached_response()
+        if cached is not None:
+            return cached, 200
+
         data = db.get_data_by_datetime_key(datetime_key)
 
-        # 转换数据格式以保持与前端的兼容性
-        formatted_data = []
-        for item in reversed(data):
-            formatted_data.append({
-                'id': item['id'],
-                'humidity': item['humidity'],
-                'temperature': item['temperature'],
-                'light_intensity': item['light_intensity'],
-                'servo_angle': item.get('servo_angle', 0),
-                'timestamp': item['timestamp'],
-                'date_key': item['date_key'],
-                'datetime_key': item['datetime_key']
-            })
+        # 转换数据格式以保持与前端的兼容性，反转顺序（最新数据在后）
+        formatted_data = data.to_dicts(DATED_READING_FIELDS, reverse=True)
 
-        return jsonify({
+        hour = int(datetime_key[11:13]) if datetime_key[11:13].isdigit() else None
+        return cache_response(jsonify({
             'status': 'success',
             'datetime_key': datetime_key,
             'count': len(formatted_data),
             'data': formatted_data
-        }), 200
+        }), datetime_key[:10], hour), 200
 
     except Exception as e:
         print(f"Error retrieving data by datetime key: {str(e)}")
@@ -450,26 +961,50 @@ def api_info():
         'database': {
             'type': 'SQLite',
             'total_records': total_records,
-            'last_update': latest['timestamp'] if latest else None
+            'last_update': latest.timestamp if latest else None,
+            'shards': db.shards.months() if db.shards else None
         },
         'endpoints': {
-            'POST /sensor-data': 'Receive sensor data',
-            'GET /sensor-data': 'Get all sensor data (supports limit and offset)',
+            'POST /sensor-data': 'Receive sensor data (optional idempotency: Idempotency-Key header, request_id, or device_id + seq; retries return the original record with duplicate=true). Under overload returns 429, while the database is busy or under backup/export/archive returns 503; both carry Retry-After (seconds) and the reading was NOT stored',
+            'GET /sensor-data/admission': 'Ingest admission control counters (in-flight, rejections, busy timeouts)',
+            'GET /sensor-data/line-ingest': 'TCP/UDP line-protocol listener ports and per-connection counters',
+            'GET /sensor-data': 'Get all sensor data (supports limit and offset; ?since_id= returns only newer rows, oldest first, with the total count for cache validation)',
             'GET /sensor-data/latest': 'Get latest sensor data',
             'GET /sensor-data/statistics': 'Get data statistics',
+            'GET /sensor-data/percentiles': 'Get p50/p90/p99 per metric (optional: ?date_key= or ?start=&end=, ?q=0.5,0.9,0.99)',
+            'GET /sensor-data/analytics': 'Rolling stats, rate of change, correlation and anomalies (optional: ?start=&end=&window=&z=&max_points=)',
+            'GET /sensor-data/gaps': 'Ingest gaps longer than the threshold, uptime ratio and liveness (optional: ?start=&end=&days=&min_seconds=&limit=)',
+            'GET /sensor-data/liveness': 'Device liveness: last reading time, seconds since, online/offline',
+            'GET /sensor-data/window/<metric>': 'Recent-window series from memory (optional: ?start=&end=&bucket=<seconds>&agg=mean|min|max|sum|count|last)',
+            'GET /sensor-data/window/<metric>/aggregate': 'Recent-window count/sum/mean/min/max from memory (optional: ?start=&end=)',
+            'GET /sensor-data/window/stats': 'In-memory window footprint and cache statistics',
+            'GET /sensor-data/cache': 'Response cache hit/miss statistics for day/date/hour/datetime queries',
             'GET /sensor-data/dates': 'Get available dates with data count',
             'GET /sensor-data/year/<year>': 'Get data by year',
             'GET /sensor-data/month/<year>/<month>': 'Get data by month',
             'GET /sensor-data/day/<year>/<month>/<day>': 'Get data by specific day',
-            'GET /sensor-data/date/<date_key>': 'Get data by date key (YYYY-MM-DD)',
+            'GET /sensor-data/date/<date_key>': 'Get data by date key (YYYY-MM-DD); closed days are served from pre-rendered snapshots with long-lived cache headers',
             'GET /sensor-data/hour/<year>/<month>/<day>/<hour>': 'Get data by specific hour',
             'GET /sensor-data/datetime/<datetime_key>': 'Get data by datetime key (YYYY-MM-DD-HH)',
             'GET /sensor-data/hours': 'Get available hours with data count (optional: ?date_key=YYYY-MM-DD)',
             'GET /sensor-data/export': 'Export data to JSON',
+            'GET /sensor-data/export/npz': 'Download a columnar .npz export (id/epoch int64, humidity/temperature float32, light_intensity/servo_angle int32; memory-mappable)',
             'POST /sensor-data/backup': 'Create database backup',
+            'POST /sensor-data/archive': 'Move closed months into compressed per-day archive segments',
+            'GET /sensor-data/archive': 'Get archive summary',
             'DELETE /sensor-data/clear': 'Clear all data',
+            'POST /jobs': 'Run export/statistics/year/month/date_range/analytics/backup in a background process on a read-only connection ({"kind": ..., "params": {...}}), returns 202 with the job id',
+            'GET /jobs': 'List background jobs',
+            'GET /jobs/<id>': 'Get background job status (queued/running/done/failed)',
+            'GET /jobs/<id>/result': 'Stream the result JSON of a finished job (202 while still running)',
             'POST /sensor-command': 'Process sensor commands from frontend',
-            'GET /get-pending-command': 'ESP8266 get pending commands'
+            'GET /get-pending-command': 'ESP8266 get pending commands in execution order (?max= up to 10 per fetch, default 1; returns commands list plus command/command_id of the first, and remaining). Repeated ServoTurnTo_/Dataup_ commands not yet fetched are coalesced to the latest; Watering_ commands are never dropped',
+            'POST /command-ack': 'ESP8266 acknowledges an executed command ({"command_id": id, "result": "Watering_done"})',
+            'GET /device-ws': 'WebSocket device channel: upload readings and receive/ack commands on one connection' + ('' if sock else ' (unavailable: flask-sock not installed)'),
+            'GET /command-history': 'Recent commands with lifecycle status (queued/fetched/acked/superseded)',
+            'GET /command-history/latency': 'Command delivery/execution latency percentiles',
+            'GET /automation/rules': 'Get automation rules and their state',
+            'POST /automation/rules': 'Replace automation rules (threshold/hysteresis/duration rules that queue commands on ingest)'
         }
     })
 
@@ -480,25 +1015,21 @@ def sensor_command():
     接收前端指令并转发给ESP8266
     """
     try:
-        print("=" * 50)
-        print("[REQUEST] 收到前端命令请求")
-
         data = request.get_json()
-        print(f"[DATA] 请求数据: {data}")
+        log_event('command.request', '收到前端命令请求', logging.DEBUG, data=data)
 
         if not data or 'command' not in data:
-            print("[ERROR] 错误: 缺少command参数")
+            log_event('command.invalid', '缺少command参数', logging.WARNING)
             return jsonify({
                 'status': 'error',
                 'message': 'Missing command parameter'
             }), 400
 
         command = data['command']
-        print(f"[COMMAND] 提取命令: {command}")
 
         # 验证指令格式
-        if not command.startswith(('Dataup_', 'Watering_', 'ServoTurnTo_')):
-            print(f"[ERROR] 错误: 无效的命令格式 - {command}")
+        if not command.startswith(COMMAND_PREFIXES):
+            log_event('command.invalid', '无效的命令格式', logging.WARNING, command=command)
             return jsonify({
                 'status': 'error',
                 'message': 'Invalid command format'
@@ -509,84 +1040,343 @@ def sensor_command():
         # ESP8266可以在下一次发送数据时检查是否有新指令
 
         # 使用指令管理器存储指令
-        command_manager.set_command(command)
-
-        print(f"[SUCCESS] 指令已存储到CommandManager: {command}")
-        print("等待ESP8266获取并转发指令到Arduino Nano...")
-        print("=" * 50)
+        command_id = command_manager.set_command(command)
 
         return jsonify({
             'status': 'success',
             'message': 'Command sent to ESP8266',
-            'command': command
+            'command': command,
+            'command_id': command_id
         }), 200
 
     except Exception as e:
-        print(f"[ERROR] 处理传感器指令时出错: {str(e)}")
-        print("=" * 50)
+        log_event('command.error', '处理传感器指令时出错', logging.ERROR, error=str(e))
         return jsonify({
             'status': 'error',
             'message': f'Failed to process command: {str(e)}'
         }), 500
 
+# 指令前缀 -> (优先级, 是否合并)，优先级数值小的先下发
+# 浇水不是幂等的，每条都要执行且保持先后顺序；舵机角度和数据更新只有最新一条有意义，未取走的旧指令被新指令取代
+# 数据更新排在动作之后，上传的数据能反映动作后的状态
+COMMAND_POLICIES = {
+    'Watering_': (0, False),
+    'ServoTurnTo_': (1, True),
+    'Dataup_': (2, True)
+}
+# 一次轮询最多返回的指令数
+MAX_COMMANDS_PER_FETCH = 10
+# 长连接上已推送、尚未确认的指令上限（与固件的指令队列长度一致），以及未确认指令占用名额的最长秒数
+DEVICE_COMMAND_WINDOW = 4
+DEVICE_COMMAND_ACK_TIMEOUT = 60
+
+# 队列中的一条指令；按 (优先级, 序号) 排序，同优先级先进先出
+PendingCommand = namedtuple('PendingCommand', 'priority sequence command command_id kind queued_at')
+
+def command_kind(command):
+    """指令所属的前缀"""
+    for prefix in COMMAND_POLICIES:
+        if command.startswith(prefix):
+            return prefix
+    return None
+
 # 使用类来管理指令状态，避免全局变量问题
 class CommandManager:
-    def __init__(self):
-        self.pending_command = None
-        self.command_timestamp = None
-
-    def set_command(self, command):
-        """设置待处理指令"""
-        self.pending_command = command
-        self.command_timestamp = datetime.now().isoformat()
-        print(f"[SEND] CommandManager: 指令已设置 -> {command} (时间: {self.command_timestamp})")
-
-    def get_command(self):
-        """获取并清除待处理指令"""
-        command = self.pending_command
-        if command:
-            print(f"[RECEIVE] CommandManager: 指令已被取出 -> {command}")
-            self.pending_command = None
-            self.command_timestamp = None
-        else:
-            print("[EMPTY] CommandManager: 无待处理指令")
-        return command
+    def __init__(self, db):
+        self.db = db
+        self.queue = []             # PendingCommand 的最小堆
+        self.latest = {}            # 可合并的前缀 -> 队列中该前缀最新的指令
+        self.superseded_ids = set() # 已被取代、仍留在堆中的指令id（取出时跳过）
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    def set_command(self, command, source='manual'):
+        """
+        加入待处理指令，返回指令id
+        可合并的指令（舵机角度、数据更新）取代同前缀中尚未被取走的旧指令，旧指令记为 superseded
+        """
+        command_id = self.db.record_command_queued(command, source)
+        kind = command_kind(command)
+        priority, coalesce = COMMAND_POLICIES.get(kind, (len(COMMAND_POLICIES), False))
+        pending = PendingCommand(priority, next(self.sequence), command, command_id, kind,
+                                 datetime.now().isoformat())
+        with self.lock:
+            superseded = self.latest.get(kind) if coalesce else None
+            if superseded is not None:
+                self.superseded_ids.add(superseded.command_id)
+            if coalesce:
+                self.latest[kind] = pending
+            heapq.heappush(self.queue, pending)
+            queued = len(self.queue) - len(self.superseded_ids)
+        if superseded is not None:
+            self.db.mark_command_superseded(superseded.command_id)
+            log_event('command.superseded', 'CommandManager: 未送达的指令被覆盖',
+                      command_id=superseded.command_id, replaced_by=command_id)
+        log_event('command.queued', 'CommandManager: 指令已加入队列，等待ESP8266获取',
+                  command=command, command_id=command_id, source=source, queued_at=pending.queued_at,
+                  queued=queued)
+        return command_id
+
+    def get_commands(self, limit=1):
+        """按优先级取出最多 limit 条待处理指令（PendingCommand 列表），取出的指令记为 fetched"""
+        taken = []
+        with self.lock:
+            while self.queue and len(taken) < limit:
+                pending = heapq.heappop(self.queue)
+                if pending.command_id in self.superseded_ids:
+                    self.superseded_ids.discard(pending.command_id)
+                    continue
+                if self.latest.get(pending.kind) is pending:
+                    del self.latest[pending.kind]
+                taken.append(pending)
+        for pending in taken:
+            self.db.mark_command_fetched(pending.command_id)
+        return taken
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.queue) - len(self.superseded_ids)
+
+    def requeue(self, commands):
+        """
+        取走的指令没能送达设备时放回队列，保持原来的顺序
+        可合并的指令期间已有同前缀的新指令时以新指令为准（记为 superseded），返回放回的条数
+        """
+        requeued = 0
+        superseded = []
+        with self.lock:
+            for pending in commands:
+                if COMMAND_POLICIES.get(pending.kind, (None, False))[1]:
+                    if pending.kind in self.latest:
+                        superseded.append((pending, self.latest[pending.kind].command_id))
+                        continue
+                    self.latest[pending.kind] = pending
+                heapq.heappush(self.queue, pending)
+                requeued += 1
+        for pending, replaced_by in superseded:
+            self.db.mark_command_superseded(pending.command_id)
+            log_event('command.superseded', 'CommandManager: 未送达的指令被覆盖',
+                      command_id=pending.command_id, replaced_by=replaced_by)
+        return requeued
 
 # 创建全局指令管理器实例
-command_manager = CommandManager()
+command_manager = CommandManager(db)
+
+@app.route('/automation/rules', methods=['GET'])
+def get_automation_rules():
+    """当前的自动化规则及其运行状态"""
+    return jsonify({'status': 'success', 'rules': rule_engine.status()}), 200
+
+@app.route('/automation/rules', methods=['POST'])
+def set_automation_rules():
+    """替换全部自动化规则，请求体为规则数组或 {"rules": [...]}"""
+    try:
+        data = request.get_json()
+        specs = data.get('rules') if isinstance(data, dict) else data
+        rule_engine.set_rules(specs)
+        return jsonify({'status': 'success', 'rules': rule_engine.status()}), 200
+
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        print(f"Error saving automation rules: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
 @app.route('/get-pending-command', methods=['GET'])
 def get_pending_command():
     """
     ESP8266获取待处理指令的接口
     ESP8266定期调用此接口检查是否有新指令
+    参数: max（一次最多取走的指令数，默认1，兼容只处理 command 字段的旧固件）
+    commands 按执行顺序排列，command/command_id 为其中第一条；remaining 为仍在排队的指令数
     """
     try:
-        print("[CHECK] ESP8266正在检查待处理指令...")
-        command = command_manager.get_command()
-
-        if command:
-            print(f"[FOUND] 向ESP8266返回指令: {command}")
+        limit = min(max(request.args.get('max', default=1, type=int), 1), MAX_COMMANDS_PER_FETCH)
+        commands = command_manager.get_commands(limit)
+        remaining = command_manager.pending_count()
+
+        if commands:
+            for pending in commands:
+                log_event('command.delivered', '向ESP8266返回指令', command=pending.command,
+                          command_id=pending.command_id)
             return jsonify({
                 'status': 'success',
                 'has_command': True,
-                'command': command
+                'command': commands[0].command,
+                'command_id': commands[0].command_id,
+                'commands': [{'command': pending.command, 'command_id': pending.command_id}
+                             for pending in commands],
+                'remaining': remaining
             }), 200
         else:
-            print("[EMPTY] 无待处理指令返回给ESP8266")
+            log_event('command.poll', '无待处理指令返回给ESP8266', logging.DEBUG)
             return jsonify({
                 'status': 'success',
                 'has_command': False,
-                'command': None
+                'command': None,
+                'command_id': None,
+                'commands': [],
+                'remaining': remaining
             }), 200
 
     except Exception as e:
-        print(f"[ERROR] 获取待处理指令时出错: {str(e)}")
+        log_event('command.error', '获取待处理指令时出错', logging.ERROR, error=str(e))
         return jsonify({
             'status': 'error',
             'message': f'Failed to get pending command: {str(e)}'
         }), 500
 
+@app.route('/command-ack', methods=['POST'])
+def command_ack():
+    """
+    ESP8266在Nano执行完指令（收到 X_done）后确认
+    请求体: {"command_id": 12, "result": "Watering_done"}
+    """
+    try:
+        data = request.get_json()
+        if not data or 'command_id' not in data:
+            return jsonify({'status': 'error', 'message': 'Missing command_id parameter'}), 400
+
+        record = db.mark_command_acked(int(data['command_id']), data.get('result'))
+        if record is None:
+            return jsonify({'status': 'error', 'message': 'Unknown command_id'}), 404
+
+        log_event('command.acked', 'ESP8266确认指令已执行', command_id=record['id'],
+                  status=record['status'], result=record['result'], total_seconds=record['total_seconds'])
+        return jsonify({'status': 'success', 'command': record}), 200
+
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Invalid command_id'}), 400
+    except Exception as e:
+        log_event('command.error', '处理指令确认时出错', logging.ERROR, error=str(e))
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def handle_device_message(message, device_id=''):
+    """
+    处理设备长连接上收到的一条消息，返回要回复的消息
+    读数: {"type": "reading", "request_id": "...", "humidity": 65.2, "temperature": 25.6, "light_intensity": 850}
+          也接受 "Light:850,Humidity:65.2,Temperature:25.6,Servo_angle:90" 文本格式
+    确认: {"type": "ack", "command_id": 12, "result": "Watering_done"}
+    回复中的 code 与对应HTTP接口的状态码一致
+    """
+    try:
+        data = json.loads(message)
+    except ValueError:
+        try:
+            data = parse_sensor_string(message)
+        except ValueError as e:
+            return {'type': 'error', 'code': 400, 'error': str(e)}
+    if not isinstance(data, dict):
+        return {'type': 'error', 'code': 400, 'error': 'Message must be a JSON object'}
+
+    message_type = data.pop('type', 'reading')
+    if message_type == 'ack':
+        try:
+            record = db.mark_command_acked(int(data['command_id']), data.get('result'))
+        except (KeyError, TypeError, ValueError):
+            return {'type': 'error', 'code': 400, 'error': 'Invalid command_id'}
+        if record is None:
+            return {'type': 'error', 'code': 404, 'error': 'Unknown command_id', 'command_id': data['command_id']}
+        log_event('command.acked', 'ESP8266确认指令已执行', command_id=record['id'], status=record['status'],
+                  result=record['result'], total_seconds=record['total_seconds'], channel='websocket')
+        return {'type': 'ack_result', 'code': 200, 'command_id': record['id'], 'command_status': record['status']}
+
+    if message_type != 'reading':
+        return {'type': 'error', 'code': 400, 'error': f'Unknown message type: {message_type}'}
+
+    if device_id and 'device_id' not in data:
+        data['device_id'] = device_id
+    try:
+        idempotency_key = idempotency_key_for(data)
+    except ValueError as e:
+        return {'type': 'error', 'code': 400, 'error': str(e)}
+
+    # 与 POST /sensor-data 相同的准入控制，每条读数单独计数
+    rejection = admission.admit()
+    if rejection is not None:
+        status, retry_after, reason = rejection
+        log_event('sensor.rejected', 'Sensor data rejected by admission control', logging.WARNING,
+                  status=status, reason=reason, channel='websocket')
+        return {'type': 'error', 'code': status, 'request_id': idempotency_key,
+                'error': 'Server busy, retry later', 'reason': reason, 'retry_after': retry_after}
+    try:
+        status, body = ingest_reading(data, idempotency_key)
+    finally:
+        admission.release()
+    return {'type': 'reading_ack' if status == 200 else 'error', 'code': status,
+            'request_id': idempotency_key, **body}
+
+def device_channel(ws):
+    """
+    设备长连接：读数上行、指令下行共用一个WebSocket连接，省去每次上传和轮询的TLS握手
+    服务器推送指令: {"type": "command", "command": "Watering_5", "command_id": 12}
+    设备执行完成后在同一连接上发送 ack；HTTP接口（/sensor-data、/get-pending-command、/command-ack）保留作为回退
+    查询参数: device_id（可选，读数只带 seq 时用于组成幂等键）
+    """
+    device_id = request.args.get('device_id', '')
+    log_event('device.connected', '设备长连接已建立', device_id=device_id, remote_addr=request.remote_addr)
+    # 已推送、尚未确认的指令 id -> (PendingCommand, 推送时间)；设备逐条执行，同时最多 DEVICE_COMMAND_WINDOW 条
+    unacked = {}
+    try:
+        while True:
+            message = ws.receive(timeout=DEVICE_COMMAND_POLL_INTERVAL)
+            if message is not None:
+                reply = handle_device_message(message, device_id)
+                if 'command_id' in reply:
+                    unacked.pop(reply['command_id'], None)
+                ws.send(json.dumps(reply, ensure_ascii=False, separators=(',', ':')))
+
+            # 确认可能改走了HTTP接口，超时的不再占用名额
+            now = time.monotonic()
+            for command_id in [i for i, (_, sent_at) in unacked.items() if now - sent_at > DEVICE_COMMAND_ACK_TIMEOUT]:
+                del unacked[command_id]
+
+            commands = command_manager.get_commands(DEVICE_COMMAND_WINDOW - len(unacked))
+            for index, pending in enumerate(commands):
+                try:
+                    ws.send(json.dumps({'type': 'command', 'command': pending.command,
+                                        'command_id': pending.command_id}, separators=(',', ':')))
+                except ConnectionClosed:
+                    command_manager.requeue(commands[index:])
+                    raise
+                unacked[pending.command_id] = (pending, now)
+                log_event('command.delivered', '通过长连接向ESP8266推送指令', command=pending.command,
+                          command_id=pending.command_id, channel='websocket')
+    finally:
+        # 断开时仍未确认的指令放回队列，由下一个连接或HTTP轮询重新下发；期间已通过HTTP确认的除外
+        pending_commands = []
+        for pending, _ in unacked.values():
+            history = db.get_command_history(command_id=pending.command_id)
+            if history and history[0]['status'] == 'fetched':
+                pending_commands.append(pending)
+        requeued = command_manager.requeue(pending_commands) if pending_commands else 0
+        log_event('device.disconnected', '设备长连接已断开', device_id=device_id, requeued=requeued)
+
+if sock:
+    sock.route('/device-ws')(device_channel)
+
+@app.route('/command-history', methods=['GET'])
+def get_command_history():
+    """最近的指令及其生命周期状态，参数: limit (默认50)"""
+    try:
+        limit = request.args.get('limit', default=50, type=int)
+        return jsonify({'status': 'success', 'commands': db.get_command_history(limit)}), 200
+
+    except Exception as e:
+        print(f"Error retrieving command history: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/command-history/latency', methods=['GET'])
+def get_command_latency():
+    """指令送达/执行延迟分位数，参数: limit (最近多少条，默认1000)"""
+    try:
+        limit = request.args.get('limit', default=1000, type=int)
+        return jsonify({'status': 'success', **db.get_command_latency(limit=limit)}), 200
+
+    except Exception as e:
+        print(f"Error computing command latency: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/sensor-data/latest-id', methods=['GET'])
 def get_latest_data_id():
     """获取最新数据的ID和时间戳，用于检测数据更新"""
@@ -596,9 +1386,9 @@ def get_latest_data_id():
         if latest_data:
             return jsonify({
                 'status': 'success',
-                'id': latest_data['id'],
-                'timestamp': latest_data['timestamp'],
-                'created_at': latest_data['created_at']
+                'id': latest_data.id,
+                'timestamp': latest_data.timestamp,
+                'created_at': latest_data.created_at
             }), 200
         else:
             return jsonify({
@@ -625,9 +1415,48 @@ def admin_panel():
     except Exception as e:
         return f"Error loading admin panel: {str(e)}"
 
-if __name__ == '__main__':
-    import os
+def evaluate_rules_for_batch(batch):
+    """行协议批量入库后逐条求值自动化规则"""
+    for reading in batch:
+        rule_engine.evaluate(reading)
 
+line_ingest = None
+
+def start_background_services():
+    """
+    启动快照后台任务和可选的TCP/UDP行协议入库监听，只在处理请求的进程中调用一次
+    （gunicorn下每个worker各自运行快照任务，文件原子替换；行协议监听要求单worker部署）
+    """
+    global line_ingest
+    snapshot_store.start(db)
+
+    # 配置 LINE_INGEST_TCP_PORT 或 LINE_INGEST_UDP_PORT 时启动
+    if os.environ.get('LINE_INGEST_TCP_PORT') or os.environ.get('LINE_INGEST_UDP_PORT'):
+        line_ingest = LineIngestServer(
+            db, parse_sensor_string,
+            host=os.environ.get('LINE_INGEST_HOST', '0.0.0.0'),
+            tcp_port=int(os.environ.get('LINE_INGEST_TCP_PORT') or 0) or None,
+            udp_port=int(os.environ.get('LINE_INGEST_UDP_PORT') or 0) or None,
+            batch_size=int(os.environ.get('LINE_INGEST_BATCH_SIZE', 2000)),
+            flush_interval=float(os.environ.get('LINE_INGEST_FLUSH_INTERVAL', 0.2)),
+            on_batch=evaluate_rules_for_batch,
+            admission=admission
+        )
+        try:
+            line_ingest.start()
+        except OSError as e:
+            # 端口被其他程序占用时只提供HTTP接口
+            print(f"Error starting line ingest listener: {str(e)}")
+            line_ingest = None
+
+# 调试模式下直接运行时，werkzeug重载器的监视进程只负责在代码变化时重启子进程，不处理请求；
+# 后台服务由它启动的子进程（WERKZEUG_RUN_MAIN=true）启动
+RELOADER_WATCHER = (__name__ == '__main__' and os.environ.get('FLASK_ENV') != 'production'
+                    and os.environ.get('WERKZEUG_RUN_MAIN') != 'true')
+if not IS_JOB_WORKER and not RELOADER_WATCHER:
+    start_background_services()
+
+if __name__ == '__main__':
     # 获取端口号，云平台通常通过环境变量提供
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('FLASK_ENV') != 'production'
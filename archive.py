@@ -0,0 +1,269 @@
+"""
+冷数据归档
+已结束月份的数据按天写入压缩的只读分段文件 (archive/YYYY/MM/YYYY-MM-DD.json.gz)，
+并在 index.json 中记录每天的文件、记录数、id边界和统计量，供查询联邦和全量统计使用
+分段先写入 pending.json（待发布），热库中的数据删除提交后才加入索引
+"""
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# 分段文件中每行的列顺序，与 SensorDatabase 的查询列一致
+COLUMNS = ('id', 'humidity', 'temperature', 'light_intensity', 'servo_angle', 'timestamp',
+           'created_at', 'year', 'month', 'day', 'hour', 'date_key', 'datetime_key')
+
+# 索引中保存统计量的指标: (列下标, 名称)
+STAT_METRICS = ((1, 'humidity'), (2, 'temperature'), (3, 'light_intensity'), (4, 'servo_angle'))
+
+
+def _metric_stats(values):
+    """一组值的 sum/min/max，与SQL聚合函数一样跳过空值；全部为空时 min/max 为None"""
+    values = [value for value in values if value is not None]
+    return {
+        'sum': sum(values),
+        'min': min(values) if values else None,
+        'max': max(values) if values else None
+    }
+
+
+class SensorArchive:
+    def __init__(self, archive_dir, cache_size=32):
+        self.archive_dir = archive_dir
+        self.index_path = os.path.join(archive_dir, 'index.json')
+        self.cache_size = cache_size
+        self._index = {}
+        self._index_mtime = None
+        self._segments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load_index(self):
+        """读取索引文件，文件未变化时使用内存缓存"""
+        try:
+            mtime = os.path.getmtime(self.index_path)
+        except OSError:
+            self._index, self._index_mtime = {}, None
+            return self._index
+        if mtime != self._index_mtime:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._index = json.load(f)
+            self._index_mtime = mtime
+        return self._index
+
+    def _write_index(self, index):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+        self._index = index
+        self._index_mtime = os.path.getmtime(self.index_path)
+
+    def segment_path(self, date_key):
+        return os.path.join(self.archive_dir, date_key[0:4], date_key[5:7], f"{date_key}.json.gz")
+
+    def has_date(self, date_key):
+        with self._lock:
+            return date_key in self._load_index()
+
+    def date_keys(self, start_key=None, end_key=None, prefix=None, after_id=None):
+        """索引中符合条件的日期（升序），日期范围含两端；after_id: 只要含有更大id的日期"""
+        with self._lock:
+            index = self._load_index()
+            keys = sorted(index)
+            if after_id is not None:
+                keys = [k for k in keys if index[k]['last_id'] > after_id]
+        if prefix:
+            keys = [k for k in keys if k.startswith(prefix)]
+        if start_key:
+            keys = [k for k in keys if k >= start_key]
+        if end_key:
+            keys = [k for k in keys if k <= end_key]
+        return keys
+
+    def _pending_path(self):
+        return os.path.join(self.archive_dir, 'pending.json')
+
+    def _load_pending(self):
+        try:
+            with open(self._pending_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except OSError:
+            return {}
+
+    def _write_pending(self, pending):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        tmp_path = self._pending_path() + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(pending, f, ensure_ascii=False, sort_keys=True)
+        os.replace(tmp_path, self._pending_path())
+
+    def _write_segment_file(self, date_key, rows):
+        """写入一天的分段文件（rows按id升序，列顺序见COLUMNS），返回索引条目"""
+        path = self.segment_path(date_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + '.tmp'
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump([list(row) for row in rows], f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+        self._segments.pop(date_key, None)
+
+        return {
+            'file': os.path.relpath(path, self.archive_dir),
+            'count': len(rows),
+            'first_id': rows[0][0],
+            'last_id': rows[-1][0],
+            'first_record': rows[0][6],
+            'last_record': rows[-1][6],
+            'stats': {name: _metric_stats(row[i] for row in rows) for i, name in STAT_METRICS}
+        }
+
+    def stage_segment(self, date_key, rows):
+        """
+        写入一天的分段文件并记为待发布，查询看不到；热库中的数据删除提交后再 publish，
+        避免同一行同时出现在热库和归档中
+        分段一经发布不再修改；重复写入同一天时要求内容条数一致，便于中断后重试
+        """
+        with self._lock:
+            existing = self._load_index().get(date_key)
+            if existing is not None:
+                if existing['count'] != len(rows):
+                    raise ValueError(f'Archive segment for {date_key} already exists with different content')
+                return existing
+
+            entry = self._write_segment_file(date_key, rows)
+            pending = self._load_pending()
+            pending[date_key] = entry
+            self._write_pending(pending)
+            return entry
+
+    def pending(self):
+        """已写入分段文件、尚未发布的日期 -> 索引条目"""
+        with self._lock:
+            return self._load_pending()
+
+    def publish(self, date_keys):
+        """把待发布的分段加入索引，之后查询才会读取"""
+        with self._lock:
+            pending = self._load_pending()
+            index = dict(self._load_index())
+            for date_key in date_keys:
+                entry = pending.pop(date_key, None)
+                if entry is not None:
+                    index[date_key] = entry
+            self._write_index(index)
+            self._write_pending(pending)
+
+    def discard(self, date_key):
+        """放弃待发布的分段（热库删除没有提交，数据仍在热库中）"""
+        with self._lock:
+            pending = self._load_pending()
+            if pending.pop(date_key, None) is not None:
+                self._remove_file(self.segment_path(date_key))
+                self._write_pending(pending)
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def drop_segments(self, date_keys=None):
+        """删除指定日期（默认全部，包括待发布的）的分段，返回删除的记录数"""
+        with self._lock:
+            index = dict(self._load_index())
+            pending = self._load_pending()
+            if date_keys is None:
+                date_keys = list(index) + list(pending)
+            if not date_keys:
+                return 0
+            removed = 0
+            for date_key in date_keys:
+                entry = index.pop(date_key, None)
+                if entry is not None:
+                    removed += entry['count']
+                if entry is not None or pending.pop(date_key, None) is not None:
+                    self._remove_file(self.segment_path(date_key))
+                self._segments.pop(date_key, None)
+            self._write_index(index)
+            self._write_pending(pending)
+            return removed
+
+    def trim_segment(self, date_key, cutoff):
+        """删除一天分段中 created_at 早于 cutoff 的行（重写分段文件），返回删除的行数"""
+        rows = self.read_segment(date_key)
+        keep = [row for row in rows if row[6] >= cutoff]
+        if len(keep) == len(rows):
+            return 0
+        if not keep:
+            return self.drop_segments([date_key])
+        with self._lock:
+            index = dict(self._load_index())
+            index[date_key] = self._write_segment_file(date_key, keep)
+            self._write_index(index)
+        return len(rows) - len(keep)
+
+    def read_segment(self, date_key):
+        """读取一天的分段，返回按id升序的行元组列表；分段不可变，解码结果做LRU缓存"""
+        with self._lock:
+            rows = self._segments.get(date_key)
+            if rows is not None:
+                self._segments.move_to_end(date_key)
+                return rows
+            entry = self._load_index().get(date_key)
+        if entry is None:
+            return []
+
+        with gzip.open(os.path.join(self.archive_dir, entry['file']), 'rt', encoding='utf-8') as f:
+            rows = [tuple(row) for row in json.load(f)]
+
+        with self._lock:
+            self._segments[date_key] = rows
+            while len(self._segments) > self.cache_size:
+                self._segments.popitem(last=False)
+        return rows
+
+    def query(self, date_keys, predicate=None):
+        """读取多天的归档行并按id降序返回，可选逐行过滤"""
+        rows = []
+        for date_key in date_keys:
+            segment = self.read_segment(date_key)
+            rows.extend(segment if predicate is None else [row for row in segment if predicate(row)])
+        rows.sort(key=lambda row: row[0], reverse=True)
+        return rows
+
+    def count(self, max_id=None):
+        """归档的记录数；max_id: 只统计 id 不大于该值的记录（只有跨越该id的那一天需要读取分段）"""
+        with self._lock:
+            index = self._load_index()
+        if max_id is None:
+            return sum(entry['count'] for entry in index.values())
+        count = 0
+        for date_key, entry in index.items():
+            if entry['last_id'] <= max_id:
+                count += entry['count']
+            elif entry['first_id'] <= max_id:
+                count += sum(1 for row in self.read_segment(date_key) if row[0] <= max_id)
+        return count
+
+    def summary(self):
+        """归档的总体统计，用于与热库统计合并"""
+        with self._lock:
+            index = self._load_index()
+        if not index:
+            return None
+        entries = [index[k] for k in sorted(index)]
+        return {
+            'days': len(entries),
+            'count': sum(e['count'] for e in entries),
+            'first_record': entries[0]['first_record'],
+            'last_record': entries[-1]['last_record'],
+            'stats': {
+                name: {
+                    'sum': sum(e['stats'][name]['sum'] for e in entries),
+                    'min': _metric_stats(e['stats'][name]['min'] for e in entries)['min'],
+                    'max': _metric_stats(e['stats'][name]['max'] for e in entries)['max']
+                } for _, name in STAT_METRICS
+            }
+        }
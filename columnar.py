@@ -0,0 +1,117 @@
+"""
+列式二进制导出
+每个字段写成一个定长类型的NumPy数组，打包为不压缩的 .npz：
+数值按二进制原样保存，比JSON小得多；读取时直接按偏移内存映射每一列，不需要逐行解析
+"""
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+
+import numpy as np
+
+# (列名, 类型)，行批次中的字段顺序与此一致
+# 光照是传感器原始读数，可能超过 int16 的范围，与舵机角度一起用 int32
+EXPORT_COLUMNS = (
+    ('id', np.int64),
+    ('epoch', np.int64),                # UTC 秒
+    ('humidity', np.float32),
+    ('temperature', np.float32),
+    ('light_intensity', np.int32),
+    ('servo_angle', np.int32),
+)
+
+# 本地文件头的固定部分长度（ZIP规范），数据紧跟在文件名和扩展字段之后
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def _npy_header(dtype, count):
+    buffer = io.BytesIO()
+    np.lib.format.write_array_header_1_0(buffer, {
+        'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        'fortran_order': False,
+        'shape': (count,)
+    })
+    return buffer.getvalue()
+
+
+def _check_integer_column(name, dtype, column):
+    """整数列中的空值(NaN)或超出类型范围的值转换后会变成无意义的数，直接报错而不是写入错误数据"""
+    if not np.issubdtype(dtype, np.integer):
+        return
+    if np.isnan(column).any():
+        raise ValueError(f'Column {name} contains NULL values')
+    limits = np.iinfo(dtype)
+    if column.min() < limits.min or column.max() > limits.max:
+        raise ValueError(f'Column {name} has values outside the {np.dtype(dtype).name} range')
+
+
+def write_npz(chunks, path):
+    """
+    将行批次写成 .npz，返回行数
+    chunks: 可迭代的批次，每批为按 EXPORT_COLUMNS 顺序的行元组列表
+    每批转换为定长数组后追加到各列的临时文件，最后按 .npy 格式打包（不压缩），
+    内存占用只与批大小有关；先写临时文件再原子替换
+    """
+    path = os.path.abspath(path)
+    count = 0
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(path)) as tmp_dir:
+        raw_paths = [os.path.join(tmp_dir, f'{name}.bin') for name, _ in EXPORT_COLUMNS]
+        raw_files = [open(raw_path, 'wb') for raw_path in raw_paths]
+        try:
+            for rows in chunks:
+                if not rows:
+                    continue
+                table = np.array(rows, dtype=np.float64).reshape(len(rows), len(EXPORT_COLUMNS))
+                for raw_file, (name, dtype), column in zip(raw_files, EXPORT_COLUMNS, table.T):
+                    _check_integer_column(name, dtype, column)
+                    column.astype(dtype).tofile(raw_file)
+                count += len(rows)
+        finally:
+            for raw_file in raw_files:
+                raw_file.close()
+
+        tmp_path = path + '.tmp'
+        with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for raw_path, (name, dtype) in zip(raw_paths, EXPORT_COLUMNS):
+                header = _npy_header(dtype, count)
+                info = zipfile.ZipInfo(f'{name}.npy')
+                info.compress_type = zipfile.ZIP_STORED
+                info.file_size = len(header) + os.path.getsize(raw_path)
+                with archive.open(info, 'w') as member, open(raw_path, 'rb') as raw_file:
+                    member.write(header)
+                    shutil.copyfileobj(raw_file, member, 1024 * 1024)
+        os.replace(tmp_path, path)
+    return count
+
+
+def load_npz(path, mmap=True):
+    """
+    读取 write_npz 导出的文件，返回 {列名: 数组}
+    mmap=True 时每列为只读内存映射（成员未压缩，直接定位到 .npy 数据的偏移），不复制数据
+    """
+    if not mmap:
+        with np.load(path) as data:
+            return {name: data[name] for name in data.files}
+
+    columns = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f'Member {info.filename} is compressed and cannot be memory-mapped')
+            f.seek(info.header_offset + 26)
+            name_length = int.from_bytes(f.read(2), 'little')
+            extra_length = int.from_bytes(f.read(2), 'little')
+            f.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length)
+            if np.lib.format.read_magic(f) == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if shape[0] == 0:
+                columns[name] = np.empty(shape, dtype=dtype)
+            else:
+                columns[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                          order='F' if fortran_order else 'C')
+    return columns
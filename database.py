@@ -1,109 +1,282 @@
 import sqlite3
 import json
+import math
+import calendar
 from datetime import datetime, timedelta
 import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.request import pathname2url
 import pytz
+from quantile_sketch import TDigest, append_values, summarize
+from archive import SensorArchive
+from shards import MonthlyShards, month_of
+import migrations
+import columnar
+from readings import SensorReading, ReadingBatch
 
-class SensorDatabase:
-    def __init__(self, db_path="sensor_data.db"):
-        self.db_path = db_path
-        self.init_database()
+# 维护分位数草图的指标
+SKETCH_METRICS = ('humidity', 'temperature', 'light_intensity', 'servo_angle')
 
-    def init_database(self):
-        """初始化数据库，创建表结构"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+# 幂等键保留时长（设备重试只发生在几十秒内），以及进程内最近键缓存的容量
+INGEST_KEY_TTL_HOURS = 24
+INGEST_KEY_CACHE_SIZE = 4096
+# 每写入多少条清理一次过期的幂等键
+INGEST_KEY_PRUNE_EVERY = 1000
 
-        # 创建传感器数据表，添加年月日时字段
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                humidity REAL NOT NULL,
-                temperature REAL NOT NULL,
-                light_intensity INTEGER NOT NULL,
-                servo_angle INTEGER DEFAULT 0,
-                timestamp TEXT NOT NULL,
-                created_at TEXT NOT NULL,
-                year INTEGER NOT NULL,
-                month INTEGER NOT NULL,
-                day INTEGER NOT NULL,
-                hour INTEGER NOT NULL,
-                date_key TEXT NOT NULL,
-                datetime_key TEXT NOT NULL
-            )
-        ''')
-        
-        # 数据库迁移：为现有表添加servo_angle字段（如果不存在）
-        try:
-            cursor.execute('ALTER TABLE sensor_data ADD COLUMN servo_angle INTEGER DEFAULT 0')
-            print("数据库迁移：已添加servo_angle字段")
-        except sqlite3.OperationalError:
-            # 字段已存在，忽略错误
-            pass
+# 指令历史保留的最近条数
+COMMAND_HISTORY_LIMIT = 10000
 
-        # 创建索引以提高查询性能
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_timestamp ON sensor_data(timestamp)
-        ''')
+# created_at 为北京时间，换算UTC秒时减去的偏移
+BEIJING_UTC_OFFSET = 8 * 3600
 
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_created_at ON sensor_data(created_at)
-        ''')
+# 相邻两条读数间隔超过多少秒记为一次断线
+GAP_THRESHOLD_SECONDS = 600
 
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_year ON sensor_data(year)
-        ''')
 
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_month ON sensor_data(year, month)
-        ''')
+def created_at_epoch(created_at):
+    """北京时间的 created_at (YYYY-MM-DD HH:MM:SS) 换算为UTC秒"""
+    return calendar.timegm(time.strptime(created_at, '%Y-%m-%d %H:%M:%S')) - BEIJING_UTC_OFFSET
 
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_day ON sensor_data(year, month, day)
-        ''')
 
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_date_key ON sensor_data(date_key)
-        ''')
+def epoch_created_at(epoch):
+    """UTC秒换算为北京时间的 created_at 格式"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(epoch + BEIJING_UTC_OFFSET))
 
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_hour ON sensor_data(year, month, day, hour)
-        ''')
 
-        cursor.execute('''
-            CREATE INDEX IF NOT EXISTS idx_datetime_key ON sensor_data(datetime_key)
-        ''')
+class SensorDatabase:
+    def __init__(self, db_path="sensor_data.db", archive_dir=None, write_timeout=5.0, read_only=False, shard_dir=None,
+                 gap_threshold=GAP_THRESHOLD_SECONDS):
+        self.db_path = db_path
+        # 只读实例（后台任务进程使用）：不执行迁移，查询用 mode=ro 连接，不会取得写锁
+        self.read_only = read_only
+        # 入库时等待写锁的最长秒数，超时抛出 sqlite3.OperationalError('database is locked')
+        self.write_timeout = write_timeout
+        # 冷数据归档目录，未配置时所有数据都留在热库
+        self.archive = SensorArchive(archive_dir) if archive_dir else None
+        # 数据变更回调 callback(event, date_key)，event 为 insert/delete/clear
+        self.listeners = []
+        # 最近的幂等键 -> 数据id，重试请求大多在这里命中，不用访问数据库
+        self.recent_ingest_keys = OrderedDict()
+        self.ingest_key_lock = threading.Lock()
+        self.inserts_since_prune = 0
+        # 断线索引的阈值（秒），与库中记录的阈值不同时启动时重建索引
+        self.gap_threshold = int(gap_threshold)
+        # 按月分片目录，配置后传感器数据写入每月一个的分片文件，主库只保留索引和统计
+        # 迁移在启用分片之前执行，回填读取的是主库中的数据；之后再把主库中的数据移入分片
+        self.shards = None
+        if not read_only:
+            self.init_database()
+        if shard_dir:
+            self.shards = MonthlyShards(shard_dir)
+            if not read_only:
+                self._move_rows_to_shards()
+        if not read_only:
+            self._ensure_gap_index()
+
+    def _connect(self):
+        """查询用的连接；只读实例以 mode=ro 打开"""
+        if self.read_only:
+            uri = f"file:{pathname2url(os.path.abspath(self.db_path))}?mode=ro"
+            return sqlite3.connect(uri, uri=True)
+        return sqlite3.connect(self.db_path)
+
+    def _query_rows(self, sql, params=(), months=None, limit=None, descending=True):
+        """
+        执行一条 sensor_data 查询，返回全部行
+        分片模式下在 months 对应的分片（默认全部）上依次执行，按id降序（descending=False 时升序）拼接
+        limit: 给定时sql以 LIMIT ? 结尾，由这里补上参数
+        """
+        if self.shards:
+            return self.shards.query(sql, params, months, limit, descending, read_only=self.read_only)
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute(sql, [*params, limit] if limit is not None else params)
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+
+    def _iter_row_chunks(self, sql, params=(), months=None, descending=True, chunk_size=5000):
+        """与 _query_rows 相同，但用 fetchmany 分批返回，内存占用只与批大小有关"""
+        if self.shards:
+            yield from self.shards.iter_chunks(sql, params, months, descending, chunk_size, read_only=self.read_only)
+            return
+        conn = self._connect()
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            conn.close()
+
+    def _months(self, start=None, end=None):
+        """分片模式下 start~end（日期或时间，含两端）涉及的分片月份，非分片模式返回None"""
+        return self.shards.months(start, end) if self.shards else None
+
+    def _next_data_id(self, cursor, count=1):
+        """
+        由主库的 sqlite_sequence 分配全局递增的id，与非分片模式的AUTOINCREMENT衔接
+        count: 一次分配的连续id个数，返回其中第一个
+        """
+        cursor.execute("UPDATE sqlite_sequence SET seq = seq + ? WHERE name = 'sensor_data'", (count,))
+        if cursor.rowcount == 0:
+            cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('sensor_data', ?)", (count,))
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'sensor_data'")
+        return cursor.fetchone()[0] - count + 1
+
+    def _begin_insert(self, cursor):
+        """
+        开始写入事务：先用 BEGIN IMMEDIATE 取得写锁，再取接收时间（北京时间 UTC+8）并返回，
+        保证 created_at 的先后与id分配顺序一致，不会出现等锁期间被后到的写入超过的情况
+        分片模式下当月分片只能在事务开始前附加（附加为 shard）；等锁期间跨月时回滚，附加新月份的分片后重试
+        """
+        beijing_tz = pytz.timezone('Asia/Shanghai')
+        attached = None
+        while True:
+            if self.shards:
+                month = datetime.now(beijing_tz).strftime('%Y-%m')
+                if month != attached:
+                    if attached is not None:
+                        cursor.execute('DETACH DATABASE shard')
+                    cursor.execute('ATTACH DATABASE ? AS shard', (self.shards.ensure(month),))
+                    attached = month
+            cursor.execute('BEGIN IMMEDIATE')
+            now = datetime.now(beijing_tz)
+            if attached is None or now.strftime('%Y-%m') == attached:
+                return now
+            cursor.execute('ROLLBACK')
+
+    def _move_rows_to_shards(self):
+        """切换到分片模式时，把主库sensor_data中已有的数据按月移入分片，每月一个事务，中断后重新执行即可继续"""
+        conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30)
+        cursor = conn.cursor()
+        cursor.execute('SELECT DISTINCT substr(date_key, 1, 7) FROM sensor_data')
+        months = [row[0] for row in cursor.fetchall()]
+
+        columns = 'id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key'
+        moved = 0
+        for month in months:
+            cursor.execute('ATTACH DATABASE ? AS shard', (self.shards.ensure(month),))
+            cursor.execute('BEGIN IMMEDIATE')
+            bounds = (f"{month}-01", f"{month}-31")
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO shard.sensor_data ({columns})
+                SELECT {columns} FROM main.sensor_data WHERE date_key BETWEEN ? AND ?
+            ''', bounds)
+            moved += cursor.rowcount
+            cursor.execute('DELETE FROM main.sensor_data WHERE date_key BETWEEN ? AND ?', bounds)
+            cursor.execute('COMMIT')
+            cursor.execute('DETACH DATABASE shard')
 
-        conn.commit()
         conn.close()
-        print(f"数据库初始化完成: {self.db_path}")
+        if moved:
+            print(f"已将 {moved} 条数据移入按月分片: {self.shards.shard_dir}")
 
-    def add_sensor_data(self, humidity, temperature, light_intensity, servo_angle=0):
-        """添加传感器数据"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def add_listener(self, callback):
+        """注册数据变更回调（用于缓存失效）"""
+        self.listeners.append(callback)
 
-        # 使用北京时间 (UTC+8)
-        beijing_tz = pytz.timezone('Asia/Shanghai')
-        now = datetime.now(beijing_tz)
-        timestamp = now.isoformat()
-        created_at = now.strftime('%Y-%m-%d %H:%M:%S')
-        year = now.year
-        month = now.month
-        day = now.day
-        hour = now.hour
-        date_key = now.strftime('%Y-%m-%d')
-        datetime_key = now.strftime('%Y-%m-%d-%H')
+    def _notify(self, event, date_key=None):
+        for callback in self.listeners:
+            callback(event, date_key)
 
-        cursor.execute('''
-            INSERT INTO sensor_data
-            (humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key))
+    def init_database(self):
+        """初始化数据库：执行尚未应用的结构迁移，已是最新版本时只读取一次 user_version"""
+        applied = migrations.migrate(self)
+        if applied:
+            print(f"数据库初始化完成: {self.db_path}，已应用迁移: {', '.join(applied)}")
+
+    def add_sensor_data(self, humidity, temperature, light_intensity, servo_angle=0, idempotency_key=None):
+        """
+        添加传感器数据
+        idempotency_key: 设备序号或请求id；同一个键再次提交时不插入，返回原记录并带 duplicate=True
+        """
+        if idempotency_key is not None:
+            with self.ingest_key_lock:
+                data_id = self.recent_ingest_keys.get(idempotency_key)
+            if data_id is not None:
+                return self._duplicate_reading(data_id)
+
+        conn = sqlite3.connect(self.db_path, timeout=self.write_timeout)
+        cursor = conn.cursor()
 
-        conn.commit()
-        data_id = cursor.lastrowid
-        conn.close()
+        # 校验或统计更新出错时必须回滚并关闭连接，否则未结束的事务一直占着写锁，之后的写入全部超时
+        try:
+            # 先取得写锁再取时间；分片模式下当月分片附加到同一连接，数据行和幂等键、统计、日历在同一个事务中提交
+            now = self._begin_insert(cursor)
+            timestamp = now.isoformat()
+            created_at = now.strftime('%Y-%m-%d %H:%M:%S')
+            year = now.year
+            month = now.month
+            day = now.day
+            hour = now.hour
+            date_key = now.strftime('%Y-%m-%d')
+            datetime_key = now.strftime('%Y-%m-%d-%H')
+
+            if idempotency_key is not None:
+                # 先占用键：事务已持有写锁，同一键的并发重试会等待并在之后看到已提交的键
+                cursor.execute('INSERT OR IGNORE INTO ingest_keys (key, data_id, created_at) VALUES (?, NULL, ?)',
+                               (idempotency_key, created_at))
+                if cursor.rowcount == 0:
+                    cursor.execute('SELECT data_id FROM ingest_keys WHERE key = ?', (idempotency_key,))
+                    data_id = cursor.fetchone()[0]
+                    conn.rollback()
+                    self._remember_ingest_key(idempotency_key, data_id)
+                    return self._duplicate_reading(data_id)
+
+            if self.shards:
+                data_id = self._next_data_id(cursor)
+                cursor.execute('''
+                    INSERT INTO shard.sensor_data
+                    (id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (data_id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key))
+            else:
+                cursor.execute('''
+                    INSERT INTO sensor_data
+                    (humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key))
+                data_id = cursor.lastrowid
+
+            if idempotency_key is not None:
+                cursor.execute('UPDATE ingest_keys SET data_id = ? WHERE key = ?', (data_id, idempotency_key))
+                self.inserts_since_prune += 1
+                if self.inserts_since_prune >= INGEST_KEY_PRUNE_EVERY:
+                    self.inserts_since_prune = 0
+                    cutoff = (now - timedelta(hours=INGEST_KEY_TTL_HOURS)).strftime('%Y-%m-%d %H:%M:%S')
+                    cursor.execute('DELETE FROM ingest_keys WHERE created_at < ?', (cutoff,))
+
+            # 在同一事务中更新累计统计和当天的分位数草图
+            readings = [{
+                'id': data_id,
+                'date_key': date_key,
+                'hour': hour,
+                'created_at': created_at,
+                'humidity': humidity,
+                'temperature': temperature,
+                'light_intensity': light_intensity,
+                'servo_angle': servo_angle
+            }]
+            self._update_running_stats(cursor, readings)
+            self._update_calendar(cursor, readings)
+            self._update_sketches(cursor, readings)
+            self._update_gaps(cursor, readings)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        if idempotency_key is not None:
+            self._remember_ingest_key(idempotency_key, data_id)
+        self._notify('insert', date_key)
 
         return {
             'id': data_id,
@@ -121,346 +294,359 @@ class SensorDatabase:
             'datetime_key': datetime_key
         }
 
-    def get_all_data(self, limit=None, offset=0):
-        """获取所有传感器数据"""
-        conn = sqlite3.connect(self.db_path)
+    def add_sensor_data_batch(self, readings):
+        """
+        批量添加传感器数据：数据行、统计、日历和草图在一个事务中写入
+        readings: [{'humidity', 'temperature', 'light_intensity', 'servo_angle'(可选，默认0)}, ...]
+        同一批读数使用同一个接收时间，id 一次分配一段连续值；不支持幂等键
+        返回写入的读数列表（含 id、created_at、date_key、hour）
+        """
+        if not readings:
+            return []
+
+        conn = sqlite3.connect(self.db_path, timeout=self.write_timeout)
         cursor = conn.cursor()
+        table = 'shard.sensor_data' if self.shards else 'sensor_data'
+
+        try:
+            # 先取得写锁再取时间，同一批读数使用同一个接收时间
+            now = self._begin_insert(cursor)
+            timestamp = now.isoformat()
+            created_at = now.strftime('%Y-%m-%d %H:%M:%S')
+            year = now.year
+            month = now.month
+            day = now.day
+            hour = now.hour
+            date_key = now.strftime('%Y-%m-%d')
+            datetime_key = now.strftime('%Y-%m-%d-%H')
+
+            first_id = self._next_data_id(cursor, len(readings))
+            batch = [{
+                'id': first_id + offset,
+                'date_key': date_key,
+                'hour': hour,
+                'created_at': created_at,
+                'humidity': reading['humidity'],
+                'temperature': reading['temperature'],
+                'light_intensity': reading['light_intensity'],
+                'servo_angle': reading.get('servo_angle', 0)
+            } for offset, reading in enumerate(readings)]
+
+            cursor.executemany(f'''
+                INSERT INTO {table}
+                (id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (r['id'], r['humidity'], r['temperature'], r['light_intensity'], r['servo_angle'],
+                 timestamp, created_at, year, month, day, hour, date_key, datetime_key)
+                for r in batch
+            ])
+
+            self._update_running_stats(cursor, batch)
+            self._update_calendar(cursor, batch)
+            self._update_sketches(cursor, batch)
+            self._update_gaps(cursor, batch)
+            conn.commit()
+        finally:
+            conn.close()
+
+        self._notify('insert', date_key)
+        return batch
+
+    def _remember_ingest_key(self, idempotency_key, data_id):
+        with self.ingest_key_lock:
+            self.recent_ingest_keys[idempotency_key] = data_id
+            self.recent_ingest_keys.move_to_end(idempotency_key)
+            while len(self.recent_ingest_keys) > INGEST_KEY_CACHE_SIZE:
+                self.recent_ingest_keys.popitem(last=False)
+
+    def _duplicate_reading(self, data_id):
+        """重复提交时返回原记录"""
+        reading = self.get_data_by_id(data_id)
+        reading = reading.to_dict() if reading else {'id': data_id}
+        reading['duplicate'] = True
+        return reading
+
+    def get_data_by_id(self, data_id):
+        """根据id获取单条数据（SensorReading），不存在时返回None"""
+        rows = self._query_rows('''
+            SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
+            FROM sensor_data
+            WHERE id = ?
+            LIMIT ?
+        ''', (data_id,), limit=1)
+        return SensorReading(*rows[0]) if rows else None
 
+    def get_all_data(self, limit=None, offset=0):
+        """获取所有传感器数据（含归档，按id降序的 ReadingBatch）"""
         if limit:
-            cursor.execute('''
+            # 取前 offset+limit 行再跳过offset，分片模式下每个分片只需取还差的行数；热库不够时从最新的归档日期往前补
+            rows = self._query_rows('''
                 SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
                 FROM sensor_data
                 ORDER BY id DESC
-                LIMIT ? OFFSET ?
-            ''', (limit, offset))
+                LIMIT ?
+            ''', limit=offset + limit)
+            if len(rows) < offset + limit:
+                rows += self._newest_archived(offset + limit - len(rows))
+            rows = rows[offset:]
         else:
-            cursor.execute('''
+            rows = self._query_rows('''
                 SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
                 FROM sensor_data
                 ORDER BY id DESC
             ''')
-
-        rows = cursor.fetchall()
-        conn.close()
-
-        # 转换为字典格式
-        data = []
-        for row in rows:
-            data.append({
-                'id': row[0],
-                'humidity': row[1],
-                'temperature': row[2],
-                'light_intensity': row[3],
-                'servo_angle': row[4],
-                'timestamp': row[5],
-                'created_at': row[6],
-                'year': row[7],
-                'month': row[8],
-                'day': row[9],
-                'hour': row[10],
-                'date_key': row[11],
-                'datetime_key': row[12]
-            })
-
-        return data
+            rows = self._with_archived(rows)
+
+        return ReadingBatch(rows)
+
+    def _newest_archived(self, count):
+        """归档中最新的 count 行，按id降序（归档的id都小于热库）"""
+        rows = []
+        if self.archive:
+            for date_key in reversed(self.archive.date_keys()):
+                if len(rows) >= count:
+                    break
+                rows.extend(reversed(self.archive.read_segment(date_key)))
+        return rows[:count]
+
+    def _archived_after(self, after_id):
+        """归档中 id 大于 after_id 的行，按id升序"""
+        if not self.archive:
+            return []
+        rows = []
+        for date_key in self.archive.date_keys(after_id=after_id):
+            rows.extend(row for row in self.archive.read_segment(date_key) if row[0] > after_id)
+        return rows
+
+    def iter_all_data(self, chunk_size=1000):
+        """
+        按id升序分页读取全部数据，每页为 (id, humidity, temperature, light_intensity, servo_angle, timestamp) 行列表，用于流式响应
+        先输出归档（按天分段读取），再输出热库：每页是一次独立的短查询（id 大于上一页最后一个id），
+        输出期间不长时间持有读锁阻塞入库；只包含开始时已存在的数据
+        """
+        max_ids = [row[0] for row in self._query_rows('SELECT MAX(id) FROM sensor_data') if row[0] is not None]
+
+        if self.archive:
+            page = []
+            for date_key in self.archive.date_keys():
+                for row in self.archive.read_segment(date_key):
+                    page.append(row[:6])
+                    if len(page) >= chunk_size:
+                        yield page
+                        page = []
+            if page:
+                yield page
+
+        if not max_ids:
+            return
+        max_id = max(max_ids)
+
+        last_id = 0
+        while True:
+            rows = self._query_rows('''
+                SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp
+                FROM sensor_data
+                WHERE id > ? AND id <= ?
+                ORDER BY id ASC
+                LIMIT ?
+            ''', (last_id, max_id), limit=chunk_size, descending=False)
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
 
     def get_latest_data(self):
-        """获取最新的传感器数据"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
+        """获取最新的传感器数据（SensorReading），没有数据时返回None；热库为空时取归档中的最后一条"""
+        rows = self._query_rows('''
             SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
             FROM sensor_data
             ORDER BY id DESC
-            LIMIT 1
-        ''')
-
-        row = cursor.fetchone()
-        conn.close()
-
-        if row:
-            return {
-                'id': row[0],
-                'humidity': row[1],
-                'temperature': row[2],
-                'light_intensity': row[3],
-                'servo_angle': row[4],
-                'timestamp': row[5],
-                'created_at': row[6],
-                'year': row[7],
-                'month': row[8],
-                'day': row[9],
-                'hour': row[10],
-                'date_key': row[11],
-                'datetime_key': row[12]
-            }
-        return None
-
-    def get_data_count(self):
-        """获取数据总数"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('SELECT COUNT(*) FROM sensor_data')
-        count = cursor.fetchone()[0]
-        conn.close()
-
-        return count
+            LIMIT ?
+        ''', limit=1) or self._newest_archived(1)
+        return SensorReading(*rows[0]) if rows else None
+
+    def get_data_since(self, since_id, limit=None):
+        """获取 id 大于 since_id 的数据（按id升序，含归档），用于前端增量同步"""
+        archived = self._archived_after(since_id)
+        if limit and len(archived) >= limit:
+            return ReadingBatch(archived[:limit])
+        rows = self._query_rows(f'''
+            SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
+            FROM sensor_data
+            WHERE id > ?
+            ORDER BY id ASC
+            {'LIMIT ?' if limit else ''}
+        ''', (since_id,), limit=(limit - len(archived)) if limit else None, descending=False)
+
+        return ReadingBatch(archived + rows)
+
+    def get_data_count(self, max_id=None):
+        """
+        获取数据总数（含归档）
+        max_id: 只统计 id 不大于该值的记录；增量同步时用最后返回的id，统计结果不受查询之后新写入的数据影响
+        """
+        if max_id is None:
+            count = sum(row[0] for row in self._query_rows('SELECT COUNT(*) FROM sensor_data'))
+        else:
+            count = sum(row[0] for row in self._query_rows('SELECT COUNT(*) FROM sensor_data WHERE id <= ?',
+                                                           (max_id,)))
+        return count + (self.archive.count(max_id) if self.archive else 0)
 
     def get_data_by_date_range(self, start_date, end_date):
         """根据日期范围获取数据"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
+        rows = self._query_rows('''
             SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
             FROM sensor_data
             WHERE created_at BETWEEN ? AND ?
             ORDER BY id DESC
-        ''', (start_date, end_date))
-
-        rows = cursor.fetchall()
-        conn.close()
-
-        data = []
-        for row in rows:
-            data.append({
-                'id': row[0],
-                'humidity': row[1],
-                'temperature': row[2],
-                'light_intensity': row[3],
-                'servo_angle': row[4],
-                'timestamp': row[5],
-                'created_at': row[6],
-                'year': row[7],
-                'month': row[8],
-                'day': row[9],
-                'hour': row[10],
-                'date_key': row[11],
-                'datetime_key': row[12]
-            })
-
-        return data
+        ''', (start_date, end_date), months=self._months(start_date, end_date))
+        rows = self._with_archived(rows, start_date[:10], end_date[:10],
+                                   predicate=lambda row: start_date <= row[6] <= end_date)
+
+        return ReadingBatch(rows)
+
+    def _with_archived(self, rows, start_key=None, end_key=None, prefix=None, predicate=None):
+        """将归档中符合条件日期的行合并进热库查询结果，保持按id降序"""
+        if not self.archive:
+            return rows
+        date_keys = self.archive.date_keys(start_key, end_key, prefix)
+        if not date_keys:
+            return rows
+        archived = self.archive.query(date_keys, predicate)
+        if not archived:
+            return rows
+        return sorted(rows + archived, key=lambda row: row[0], reverse=True)
+
+    def get_numeric_series(self, start_date=None, end_date=None, after_id=None):
+        """
+        一次性批量读取时间范围内的数值列，用于向量化分析
+        返回按id升序的行: (id, epoch秒, humidity, temperature, light_intensity, servo_angle)
+        epoch由北京时间的created_at直接换算，仅用于计算时间差和回显时间
+        after_id: 只返回 id 大于该值的行（主键范围扫描，用于增量同步）
+        舵机角度列允许为空（旧数据），空值按默认值0返回，与列式导出一致
+        """
+        conditions = []
+        params = []
+        if start_date:
+            conditions.append('created_at >= ?')
+            params.append(start_date)
+        if end_date:
+            conditions.append('created_at <= ?')
+            params.append(end_date)
+        if after_id is not None:
+            conditions.append('id > ?')
+            params.append(after_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        rows = self._query_rows(f'''
+            SELECT id, CAST(strftime('%s', created_at) AS INTEGER), humidity, temperature, light_intensity,
+                   COALESCE(servo_angle, 0)
+            FROM sensor_data
+            {where}
+            ORDER BY id ASC
+        ''', params, months=self._months(start_date, end_date), descending=False)
+
+        if not self.archive:
+            return rows
+        # 归档的id都小于热库，按天读取后放在前面
+        archived = []
+        for date_key in self.archive.date_keys(start_date and start_date[:10], end_date and end_date[:10],
+                                               after_id=after_id):
+            archived.extend(
+                (row[0], created_at_epoch(row[6]) + BEIJING_UTC_OFFSET, row[1], row[2], row[3],
+                 row[4] if row[4] is not None else 0)
+                for row in self.archive.read_segment(date_key)
+                if (not start_date or row[6] >= start_date) and (not end_date or row[6] <= end_date)
+                and (after_id is None or row[0] > after_id)
+            )
+        return archived + rows if archived else rows
 
     def get_data_by_year(self, year):
         """根据年份获取数据"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
+        rows = self._query_rows('''
             SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
             FROM sensor_data
             WHERE year = ?
             ORDER BY id DESC
-        ''', (year,))
-
-        rows = cursor.fetchall()
-        conn.close()
-
-        data = []
-        for row in rows:
-            data.append({
-                'id': row[0],
-                'humidity': row[1],
-                'temperature': row[2],
-                'light_intensity': row[3],
-                'servo_angle': row[4],
-                'timestamp': row[5],
-                'created_at': row[6],
-                'year': row[7],
-                'month': row[8],
-                'day': row[9],
-                'hour': row[10],
-                'date_key': row[11],
-                'datetime_key': row[12]
-            })
+        ''', (year,), months=self._months(f"{int(year):04d}-01", f"{int(year):04d}-12"))
+        rows = self._with_archived(rows, prefix=f"{int(year):04d}-")
 
-        return data
+        return ReadingBatch(rows)
 
     def get_data_by_month(self, year, month):
         """根据年月获取数据"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
+        rows = self._query_rows('''
             SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
             FROM sensor_data
             WHERE year = ? AND month = ?
             ORDER BY id DESC
-        ''', (year, month))
-
-        rows = cursor.fetchall()
-        conn.close()
-
-        data = []
-        for row in rows:
-            data.append({
-                'id': row[0],
-                'humidity': row[1],
-                'temperature': row[2],
-                'light_intensity': row[3],
-                'servo_angle': row[4],
-                'timestamp': row[5],
-                'created_at': row[6],
-                'year': row[7],
-                'month': row[8],
-                'day': row[9],
-                'hour': row[10],
-                'date_key': row[11],
-                'datetime_key': row[12]
-            })
-
-        return data
-
-    def get_data_by_day(self, year, month, day):
-        """根据具体日期获取数据"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
+        ''', (year, month), months=[f"{int(year):04d}-{int(month):02d}"])
+        rows = self._with_archived(rows, prefix=f"{int(year):04d}-{int(month):02d}-")
+
+        return ReadingBatch(rows)
+
+    def _query_day_rows(self, date_key, hour=None):
+        """
+        按日历索引的id边界读取某天（或某小时）的热库数据，按id降序
+        +date_key/+datetime_key 阻止优化器改走日期索引，保证按主键范围扫描；分片模式下只访问当月分片
+        """
+        id_range = self.get_id_range(date_key, hour)
+        if id_range is None:
+            return []
+        if hour is None:
+            column, key = 'date_key', date_key
+        else:
+            column, key = 'datetime_key', f"{date_key}-{int(hour):02d}"
+        return self._query_rows(f'''
             SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
             FROM sensor_data
-            WHERE year = ? AND month = ? AND day = ?
+            WHERE id BETWEEN ? AND ?
+              AND +{column} = ?
             ORDER BY id DESC
-        ''', (year, month, day))
+        ''', (id_range[0], id_range[1], key), months=[month_of(date_key)])
 
-        rows = cursor.fetchall()
-        conn.close()
-
-        data = []
-        for row in rows:
-            data.append({
-                'id': row[0],
-                'humidity': row[1],
-                'temperature': row[2],
-                'light_intensity': row[3],
-                'servo_angle': row[4],
-                'timestamp': row[5],
-                'created_at': row[6],
-                'year': row[7],
-                'month': row[8],
-                'day': row[9],
-                'hour': row[10],
-                'date_key': row[11],
-                'datetime_key': row[12]
-            })
+    def get_data_by_day(self, year, month, day):
+        """根据具体日期获取数据（通过日历索引的id边界做主键范围扫描）"""
+        date_key = f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
+        rows = self._query_day_rows(date_key)
+        rows = self._with_archived(rows, date_key, date_key)
 
-        return data
+        return ReadingBatch(rows)
 
     def get_data_by_date_key(self, date_key):
-        """根据日期键获取数据 (格式: YYYY-MM-DD)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
-            FROM sensor_data
-            WHERE date_key = ?
-            ORDER BY id DESC
-        ''', (date_key,))
-
-        rows = cursor.fetchall()
-        conn.close()
-
-        data = []
-        for row in rows:
-            data.append({
-                'id': row[0],
-                'humidity': row[1],
-                'temperature': row[2],
-                'light_intensity': row[3],
-                'servo_angle': row[4],
-                'timestamp': row[5],
-                'created_at': row[6],
-                'year': row[7],
-                'month': row[8],
-                'day': row[9],
-                'hour': row[10],
-                'date_key': row[11],
-                'datetime_key': row[12]
-            })
+        """根据日期键获取数据 (格式: YYYY-MM-DD)，通过日历索引的id边界做主键范围扫描"""
+        rows = self._query_day_rows(date_key)
+        rows = self._with_archived(rows, date_key, date_key)
 
-        return data
+        return ReadingBatch(rows)
 
     def get_data_by_hour(self, year, month, day, hour):
-        """根据具体小时获取数据"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        """根据具体小时获取数据（通过日历索引的id边界做主键范围扫描）"""
+        date_key = f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
+        hour = int(hour)
+        rows = self._query_day_rows(date_key, hour)
+        rows = self._with_archived(rows, date_key, date_key, predicate=lambda row: row[10] == hour)
 
-        cursor.execute('''
-            SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
-            FROM sensor_data
-            WHERE year = ? AND month = ? AND day = ? AND hour = ?
-            ORDER BY id DESC
-        ''', (year, month, day, hour))
-
-        rows = cursor.fetchall()
-        conn.close()
-
-        data = []
-        for row in rows:
-            data.append({
-                'id': row[0],
-                'humidity': row[1],
-                'temperature': row[2],
-                'light_intensity': row[3],
-                'servo_angle': row[4],
-                'timestamp': row[5],
-                'created_at': row[6],
-                'year': row[7],
-                'month': row[8],
-                'day': row[9],
-                'hour': row[10],
-                'date_key': row[11],
-                'datetime_key': row[12]
-            })
-
-        return data
+        return ReadingBatch(rows)
 
     def get_data_by_datetime_key(self, datetime_key):
-        """根据日期时间键获取数据 (格式: YYYY-MM-DD-HH)"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
-            FROM sensor_data
-            WHERE datetime_key = ?
-            ORDER BY id DESC
-        ''', (datetime_key,))
+        """根据日期时间键获取数据 (格式: YYYY-MM-DD-HH)，通过日历索引的id边界做主键范围扫描"""
+        date_key, _, hour = datetime_key.rpartition('-')
+        hour = int(hour) if hour.isdigit() else -1
+        rows = self._query_day_rows(date_key, hour)
+        rows = self._with_archived(rows, date_key, date_key, predicate=lambda row: row[12] == datetime_key)
 
-        rows = cursor.fetchall()
-        conn.close()
-
-        data = []
-        for row in rows:
-            data.append({
-                'id': row[0],
-                'humidity': row[1],
-                'temperature': row[2],
-                'light_intensity': row[3],
-                'servo_angle': row[4],
-                'timestamp': row[5],
-                'created_at': row[6],
-                'year': row[7],
-                'month': row[8],
-                'day': row[9],
-                'hour': row[10],
-                'date_key': row[11],
-                'datetime_key': row[12]
-            })
-
-        return data
+        return ReadingBatch(rows)
 
     def get_available_dates(self):
         """获取有数据的所有日期"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         cursor.execute('''
-            SELECT DISTINCT date_key, year, month, day, COUNT(*) as count
-            FROM sensor_data
+            SELECT date_key, SUM(count) as count
+            FROM sensor_calendar
             GROUP BY date_key
             ORDER BY date_key DESC
         ''')
@@ -472,33 +658,31 @@ class SensorDatabase:
         for row in rows:
             dates.append({
                 'date_key': row[0],
-                'year': row[1],
-                'month': row[2],
-                'day': row[3],
-                'count': row[4]
+                'year': int(row[0][0:4]),
+                'month': int(row[0][5:7]),
+                'day': int(row[0][8:10]),
+                'count': row[1]
             })
 
         return dates
 
     def get_available_hours(self, date_key=None):
         """获取有数据的所有小时"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         if date_key:
             cursor.execute('''
-                SELECT DISTINCT datetime_key, year, month, day, hour, COUNT(*) as count
-                FROM sensor_data
+                SELECT date_key, hour, count
+                FROM sensor_calendar
                 WHERE date_key = ?
-                GROUP BY datetime_key
-                ORDER BY datetime_key DESC
+                ORDER BY date_key DESC, hour DESC
             ''', (date_key,))
         else:
             cursor.execute('''
-                SELECT DISTINCT datetime_key, year, month, day, hour, COUNT(*) as count
-                FROM sensor_data
-                GROUP BY datetime_key
-                ORDER BY datetime_key DESC
+                SELECT date_key, hour, count
+                FROM sensor_calendar
+                ORDER BY date_key DESC, hour DESC
             ''')
 
         rows = cursor.fetchall()
@@ -507,40 +691,268 @@ class SensorDatabase:
         hours = []
         for row in rows:
             hours.append({
-                'datetime_key': row[0],
-                'year': row[1],
-                'month': row[2],
-                'day': row[3],
-                'hour': row[4],
-                'count': row[5]
+                'datetime_key': f"{row[0]}-{row[1]:02d}",
+                'year': int(row[0][0:4]),
+                'month': int(row[0][5:7]),
+                'day': int(row[0][8:10]),
+                'hour': row[1],
+                'count': row[2]
             })
 
         return hours
 
+    def _update_running_stats(self, cursor, readings):
+        """
+        将一批读数累加进统计行（调用方负责提交事务），统计行为dirty时跳过
+        与重算时的 SQL SUM/MIN/MAX 一致，跳过空值（旧数据的舵机角度可能为NULL）
+        """
+        stats = {}
+        for metric in SKETCH_METRICS:
+            values = [r[metric] for r in readings if r[metric] is not None]
+            stats[metric] = (sum(values), min(values), max(values)) if values else (0, None, None)
+        created = [r['created_at'] for r in readings]
+        self._fold_running_stats(cursor, len(readings), stats, min(created), max(created))
+
+    def _fold_running_stats(self, cursor, count, stats, first_record, last_record):
+        """
+        将一组聚合值合并进统计行
+        stats: {指标: (sum, min, max)}
+        """
+        params = [count]
+        for metric in SKETCH_METRICS:
+            total, low, high = stats[metric]
+            params.extend([total, low, low, high, high])
+        params.extend([first_record, first_record, last_record, last_record])
+
+        cursor.execute('''
+            UPDATE sensor_stats SET
+                total_count = total_count + ?,
+                sum_humidity = sum_humidity + ?,
+                min_humidity = CASE WHEN min_humidity IS NULL OR ? < min_humidity THEN ? ELSE min_humidity END,
+                max_humidity = CASE WHEN max_humidity IS NULL OR ? > max_humidity THEN ? ELSE max_humidity END,
+                sum_temperature = sum_temperature + ?,
+                min_temperature = CASE WHEN min_temperature IS NULL OR ? < min_temperature THEN ? ELSE min_temperature END,
+                max_temperature = CASE WHEN max_temperature IS NULL OR ? > max_temperature THEN ? ELSE max_temperature END,
+                sum_light = sum_light + ?,
+                min_light = CASE WHEN min_light IS NULL OR ? < min_light THEN ? ELSE min_light END,
+                max_light = CASE WHEN max_light IS NULL OR ? > max_light THEN ? ELSE max_light END,
+                sum_servo = sum_servo + ?,
+                min_servo = CASE WHEN min_servo IS NULL OR ? < min_servo THEN ? ELSE min_servo END,
+                max_servo = CASE WHEN max_servo IS NULL OR ? > max_servo THEN ? ELSE max_servo END,
+                first_record = CASE WHEN first_record IS NULL OR ? < first_record THEN ? ELSE first_record END,
+                last_record = CASE WHEN last_record IS NULL OR ? > last_record THEN ? ELSE last_record END
+            WHERE id = 1 AND dirty = 0
+        ''', params)
+
+    def _recompute_running_stats(self, cursor):
+        """全表扫描重算统计行（调用方负责提交事务）"""
+        if self.shards:
+            self._recompute_sharded_stats(cursor)
+        else:
+            self._recompute_table_stats(cursor)
+
+        # 统计覆盖完整历史：合并归档中的数据
+        summary = self.archive.summary() if self.archive else None
+        if summary:
+            stats = {metric: (s['sum'], s['min'], s['max']) for metric, s in summary['stats'].items()}
+            self._fold_running_stats(cursor, summary['count'], stats,
+                                     summary['first_record'], summary['last_record'])
+
+    def _recompute_sharded_stats(self, cursor):
+        """分片模式：清空统计行后逐个合并各分片的聚合值"""
+        cursor.execute('''
+            UPDATE sensor_stats SET
+                total_count = 0,
+                sum_humidity = 0, min_humidity = NULL, max_humidity = NULL,
+                sum_temperature = 0, min_temperature = NULL, max_temperature = NULL,
+                sum_light = 0, min_light = NULL, max_light = NULL,
+                sum_servo = 0, min_servo = NULL, max_servo = NULL,
+                first_record = NULL, last_record = NULL, dirty = 0
+            WHERE id = 1
+        ''')
+        for row in self.shards.query('''
+            SELECT
+                COUNT(*), SUM(humidity), MIN(humidity), MAX(humidity),
+                SUM(temperature), MIN(temperature), MAX(temperature),
+                SUM(light_intensity), MIN(light_intensity), MAX(light_intensity),
+                SUM(servo_angle), MIN(servo_angle), MAX(servo_angle),
+                MIN(created_at), MAX(created_at)
+            FROM sensor_data
+        ''', read_only=self.read_only):
+            if row[0]:
+                stats = {metric: tuple(row[1 + i * 3:4 + i * 3]) for i, metric in enumerate(SKETCH_METRICS)}
+                self._fold_running_stats(cursor, row[0], stats, row[13], row[14])
+
+    def _recompute_table_stats(self, cursor):
+        cursor.execute('''
+            UPDATE sensor_stats SET
+                (total_count, sum_humidity, min_humidity, max_humidity,
+                 sum_temperature, min_temperature, max_temperature,
+                 sum_light, min_light, max_light,
+                 sum_servo, min_servo, max_servo,
+                 first_record, last_record, dirty) = (
+                SELECT
+                    COUNT(*), COALESCE(SUM(humidity), 0), MIN(humidity), MAX(humidity),
+                    COALESCE(SUM(temperature), 0), MIN(temperature), MAX(temperature),
+                    COALESCE(SUM(light_intensity), 0), MIN(light_intensity), MAX(light_intensity),
+                    COALESCE(SUM(servo_angle), 0), MIN(servo_angle), MAX(servo_angle),
+                    MIN(created_at), MAX(created_at), 0
+                FROM sensor_data
+            )
+            WHERE id = 1
+        ''')
+
+    def get_id_range(self, date_key, hour=None):
+        """从日历索引读取某天（或某小时）的 (first_id, last_id, count)，无数据返回None"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        if hour is None:
+            cursor.execute('''
+                SELECT MIN(first_id), MAX(last_id), SUM(count)
+                FROM sensor_calendar WHERE date_key = ?
+            ''', (date_key,))
+        else:
+            cursor.execute('''
+                SELECT first_id, last_id, count
+                FROM sensor_calendar WHERE date_key = ? AND hour = ?
+            ''', (date_key, hour))
+
+        row = cursor.fetchone()
+        conn.close()
+
+        if row and row[0] is not None:
+            return row
+        return None
+
+    def _update_calendar(self, cursor, readings):
+        """将一批读数upsert进日历索引（调用方负责提交事务）"""
+        buckets = {}
+        for reading in readings:
+            key = (reading['date_key'], reading['hour'])
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, reading['id'], reading['id']]
+            else:
+                bucket[0] += 1
+                bucket[1] = min(bucket[1], reading['id'])
+                bucket[2] = max(bucket[2], reading['id'])
+
+        cursor.executemany('''
+            INSERT INTO sensor_calendar (date_key, hour, count, first_id, last_id)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (date_key, hour) DO UPDATE SET
+                count = count + excluded.count,
+                first_id = MIN(first_id, excluded.first_id),
+                last_id = MAX(last_id, excluded.last_id)
+        ''', [(date_key, hour, *bucket) for (date_key, hour), bucket in buckets.items()])
+
+    def _rebuild_calendar(self, cursor, date_keys=None):
+        """根据sensor_data和归档重建指定日期（默认全部）的日历索引"""
+        if self.shards:
+            # 分片模式：在相关分片上分组统计后写入主库
+            if date_keys is None:
+                cursor.execute('DELETE FROM sensor_calendar')
+                rows = self.shards.query('''
+                    SELECT date_key, hour, COUNT(*), MIN(id), MAX(id)
+                    FROM sensor_data
+                    GROUP BY date_key, hour
+                ''', read_only=self.read_only)
+            else:
+                placeholders = ','.join('?' * len(date_keys))
+                cursor.execute(f'DELETE FROM sensor_calendar WHERE date_key IN ({placeholders})', date_keys)
+                rows = self.shards.query(f'''
+                    SELECT date_key, hour, COUNT(*), MIN(id), MAX(id)
+                    FROM sensor_data
+                    WHERE date_key IN ({placeholders})
+                    GROUP BY date_key, hour
+                ''', date_keys, months={month_of(k) for k in date_keys}, read_only=self.read_only)
+            cursor.executemany('''
+                INSERT INTO sensor_calendar (date_key, hour, count, first_id, last_id)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            self._fold_archived_calendar(cursor, date_keys)
+            return
+
+        if date_keys is None:
+            cursor.execute('DELETE FROM sensor_calendar')
+            cursor.execute('''
+                INSERT INTO sensor_calendar (date_key, hour, count, first_id, last_id)
+                SELECT date_key, hour, COUNT(*), MIN(id), MAX(id)
+                FROM sensor_data
+                GROUP BY date_key, hour
+            ''')
+        else:
+            placeholders = ','.join('?' * len(date_keys))
+            cursor.execute(f'DELETE FROM sensor_calendar WHERE date_key IN ({placeholders})', date_keys)
+            cursor.execute(f'''
+                INSERT INTO sensor_calendar (date_key, hour, count, first_id, last_id)
+                SELECT date_key, hour, COUNT(*), MIN(id), MAX(id)
+                FROM sensor_data
+                WHERE date_key IN ({placeholders})
+                GROUP BY date_key, hour
+            ''', date_keys)
+        self._fold_archived_calendar(cursor, date_keys)
+
+    def _archived_rows(self, date_keys=None):
+        """归档中指定日期（默认全部）的行，按id升序"""
+        if not self.archive:
+            return []
+        archived = set(self.archive.date_keys())
+        rows = []
+        for date_key in sorted(archived if date_keys is None else archived.intersection(date_keys)):
+            rows.extend(self.archive.read_segment(date_key))
+        return rows
+
+    def _fold_archived_calendar(self, cursor, date_keys=None):
+        """重建日历时把归档中这些日期的数据也计入"""
+        calendar = {}
+        for row in self._archived_rows(date_keys):
+            key = (row[11], row[10])
+            count, first_id, last_id = calendar.get(key, (0, row[0], row[0]))
+            calendar[key] = (count + 1, min(first_id, row[0]), max(last_id, row[0]))
+        cursor.executemany('''
+            INSERT INTO sensor_calendar (date_key, hour, count, first_id, last_id)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (date_key, hour) DO UPDATE SET
+                count = count + excluded.count,
+                first_id = MIN(first_id, excluded.first_id),
+                last_id = MAX(last_id, excluded.last_id)
+        ''', [(date_key, hour, *values) for (date_key, hour), values in calendar.items()])
+
     def get_statistics(self):
-        """获取数据统计信息"""
-        conn = sqlite3.connect(self.db_path)
+        """获取数据统计信息（读取累计统计行，常数时间；删除数据后首次读取时重算）"""
+        conn = self._connect()
         cursor = conn.cursor()
 
+        cursor.execute('SELECT dirty FROM sensor_stats WHERE id = 1')
+        if cursor.fetchone()[0]:
+            if self.read_only:
+                # 只读连接不能更新统计行：在同名临时表上重算（未限定库名时临时表优先），结果不写回
+                cursor.execute('CREATE TEMP TABLE sensor_stats AS SELECT * FROM main.sensor_stats')
+            self._recompute_running_stats(cursor)
+            conn.commit()
+
         # 获取基本统计
         cursor.execute('''
             SELECT
-                COUNT(*) as total_count,
-                AVG(humidity) as avg_humidity,
-                MIN(humidity) as min_humidity,
-                MAX(humidity) as max_humidity,
-                AVG(temperature) as avg_temperature,
-                MIN(temperature) as min_temperature,
-                MAX(temperature) as max_temperature,
-                AVG(light_intensity) as avg_light,
-                MIN(light_intensity) as min_light,
-                MAX(light_intensity) as max_light,
-                AVG(servo_angle) as avg_servo,
-                MIN(servo_angle) as min_servo,
-                MAX(servo_angle) as max_servo,
-                MIN(created_at) as first_record,
-                MAX(created_at) as last_record
-            FROM sensor_data
+                total_count,
+                sum_humidity / total_count,
+                min_humidity,
+                max_humidity,
+                sum_temperature / total_count,
+                min_temperature,
+                max_temperature,
+                sum_light / total_count,
+                min_light,
+                max_light,
+                sum_servo / total_count,
+                min_servo,
+                max_servo,
+                first_record,
+                last_record
+            FROM sensor_stats
+            WHERE id = 1
         ''')
 
         row = cursor.fetchone()
@@ -584,6 +996,343 @@ class SensorDatabase:
                 'time_range': {'first_record': None, 'last_record': None}
             }
 
+    def _update_sketches(self, cursor, readings):
+        """
+        将一批读数合并进对应日期的草图（调用方负责提交事务）
+        必须在写入sensor_data之后调用，此时已持有写锁，读-改-写不会与其他进程交错
+        空值（旧数据的舵机角度可能为NULL）不计入草图，与SQL聚合函数一致
+        """
+        by_date = {}
+        for reading in readings:
+            by_date.setdefault(reading['date_key'], []).append(reading)
+
+        for date_key, day_readings in by_date.items():
+            cursor.execute('SELECT metric, sketch FROM sensor_sketches WHERE date_key = ?', (date_key,))
+            sketches = dict(cursor.fetchall())
+            updates = []
+            for metric in SKETCH_METRICS:
+                values = [r[metric] for r in day_readings if r[metric] is not None]
+                if values:
+                    updates.append((date_key, metric, append_values(sketches.get(metric), values)))
+            cursor.executemany('''
+                INSERT OR REPLACE INTO sensor_sketches (date_key, metric, sketch)
+                VALUES (?, ?, ?)
+            ''', updates)
+
+    def _rebuild_sketches(self, cursor, date_keys=None):
+        """根据sensor_data和归档重建指定日期（默认全部）的草图，跳过空值"""
+        if date_keys is None:
+            cursor.execute('DELETE FROM sensor_sketches')
+            sql, params, months = 'SELECT date_key, humidity, temperature, light_intensity, servo_angle FROM sensor_data ORDER BY id', (), None
+        else:
+            placeholders = ','.join('?' * len(date_keys))
+            cursor.execute(f'DELETE FROM sensor_sketches WHERE date_key IN ({placeholders})', date_keys)
+            sql = f'''
+                SELECT date_key, humidity, temperature, light_intensity, servo_angle
+                FROM sensor_data WHERE date_key IN ({placeholders}) ORDER BY id
+            '''
+            params, months = date_keys, {month_of(k) for k in date_keys}
+
+        if self.shards:
+            rows = self.shards.query(sql, params, months, descending=False, read_only=self.read_only)
+        else:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        # 归档中的数据更早，先于热库数据加入
+        archived = [(row[11], row[1], row[2], row[3], row[4]) for row in self._archived_rows(date_keys)]
+
+        digests = {}
+        for row in archived + list(rows):
+            for metric, value in zip(SKETCH_METRICS, row[1:]):
+                if value is not None:
+                    digests.setdefault((row[0], metric), TDigest()).add(value)
+
+        cursor.executemany('''
+            INSERT OR REPLACE INTO sensor_sketches (date_key, metric, sketch)
+            VALUES (?, ?, ?)
+        ''', [(date_key, metric, digest.to_bytes()) for (date_key, metric), digest in digests.items()])
+
+    def get_percentiles(self, start_date=None, end_date=None, quantiles=(0.5, 0.9, 0.99)):
+        """
+        合并日期范围内（含两端，格式YYYY-MM-DD）每天的草图，返回各指标的分位数
+        代价只与天数有关，与数据行数无关
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        conditions = []
+        params = []
+        if start_date:
+            conditions.append('date_key >= ?')
+            params.append(start_date)
+        if end_date:
+            conditions.append('date_key <= ?')
+            params.append(end_date)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        cursor.execute(f'SELECT date_key, metric, sketch FROM sensor_sketches {where}', params)
+        rows = cursor.fetchall()
+        conn.close()
+
+        merged = {metric: TDigest() for metric in SKETCH_METRICS}
+        days = set()
+        for date_key, metric, sketch in rows:
+            if metric in merged:
+                merged[metric].merge(TDigest.from_bytes(sketch))
+                days.add(date_key)
+
+        return {
+            'days': len(days),
+            'metrics': {metric: summarize(digest, quantiles) for metric, digest in merged.items()}
+        }
+
+    def _update_gaps(self, cursor, readings):
+        """
+        按id顺序检查一批读数与上一条读数的间隔，超过阈值的记入断线索引，并更新最后一条读数（调用方负责提交事务）
+        必须在写入sensor_data之后调用，此时已持有写锁
+        """
+        cursor.execute('SELECT last_id, last_seen FROM sensor_liveness WHERE id = 1')
+        last_id, last_seen = cursor.fetchone() or (None, None)
+        last_epoch = created_at_epoch(last_seen) if last_seen else None
+
+        gaps = []
+        for reading in sorted(readings, key=lambda r: r['id']):
+            # 同一批读数的 created_at 相同，只在变化时换算
+            if reading['created_at'] != last_seen:
+                epoch = created_at_epoch(reading['created_at'])
+                if last_epoch is not None and epoch - last_epoch > self.gap_threshold:
+                    gaps.append((last_id, reading['id'], last_seen, reading['created_at'], epoch - last_epoch))
+                last_seen, last_epoch = reading['created_at'], epoch
+            last_id = reading['id']
+
+        if gaps:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO sensor_gaps (start_id, end_id, start_at, end_at, seconds)
+                VALUES (?, ?, ?, ?, ?)
+            ''', gaps)
+        cursor.execute('UPDATE sensor_liveness SET last_id = ?, last_seen = ? WHERE id = 1', (last_id, last_seen))
+
+    def _ensure_gap_index(self):
+        """断线索引尚未建立（刚迁移）或阈值配置有变化时，按全部数据（含归档）重建"""
+        conn = sqlite3.connect(self.db_path)
+        row = conn.execute('SELECT gap_threshold FROM sensor_liveness WHERE id = 1').fetchone()
+        conn.close()
+        if row is None or row[0] != self.gap_threshold:
+            self._rebuild_gaps()
+
+    def _rebuild_gaps(self):
+        """按id顺序扫描全部数据重新计算断线索引，返回断线次数"""
+        gaps = []
+        last_id = last_epoch = None
+        for rows in self.iter_numeric_chunks():
+            for row in rows:
+                data_id, epoch = row[0], row[1]
+                if last_epoch is not None and epoch - last_epoch > self.gap_threshold:
+                    gaps.append((last_id, data_id, epoch_created_at(last_epoch), epoch_created_at(epoch),
+                                 epoch - last_epoch))
+                last_id, last_epoch = data_id, epoch
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM sensor_gaps')
+        cursor.executemany('''
+            INSERT INTO sensor_gaps (start_id, end_id, start_at, end_at, seconds)
+            VALUES (?, ?, ?, ?, ?)
+        ''', gaps)
+        cursor.execute('''
+            UPDATE sensor_liveness SET last_id = ?, last_seen = ?, gap_threshold = ? WHERE id = 1
+        ''', (last_id, epoch_created_at(last_epoch) if last_epoch is not None else None, self.gap_threshold))
+        conn.commit()
+        conn.close()
+        return len(gaps)
+
+    def get_gaps(self, start=None, end=None, min_seconds=None, limit=None):
+        """
+        与时间范围重叠的断线记录（最近的在前），只读取断线索引
+        start/end: 北京时间 YYYY-MM-DD HH:MM:SS；min_seconds: 只返回不短于该秒数的断线
+        """
+        conditions, params = [], []
+        if start:
+            conditions.append('end_at > ?')
+            params.append(start)
+        if end:
+            conditions.append('start_at < ?')
+            params.append(end)
+        if min_seconds:
+            conditions.append('seconds >= ?')
+            params.append(min_seconds)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        limit_clause = 'LIMIT ?' if limit else ''
+        if limit:
+            params.append(limit)
+
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT start_id, end_id, start_at, end_at, seconds
+            FROM sensor_gaps
+            {where}
+            ORDER BY start_id DESC
+            {limit_clause}
+        ''', params)
+        rows = cursor.fetchall()
+        conn.close()
+
+        return [{
+            'start_id': row[0],
+            'end_id': row[1],
+            'start_at': row[2],
+            'end_at': row[3],
+            'seconds': row[4]
+        } for row in rows]
+
+    def get_liveness(self, now=None):
+        """
+        设备在线状态：最后一条读数及距今秒数，超过断线阈值视为离线
+        now: UTC秒，默认当前时间
+        """
+        conn = self._connect()
+        row = conn.execute('SELECT last_id, last_seen FROM sensor_liveness WHERE id = 1').fetchone()
+        conn.close()
+        last_id, last_seen = row or (None, None)
+
+        now = time.time() if now is None else now
+        seconds_since = int(now - created_at_epoch(last_seen)) if last_seen else None
+        return {
+            'online': seconds_since is not None and seconds_since <= self.gap_threshold,
+            'last_id': last_id,
+            'last_seen': last_seen,
+            'seconds_since_last': seconds_since,
+            'gap_threshold': self.gap_threshold,
+            'now': epoch_created_at(int(now))
+        }
+
+    def get_uptime(self, start, end, now=None):
+        """
+        时间范围内的在线率：范围长度减去与之重叠的断线时长（当前离线时包含进行中的断线）
+        第一条读数之前的时间不计为断线
+        start/end: 北京时间 YYYY-MM-DD HH:MM:SS
+        """
+        start_epoch, end_epoch = created_at_epoch(start), created_at_epoch(end)
+        liveness = self.get_liveness(now)
+        intervals = [(created_at_epoch(gap['start_at']), created_at_epoch(gap['end_at']))
+                     for gap in self.get_gaps(start, end)]
+        if not liveness['online'] and liveness['last_seen']:
+            intervals.append((created_at_epoch(liveness['last_seen']), created_at_epoch(liveness['now'])))
+
+        overlaps = [min(high, end_epoch) - max(low, start_epoch) for low, high in intervals]
+        overlaps = [seconds for seconds in overlaps if seconds > 0]
+        downtime = sum(overlaps)
+        span = max(0, end_epoch - start_epoch)
+        return {
+            'start': start,
+            'end': end,
+            'span_seconds': span,
+            'downtime_seconds': downtime,
+            'uptime_ratio': round(1 - downtime / span, 6) if span else None,
+            'gap_count': len(overlaps)
+        }
+
+    def archive_closed_months(self, vacuum=True):
+        """
+        将已结束月份（北京时间）的数据按天移入归档，热库只保留当月数据
+        每天在一个写事务内完成：读取 → 写入待发布分段 → 删除，提交后再发布分段，查询不会同时读到两份；
+        中断后重新执行即可继续
+        统计、日历和分位数草图仍覆盖归档数据，不需要调整
+        """
+        if not self.archive:
+            raise ValueError('Archive directory is not configured')
+
+        self._recover_pending_segments()
+        beijing_tz = pytz.timezone('Asia/Shanghai')
+        month_start = datetime.now(beijing_tz).strftime('%Y-%m-01')
+        if self.shards:
+            return self._archive_closed_shards(month_of(month_start))
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT DISTINCT date_key FROM sensor_data
+            WHERE date_key < ?
+            ORDER BY date_key
+        ''', (month_start,))
+        date_keys = [row[0] for row in cursor.fetchall()]
+
+        archived_rows = 0
+        for date_key in date_keys:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
+                FROM sensor_data
+                WHERE date_key = ?
+                ORDER BY id ASC
+            ''', (date_key,))
+            rows = cursor.fetchall()
+            if rows:
+                self.archive.stage_segment(date_key, rows)
+                cursor.execute('DELETE FROM sensor_data WHERE date_key = ? AND id BETWEEN ? AND ?',
+                               (date_key, rows[0][0], rows[-1][0]))
+                archived_rows += len(rows)
+            conn.commit()
+            if rows:
+                self.archive.publish([date_key])
+
+        conn.close()
+
+        if vacuum and archived_rows:
+            # 回收删除后的空闲页，缩小热库文件
+            conn = sqlite3.connect(self.db_path, isolation_level=None)
+            conn.execute('VACUUM')
+            conn.close()
+
+        return {
+            'archived_days': len(date_keys),
+            'archived_rows': archived_rows
+        }
+
+    def _recover_pending_segments(self):
+        """
+        上次归档在删除提交和发布分段之间中断时：热库中已没有这些行的分段补发布，
+        删除没有提交（行仍在热库中）的分段丢弃，稍后重新归档
+        """
+        for date_key, entry in self.archive.pending().items():
+            remaining = sum(row[0] for row in self._query_rows('''
+                SELECT COUNT(*) FROM sensor_data WHERE date_key = ? AND id BETWEEN ? AND ?
+            ''', (date_key, entry['first_id'], entry['last_id']), months=[month_of(date_key)]))
+            if remaining:
+                self.archive.discard(date_key)
+            else:
+                self.archive.publish([date_key])
+
+    def _archive_closed_shards(self, current_month):
+        """分片模式：已结束月份的分片按天写入归档后删除整个分片文件（归档写入可重复，中断后重新执行即可）"""
+        archived_days = 0
+        archived_rows = 0
+        for month in self.shards.months():
+            if month >= current_month:
+                continue
+            rows = self.shards.query('''
+                SELECT id, humidity, temperature, light_intensity, servo_angle, timestamp, created_at, year, month, day, hour, date_key, datetime_key
+                FROM sensor_data
+                ORDER BY id ASC
+            ''', months=[month], descending=False)
+            by_date = {}
+            for row in rows:
+                by_date.setdefault(row[11], []).append(row)
+            for date_key in sorted(by_date):
+                self.archive.stage_segment(date_key, by_date[date_key])
+            self.shards.drop(month)
+            self.archive.publish(sorted(by_date))
+            archived_days += len(by_date)
+            archived_rows += len(rows)
+
+        return {
+            'archived_days': archived_days,
+            'archived_rows': archived_rows
+        }
+
     def delete_old_data(self, days_to_keep=30):
         """删除指定天数之前的旧数据"""
         conn = sqlite3.connect(self.db_path)
@@ -592,12 +1341,46 @@ class SensorDatabase:
         cutoff_date = datetime.now() - timedelta(days=days_to_keep)
         cutoff_str = cutoff_date.strftime('%Y-%m-%d %H:%M:%S')
 
-        cursor.execute('DELETE FROM sensor_data WHERE created_at < ?', (cutoff_str,))
-        deleted_count = cursor.rowcount
+        if self.shards:
+            # 整月早于截止日期的分片直接删除文件，只有截止日所在月份的分片需要逐行删除
+            cutoff_month = month_of(cutoff_str)
+            deleted_count = 0
+            for month in self.shards.months():
+                if month < cutoff_month:
+                    deleted_count += self.shards.drop(month)
+                elif month == cutoff_month:
+                    shard = self.shards.connect(month)
+                    deleted_count += shard.execute('DELETE FROM sensor_data WHERE created_at < ?', (cutoff_str,)).rowcount
+                    shard.commit()
+                    shard.close()
+        else:
+            cursor.execute('DELETE FROM sensor_data WHERE created_at < ?', (cutoff_str,))
+            deleted_count = cursor.rowcount
+
+        # 归档中早于截止日期的整天分段直接删除，截止日当天的分段只保留截止时间之后的行
+        cutoff_date_key = cutoff_str[:10]
+        if self.archive:
+            old_keys = [k for k in self.archive.date_keys(end_key=cutoff_date_key) if k < cutoff_date_key]
+            deleted_count += self.archive.drop_segments(old_keys)
+            if self.archive.has_date(cutoff_date_key):
+                deleted_count += self.archive.trim_segment(cutoff_date_key, cutoff_str)
+
+        # 整天被删除的草图和日历直接丢弃，截止日当天按剩余数据（含归档）重建
+        cursor.execute('DELETE FROM sensor_sketches WHERE date_key < ?', (cutoff_date_key,))
+        self._rebuild_sketches(cursor, [cutoff_date_key])
+        cursor.execute('DELETE FROM sensor_calendar WHERE date_key < ?', (cutoff_date_key,))
+        self._rebuild_calendar(cursor, [cutoff_date_key])
+        # 断线索引只保留结束于截止时间之后的记录
+        cursor.execute('DELETE FROM sensor_gaps WHERE end_at < ?', (cutoff_str,))
+        if deleted_count:
+            cursor.execute('UPDATE sensor_stats SET dirty = 1 WHERE id = 1')
 
         conn.commit()
         conn.close()
 
+        if deleted_count:
+            self._notify('delete')
+
         return deleted_count
 
     def clear_all_data(self):
@@ -607,12 +1390,159 @@ class SensorDatabase:
 
         cursor.execute('DELETE FROM sensor_data')
         deleted_count = cursor.rowcount
+        if self.shards:
+            deleted_count += sum(self.shards.drop(month) for month in self.shards.months())
+        cursor.execute('DELETE FROM sensor_sketches')
+        cursor.execute('DELETE FROM sensor_calendar')
+        cursor.execute('DELETE FROM sensor_stats')
+        cursor.execute('INSERT INTO sensor_stats (id, dirty) VALUES (1, 0)')
+        cursor.execute('DELETE FROM ingest_keys')
+        cursor.execute('DELETE FROM sensor_gaps')
+        cursor.execute('UPDATE sensor_liveness SET last_id = NULL, last_seen = NULL WHERE id = 1')
 
         conn.commit()
         conn.close()
 
+        if self.archive:
+            deleted_count += self.archive.drop_segments()
+
+        with self.ingest_key_lock:
+            self.recent_ingest_keys.clear()
+
+        self._notify('clear')
+
         return deleted_count
 
+    def record_command_queued(self, command, source=None, queued_at=None):
+        """记录新下发的指令，返回指令id；只保留最近 COMMAND_HISTORY_LIMIT 条"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            INSERT INTO command_history (command, source, status, queued_at)
+            VALUES (?, ?, 'queued', ?)
+        ''', (command, source, queued_at or time.time()))
+        command_id = cursor.lastrowid
+        cursor.execute('DELETE FROM command_history WHERE id <= ?', (command_id - COMMAND_HISTORY_LIMIT,))
+
+        conn.commit()
+        conn.close()
+
+        return command_id
+
+    def mark_command_superseded(self, command_id):
+        """尚未送达就被新指令覆盖（包括取走后没能送达、放回队列时已有新指令的）"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE command_history SET status = 'superseded'
+            WHERE id = ? AND status IN ('queued', 'fetched')
+        ''', (command_id,))
+        conn.commit()
+        conn.close()
+
+    def mark_command_fetched(self, command_id, fetched_at=None):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE command_history SET status = 'fetched', fetched_at = ?
+            WHERE id = ? AND status = 'queued'
+        ''', (fetched_at or time.time(), command_id))
+        conn.commit()
+        conn.close()
+
+    def mark_command_acked(self, command_id, result=None, acked_at=None):
+        """设备确认指令已执行，返回更新后的记录；id不存在时返回None"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE command_history SET status = 'acked', acked_at = ?, result = ?
+            WHERE id = ? AND status IN ('queued', 'fetched')
+        ''', (acked_at or time.time(), result, command_id))
+        conn.commit()
+        conn.close()
+
+        history = self.get_command_history(command_id=command_id)
+        return history[0] if history else None
+
+    def get_command_history(self, limit=50, command_id=None):
+        """最近的指令记录（按id降序），包含各阶段延迟"""
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        if command_id is not None:
+            cursor.execute('''
+                SELECT id, command, source, status, queued_at, fetched_at, acked_at, result
+                FROM command_history WHERE id = ?
+            ''', (command_id,))
+        else:
+            cursor.execute('''
+                SELECT id, command, source, status, queued_at, fetched_at, acked_at, result
+                FROM command_history ORDER BY id DESC LIMIT ?
+            ''', (limit,))
+
+        rows = cursor.fetchall()
+        conn.close()
+
+        history = []
+        for row in rows:
+            queued_at, fetched_at, acked_at = row[4], row[5], row[6]
+            history.append({
+                'id': row[0],
+                'command': row[1],
+                'source': row[2],
+                'status': row[3],
+                'queued_at': datetime.fromtimestamp(queued_at, pytz.timezone('Asia/Shanghai')).isoformat(),
+                'delivery_seconds': round(fetched_at - queued_at, 3) if fetched_at else None,
+                'execution_seconds': round(acked_at - fetched_at, 3) if acked_at and fetched_at else None,
+                'total_seconds': round(acked_at - queued_at, 3) if acked_at else None,
+                'result': row[7]
+            })
+
+        return history
+
+    def get_command_latency(self, quantiles=(0.5, 0.9, 0.99), limit=1000):
+        """
+        最近 limit 条指令的延迟分位数（秒）
+        delivery: 下发 → 设备取走；execution: 取走 → 确认；total: 下发 → 确认
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT status, queued_at, fetched_at, acked_at
+            FROM command_history ORDER BY id DESC LIMIT ?
+        ''', (limit,))
+        rows = cursor.fetchall()
+        conn.close()
+
+        durations = {'delivery': [], 'execution': [], 'total': []}
+        statuses = {}
+        for status, queued_at, fetched_at, acked_at in rows:
+            statuses[status] = statuses.get(status, 0) + 1
+            if fetched_at:
+                durations['delivery'].append(fetched_at - queued_at)
+            if acked_at and fetched_at:
+                durations['execution'].append(acked_at - fetched_at)
+            if acked_at:
+                durations['total'].append(acked_at - queued_at)
+
+        latency = {}
+        for name, values in durations.items():
+            values.sort()
+            summary = {'count': len(values), 'max': round(values[-1], 3) if values else None}
+            for q in quantiles:
+                key = f"p{q * 100:g}".replace('.', '_')
+                # 最近秩法
+                summary[key] = round(values[max(0, math.ceil(q * len(values)) - 1)], 3) if values else None
+            latency[name] = summary
+
+        return {
+            'commands': len(rows),
+            'statuses': statuses,
+            'latency': latency
+        }
+
     def export_to_json(self, file_path=None):
         """导出数据到JSON文件"""
         if not file_path:
@@ -621,10 +1551,37 @@ class SensorDatabase:
         data = self.get_all_data()
 
         with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+            json.dump(data.to_dicts(), f, ensure_ascii=False, indent=2)
 
         return file_path, len(data)
 
+    def iter_numeric_chunks(self, chunk_size=5000):
+        """
+        按id升序分批读取全部数据的数值列（先归档后热库），用于列式导出
+        每行为 (id, epoch, humidity, temperature, light_intensity, servo_angle)，epoch 为UTC秒（created_at为北京时间）
+        舵机角度列允许为空（旧数据），空值按默认值0导出
+        """
+        if self.archive:
+            for date_key in self.archive.date_keys():
+                yield [
+                    (row[0], created_at_epoch(row[6]), row[1], row[2], row[3], row[4] if row[4] is not None else 0)
+                    for row in self.archive.read_segment(date_key)
+                ]
+        yield from self._iter_row_chunks(f'''
+            SELECT id, CAST(strftime('%s', created_at) AS INTEGER) - {BEIJING_UTC_OFFSET},
+                   humidity, temperature, light_intensity, COALESCE(servo_angle, 0)
+            FROM sensor_data
+            ORDER BY id ASC
+        ''', descending=False, chunk_size=chunk_size)
+
+    def export_to_npz(self, file_path=None):
+        """导出全部数据为列式 .npz（各列为定长类型数组，可内存映射读取），返回 (文件路径, 记录数)"""
+        if not file_path:
+            file_path = f"sensor_data_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.npz"
+
+        count = columnar.write_npz(self.iter_numeric_chunks(), file_path)
+        return file_path, count
+
     def import_from_json(self, file_path):
         """从JSON文件导入数据"""
         with open(file_path, 'r', encoding='utf-8') as f:
@@ -647,12 +1604,23 @@ class SensorDatabase:
         return imported_count
 
     def backup_database(self, backup_path=None):
-        """备份数据库"""
+        """备份数据库（SQLite在线备份，每步复制一批页面，期间不长时间占用读锁，得到一致的快照）"""
         if not backup_path:
             backup_path = f"sensor_data_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
 
-        import shutil
-        shutil.copy2(self.db_path, backup_path)
+        source = self._connect()
+        target = sqlite3.connect(backup_path)
+        try:
+            source.backup(target, pages=1024)
+        finally:
+            target.close()
+            source.close()
+
+        if self.shards:
+            # 分片备份到同目录的 shard_backups/，已结束月份的分片只在第一次备份时复制
+            current_month = datetime.now(pytz.timezone('Asia/Shanghai')).strftime('%Y-%m')
+            backup_dir = os.path.join(os.path.dirname(os.path.abspath(backup_path)), 'shard_backups')
+            self.shards.backup(backup_dir, current_month)
         return backup_path
 
 # 测试函数
@@ -677,13 +1645,13 @@ def test_database():
     print("\n获取所有数据:")
     all_data = db.get_all_data()
     for data in all_data:
-        print(f"ID: {data['id']}, 湿度: {data['humidity']}%, 温度: {data['temperature']}°C, 光照: {data['light_intensity']} lux")
+        print(f"ID: {data.id}, 湿度: {data.humidity}%, 温度: {data.temperature}°C, 光照: {data.light_intensity} lux")
 
     # 获取最新数据
     print("\n获取最新数据:")
     latest = db.get_latest_data()
     if latest:
-        print(f"最新数据: 湿度{latest['humidity']}%, 温度{latest['temperature']}°C, 光照{latest['light_intensity']} lux")
+        print(f"最新数据: 湿度{latest.humidity}%, 温度{latest.temperature}°C, 光照{latest.light_intensity} lux")
 
     # 获取统计信息
     print("\n获取统计信息:")
@@ -14,6 +14,14 @@
  * 1. 增加软串口缓冲区到256字节（默认64字节）
  * 2. 使用超时机制逐字符接收，避免数据丢失
  * 3. 改进的JSON验证和错误处理
+ * 4. 上传带幂等键(Idempotency-Key)，超时/5xx时用同一个键重试，服务器不会重复入库
+ * 5. 服务器过载(429)或数据库忙(503)时数据没有入库，响应头 Retry-After 给出建议等待秒数；
+ *    等待时间较短时按提示等待后重试，否则放弃本条（Nano下次采集会重新发送最新数据）
+ * 6. 与服务器保持WebSocket长连接(/device-ws)：读数上传、指令推送和指令确认走同一个连接，
+ *    不再每次上传和每2秒轮询都做一次TLS握手；长连接断开或确认超时时改用HTTP接口（同一个幂等键）
+ *    依赖库: arduinoWebSockets (Markus Sattler)
+ * 7. 服务器一次可下发多条指令（长连接推送或 /get-pending-command?max=N），先放入本地指令队列，
+ *    逐条转发给Nano，收到 X_done 后再转发下一条；队列为空时才轮询，排队的指令较多时立即再取
  */
 
 // ========== 增加软串口缓冲区大小 ==========
@@ -25,6 +33,7 @@
 #include <ESP8266HTTPClient.h>
 #include <SoftwareSerial.h>
 #include <ArduinoJson.h>
+#include <WebSocketsClient.h>
 
 // ========== WiFi配置 ==========
 const char* ssid = "SCF-XIAOMI";        // 修改为你的WiFi名称
@@ -33,6 +42,9 @@ const char* password = "scf888888";     // 修改为你的WiFi密码
 // ========== 云端服务器配置 ==========
 const char* serverURL = "https://edisonchan.zeabur.app/sensor-data";
 const char* commandURL = "https://edisonchan.zeabur.app/get-pending-command";
+const char* ackURL = "https://edisonchan.zeabur.app/command-ack";
+const char* wsHost = "edisonchan.zeabur.app";
+const uint16_t wsPort = 443;
 
 // ========== 串口配置 ==========
 // 软串口: ESP8266 GPIO4=RX=D2, GPIO5=TX=D1
@@ -45,6 +57,33 @@ const unsigned long CHAR_TIMEOUT = 100;  // 字符超时时间(ms)
 // 指令检查相关变量
 unsigned long lastCommandCheckTime = 0;
 const unsigned long COMMAND_CHECK_INTERVAL = 2000;  // 每2秒检查一次指令
+long pendingAckId = 0;  // 已转发给Nano、等待 X_done 确认的指令id（0表示没有）
+bool moreCommandsWaiting = false;  // 上次轮询时服务器还有排队的指令
+
+// 本地指令队列：逐条转发给Nano，Nano回复 X_done（或超时）后再转发下一条
+const int COMMAND_QUEUE_SIZE = 4;  // 与服务器的 DEVICE_COMMAND_WINDOW 一致
+const unsigned long COMMAND_DONE_TIMEOUT = 15000;  // 等待Nano执行完成的最长时间(ms)
+String commandQueue[COMMAND_QUEUE_SIZE];
+long commandQueueIds[COMMAND_QUEUE_SIZE];
+int commandQueueHead = 0;
+int commandQueueCount = 0;
+bool commandInProgress = false;    // 已转发给Nano、尚未收到 X_done
+unsigned long commandForwardedAt = 0;
+
+// 上传幂等相关变量
+// 每条新数据分配一个序号，重试同一条数据时沿用同一个键，服务器据此返回原记录而不重复插入
+String bootId;                     // 芯片ID + 启动时的随机数，避免重启后序号重复
+unsigned long uploadSeq = 0;       // 上传序号
+const int UPLOAD_MAX_ATTEMPTS = 2; // 最多尝试次数（Nano只等待10秒，不宜过多）
+const int MAX_RETRY_AFTER_WAIT = 3;  // 最多按 Retry-After 等待的秒数
+const char* retryHeaderKeys[] = {"Retry-After"};
+
+// 长连接相关变量
+WebSocketsClient webSocket;
+bool wsConnected = false;
+String wsAckRequestId;             // 等待服务器确认的读数幂等键
+int wsAckCode = 0;                 // 服务器回复的状态码（0表示尚未收到）
+const unsigned long WS_ACK_TIMEOUT = 3000;  // 等待读数确认的最长时间(ms)，超时改用HTTP
 
 void setup() {
   // 启动硬串口用于调试输出
@@ -66,6 +105,16 @@ void setup() {
   // 配置HTTPS (忽略证书验证)
   client.setInsecure();
 
+  // 生成本次启动的幂等键前缀
+  bootId = String(ESP.getChipId(), HEX) + "-" + String(RANDOM_REG32, HEX);
+
+  // 建立长连接，断开后自动重连；心跳检测半开连接
+  String wsPath = "/device-ws?device_id=" + String(ESP.getChipId(), HEX);
+  webSocket.beginSSL(wsHost, wsPort, wsPath.c_str());
+  webSocket.onEvent(webSocketEvent);
+  webSocket.setReconnectInterval(5000);
+  webSocket.enableHeartbeat(15000, 3000, 2);
+
   // ESP8266初始化完成后，等待Nano就绪再发送信号
   delay(3000);  // 等待Nano完全初始化
 
@@ -84,12 +133,19 @@ void loop() {
     return;
   }
 
+  // 处理长连接收发和重连
+  webSocket.loop();
+
   // 接收Nano数据并直接转发到云端
   receiveAndForwardNanoData();
 
-  // 定期检查云端指令
+  // 队列中的指令在这里逐条转发，避免打断Nano等待上传结果
+  forwardNextCommand();
+
+  // 长连接不可用、且本地指令都已执行时轮询云端指令；服务器还有排队的指令时不等待间隔
   unsigned long currentTime = millis();
-  if (currentTime - lastCommandCheckTime >= COMMAND_CHECK_INTERVAL) {
+  if (!wsConnected && commandQueueCount == 0 && !commandInProgress &&
+      (moreCommandsWaiting || currentTime - lastCommandCheckTime >= COMMAND_CHECK_INTERVAL)) {
     lastCommandCheckTime = currentTime;
     checkPendingCommands();
   }
@@ -201,12 +257,47 @@ void receiveAndForwardNanoData() {
           // LED快闪表示正在发送
           digitalWrite(LED_BUILTIN, LOW);
 
-          HTTPClient http;
-          http.begin(client, serverURL);
-          http.addHeader("Content-Type", "application/json");
-          http.setTimeout(15000);
+          // 同一条数据的所有尝试使用同一个幂等键
+          uploadSeq++;
+          String requestId = bootId + "-" + String(uploadSeq);
 
-          int httpCode = http.POST(receivedString);
+          int httpCode = -1;
+          if (wsConnected) {
+            httpCode = uploadOverWebSocket(receivedString, requestId);
+          }
+
+          // 长连接不可用、确认超时或服务器忙时改用HTTP上传，同一个幂等键不会重复入库
+          for (int attempt = 1; attempt <= UPLOAD_MAX_ATTEMPTS && !isFinalUploadCode(httpCode); attempt++) {
+            HTTPClient http;
+            http.begin(client, serverURL);
+            http.addHeader("Content-Type", "application/json");
+            http.addHeader("Idempotency-Key", requestId);
+            http.collectHeaders(retryHeaderKeys, 1);
+            http.setTimeout(15000);
+
+            httpCode = http.POST(receivedString);
+            int retryAfter = http.header("Retry-After").toInt();
+            http.end();
+
+            // 只对超时/连接错误、429和5xx重试，其他4xx说明数据本身有问题
+            if (isFinalUploadCode(httpCode)) {
+              break;
+            }
+            Serial.println("上传失败 HTTP: " + String(httpCode) + "，第" + String(attempt) + "次");
+            if (attempt == UPLOAD_MAX_ATTEMPTS) {
+              break;
+            }
+            if ((httpCode == 429 || httpCode == 503) && retryAfter > 0) {
+              // 服务器给出了重试提示，等待时间太长就放弃本条
+              if (retryAfter > MAX_RETRY_AFTER_WAIT) {
+                Serial.println("服务器繁忙，Retry-After: " + String(retryAfter) + "秒，放弃本条");
+                break;
+              }
+              delay(retryAfter * 1000);
+            } else {
+              delay(500);
+            }
+          }
 
           if (httpCode == 200 || httpCode == 201) {
             Serial.println("上传成功 HTTP: " + String(httpCode));
@@ -230,7 +321,6 @@ void receiveAndForwardNanoData() {
             nanoSerial.flush();
           }
 
-          http.end();
           digitalWrite(LED_BUILTIN, HIGH);
         } else {
           Serial.println("数据缺少必需字段");
@@ -238,6 +328,14 @@ void receiveAndForwardNanoData() {
       } else {
         Serial.println("JSON格式无效");
       }
+    } else if (receivedString.indexOf("_done") > 0) {
+      // Nano执行完指令 (Dataup_done / Watering_done / ServoTurnTo_done)，向服务器确认
+      Serial.println("指令完成: " + receivedString);
+      commandInProgress = false;
+      if (pendingAckId > 0) {
+        ackCommand(pendingAckId, receivedString);
+        pendingAckId = 0;
+      }
     } else {
       if (receivedString.length() > 0) {
         Serial.println("非JSON数据: " + receivedString);
@@ -249,34 +347,174 @@ void receiveAndForwardNanoData() {
   }
 }
 
-// 检查云端服务器是否有待处理的指令
+// 上传结果是否无需重试：成功，或除429以外的4xx（数据本身有问题）
+bool isFinalUploadCode(int httpCode) {
+  return httpCode > 0 && httpCode < 500 && httpCode != 429;
+}
+
+// 通过长连接上传一条读数，返回服务器回复的状态码，超时或连接断开返回-1
+int uploadOverWebSocket(String json, String requestId) {
+  // {"light_intensity":60,...} → {"type":"reading","request_id":"...","light_intensity":60,...}
+  String message = "{\"type\":\"reading\",\"request_id\":\"" + requestId + "\"," + json.substring(1);
+  wsAckRequestId = requestId;
+  wsAckCode = 0;
+  if (!webSocket.sendTXT(message)) {
+    return -1;
+  }
+
+  unsigned long startTime = millis();
+  while (wsAckCode == 0 && wsConnected && millis() - startTime < WS_ACK_TIMEOUT) {
+    webSocket.loop();
+    delay(1);
+  }
+  wsAckRequestId = "";
+  if (wsAckCode == 0) {
+    Serial.println("长连接确认超时");
+    return -1;
+  }
+  Serial.println("长连接上传 code: " + String(wsAckCode));
+  return wsAckCode;
+}
+
+// 长连接事件
+void webSocketEvent(WStype_t type, uint8_t* payload, size_t length) {
+  switch (type) {
+    case WStype_CONNECTED:
+      wsConnected = true;
+      Serial.println("长连接已建立");
+      break;
+    case WStype_DISCONNECTED:
+      if (wsConnected) {
+        Serial.println("长连接断开，改用HTTP");
+      }
+      wsConnected = false;
+      break;
+    case WStype_TEXT:
+      handleServerMessage(String((const char*)payload));
+      break;
+    default:
+      break;
+  }
+}
+
+// 处理服务器通过长连接发来的消息：指令推送，或读数的确认/错误
+void handleServerMessage(String message) {
+  if (message.indexOf("\"type\":\"command\"") >= 0) {
+    // 先放入队列，由loop()转发给Nano
+    int commandStart = message.indexOf("\"command\":\"");
+    if (commandStart > 0) {
+      commandStart += 11;  // 跳过"command":"
+      int commandEnd = message.indexOf("\"", commandStart);
+      if (commandEnd > commandStart) {
+        String command = message.substring(commandStart, commandEnd);
+        int idStart = message.indexOf("\"command_id\":");
+        long commandId = idStart >= 0 ? message.substring(idStart + 13).toInt() : 0;
+        Serial.println("云端指令(长连接): " + command);
+        enqueueCommand(command, commandId);
+      }
+    }
+  } else if (wsAckRequestId.length() > 0 &&
+             message.indexOf("\"request_id\":\"" + wsAckRequestId + "\"") >= 0) {
+    int codeStart = message.indexOf("\"code\":");
+    wsAckCode = codeStart >= 0 ? message.substring(codeStart + 7).toInt() : -1;
+  }
+}
+
+// 检查云端服务器是否有待处理的指令，一次最多取走本地队列能放下的条数
 void checkPendingCommands() {
   HTTPClient http;
-  http.begin(client, commandURL);
+  http.begin(client, String(commandURL) + "?max=" + String(COMMAND_QUEUE_SIZE));
   http.setTimeout(5000);  // 5秒超时
 
   int httpCode = http.GET();
+  moreCommandsWaiting = false;
 
   if (httpCode == 200) {
     String response = http.getString();
 
-    // 简单解析JSON响应
-    if (response.indexOf("\"has_command\":true") > 0) {
-      // 提取指令内容
-      int commandStart = response.indexOf("\"command\":\"");
-      if (commandStart > 0) {
-        commandStart += 11;  // 跳过"command":"
-        int commandEnd = response.indexOf("\"", commandStart);
-        if (commandEnd > commandStart) {
-          String command = response.substring(commandStart, commandEnd);
-          Serial.println("云端指令: " + command);
-
-          // 转发指令到Arduino Nano
-          forwardCommandToNano(command);
-        }
+    // 简单解析JSON响应：commands 数组按执行顺序排列，每项为 {"command":"...","command_id":N}
+    int listStart = response.indexOf("\"commands\":[");
+    int listEnd = listStart >= 0 ? response.indexOf("]", listStart) : -1;
+    int commandStart = listStart >= 0 ? response.indexOf("\"command\":\"", listStart) : -1;
+    while (commandStart > 0 && commandStart < listEnd) {
+      commandStart += 11;  // 跳过"command":"
+      int commandEnd = response.indexOf("\"", commandStart);
+      if (commandEnd <= commandStart) {
+        break;
       }
+      String command = response.substring(commandStart, commandEnd);
+      Serial.println("云端指令: " + command);
+
+      // 记录指令id，Nano回复 X_done 后确认
+      int idStart = response.indexOf("\"command_id\":", commandEnd);
+      long commandId = (idStart >= 0 && idStart < listEnd) ? response.substring(idStart + 13).toInt() : 0;
+      enqueueCommand(command, commandId);
+
+      commandStart = response.indexOf("\"command\":\"", commandEnd);
     }
+
+    int remainingStart = response.indexOf("\"remaining\":");
+    moreCommandsWaiting = remainingStart >= 0 && response.substring(remainingStart + 12).toInt() > 0;
+  }
+
+  http.end();
+}
+
+// 指令放入本地队列；队列已满时丢弃并打印（服务器每次下发的条数不超过队列长度，正常不会发生）
+void enqueueCommand(String command, long commandId) {
+  if (commandQueueCount >= COMMAND_QUEUE_SIZE) {
+    Serial.println("指令队列已满，丢弃: " + command);
+    return;
   }
+  int tail = (commandQueueHead + commandQueueCount) % COMMAND_QUEUE_SIZE;
+  commandQueue[tail] = command;
+  commandQueueIds[tail] = commandId;
+  commandQueueCount++;
+}
+
+// 上一条指令执行完成（或超时）后，把队列中的下一条转发给Nano
+void forwardNextCommand() {
+  if (commandInProgress) {
+    if (millis() - commandForwardedAt < COMMAND_DONE_TIMEOUT) {
+      return;
+    }
+    Serial.println("等待指令完成超时");
+    commandInProgress = false;
+    pendingAckId = 0;
+  }
+  if (commandQueueCount == 0) {
+    return;
+  }
+
+  String command = commandQueue[commandQueueHead];
+  pendingAckId = commandQueueIds[commandQueueHead];
+  commandQueue[commandQueueHead] = "";
+  commandQueueHead = (commandQueueHead + 1) % COMMAND_QUEUE_SIZE;
+  commandQueueCount--;
+
+  commandInProgress = true;
+  commandForwardedAt = millis();
+  forwardCommandToNano(command);
+}
+
+// 向服务器确认指令已执行
+void ackCommand(long commandId, String result) {
+  String body = "{\"command_id\":" + String(commandId) + ",\"result\":\"" + result + "\"}";
+  if (wsConnected) {
+    String message = "{\"type\":\"ack\"," + body.substring(1);
+    if (webSocket.sendTXT(message)) {
+      Serial.println("指令确认(长连接)");
+      return;
+    }
+  }
+
+  HTTPClient http;
+  http.begin(client, ackURL);
+  http.addHeader("Content-Type", "application/json");
+  http.setTimeout(5000);
+
+  int httpCode = http.POST(body);
+  Serial.println("指令确认 HTTP: " + String(httpCode));
 
   http.end();
 }
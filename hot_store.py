@@ -0,0 +1,405 @@
+"""
+最近N天数据的内存时序存储
+每个块保存共享的时间戳列和每个指标一列数值：时间戳/ID使用delta-of-delta编码，数值使用XOR编码 (Gorilla)
+最新的未封存块以数组形式保存，已封存块解码后放入有上限的LRU缓存
+
+时间轴: 北京时间的 created_at 直接按UTC换算得到的秒数，与 SensorDatabase.get_numeric_series 一致
+"""
+import calendar
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+
+METRICS = ('humidity', 'temperature', 'light_intensity', 'servo_angle')
+AGGREGATES = ('mean', 'min', 'max', 'sum', 'count', 'last')
+
+_U64 = 1 << 64
+
+
+class BitWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.acc = 0
+        self.acc_bits = 0
+
+    def write(self, value, nbits):
+        self.acc = (self.acc << nbits) | (value & ((1 << nbits) - 1))
+        self.acc_bits += nbits
+        while self.acc_bits >= 8:
+            self.acc_bits -= 8
+            self.buffer.append((self.acc >> self.acc_bits) & 0xFF)
+        self.acc &= (1 << self.acc_bits) - 1
+
+    def getvalue(self):
+        if self.acc_bits:
+            return bytes(self.buffer) + bytes([(self.acc << (8 - self.acc_bits)) & 0xFF])
+        return bytes(self.buffer)
+
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, nbits):
+        start = self.pos >> 3
+        end = (self.pos + nbits + 7) >> 3
+        chunk = int.from_bytes(self.data[start:end], 'big')
+        shift = (end << 3) - self.pos - nbits
+        self.pos += nbits
+        return (chunk >> shift) & ((1 << nbits) - 1)
+
+
+def encode_integers(values):
+    """delta-of-delta 编码单调整数序列（时间戳、ID）"""
+    writer = BitWriter()
+    writer.write(values[0] % _U64, 64)
+    prev = values[0]
+    prev_delta = 0
+    for value in values[1:]:
+        delta = value - prev
+        dod = delta - prev_delta
+        if dod == 0:
+            writer.write(0, 1)
+        elif -63 <= dod <= 64:
+            writer.write(0b10, 2)
+            writer.write(dod + 63, 7)
+        elif -255 <= dod <= 256:
+            writer.write(0b110, 3)
+            writer.write(dod + 255, 9)
+        elif -2047 <= dod <= 2048:
+            writer.write(0b1110, 4)
+            writer.write(dod + 2047, 12)
+        else:
+            writer.write(0b1111, 4)
+            writer.write(dod % _U64, 64)
+        prev_delta = delta
+        prev = value
+    return writer.getvalue()
+
+
+def decode_integers(data, count):
+    reader = BitReader(data)
+    first = reader.read(64)
+    if first >= 1 << 63:
+        first -= _U64
+    values = array('q', [first])
+    prev = first
+    delta = 0
+    for _ in range(count - 1):
+        if reader.read(1) == 0:
+            dod = 0
+        elif reader.read(1) == 0:
+            dod = reader.read(7) - 63
+        elif reader.read(1) == 0:
+            dod = reader.read(9) - 255
+        elif reader.read(1) == 0:
+            dod = reader.read(12) - 2047
+        else:
+            dod = reader.read(64)
+            if dod >= 1 << 63:
+                dod -= _U64
+        delta += dod
+        prev += delta
+        values.append(prev)
+    return values
+
+
+def encode_floats(values):
+    """XOR 编码浮点序列：与前值相同只占1位，变化时只写有效位"""
+    bits = array('Q')
+    bits.frombytes(array('d', values).tobytes())
+
+    writer = BitWriter()
+    writer.write(bits[0], 64)
+    prev = bits[0]
+    prev_lead = -1
+    prev_trail = 0
+    for value in bits[1:]:
+        xor = value ^ prev
+        if xor == 0:
+            writer.write(0, 1)
+        else:
+            lead = min(64 - xor.bit_length(), 31)
+            trail = (xor & -xor).bit_length() - 1
+            if prev_lead >= 0 and lead >= prev_lead and trail >= prev_trail:
+                # 有效位落在上一个窗口内，复用窗口
+                writer.write(0b10, 2)
+                writer.write(xor >> prev_trail, 64 - prev_lead - prev_trail)
+            else:
+                significant = 64 - lead - trail
+                writer.write(0b11, 2)
+                writer.write(lead, 5)
+                writer.write(significant - 1, 6)
+                writer.write(xor >> trail, significant)
+                prev_lead, prev_trail = lead, trail
+        prev = value
+    return writer.getvalue()
+
+
+def decode_floats(data, count):
+    reader = BitReader(data)
+    prev = reader.read(64)
+    bits = array('Q', [prev])
+    lead = trail = 0
+    for _ in range(count - 1):
+        if reader.read(1) == 0:
+            bits.append(prev)
+            continue
+        if reader.read(1) == 1:
+            lead = reader.read(5)
+            significant = reader.read(6) + 1
+            trail = 64 - lead - significant
+        prev ^= reader.read(64 - lead - trail) << trail
+        bits.append(prev)
+    values = array('d')
+    values.frombytes(bits.tobytes())
+    return values
+
+
+class Block:
+    """已封存的压缩块，附带每个指标的 (sum, min, max) 摘要，聚合查询完全覆盖时无需解码"""
+    __slots__ = ('count', 'start', 'end', 'first_id', 'last_id', 'ts_data', 'id_data', 'value_data', 'summary')
+
+    def __init__(self, timestamps, ids, columns):
+        self.count = len(timestamps)
+        self.start = timestamps[0]
+        self.end = timestamps[-1]
+        self.first_id = ids[0]
+        self.last_id = ids[-1]
+        self.ts_data = encode_integers(timestamps)
+        self.id_data = encode_integers(ids)
+        self.value_data = {metric: encode_floats(columns[metric]) for metric in METRICS}
+        self.summary = {
+            metric: (sum(columns[metric]), min(columns[metric]), max(columns[metric])) for metric in METRICS
+        }
+
+    def nbytes(self):
+        return len(self.ts_data) + len(self.id_data) + sum(len(d) for d in self.value_data.values())
+
+
+def parse_time(value):
+    """'YYYY-MM-DD[ HH:MM:SS]' 或epoch秒 转为存储使用的时间轴秒数"""
+    if value is None or value == '':
+        return None
+    value = str(value).strip()
+    if value.lstrip('-').isdigit():
+        return int(value)
+    fmt = '%Y-%m-%d' if len(value) == 10 else '%Y-%m-%d %H:%M:%S'
+    return calendar.timegm(time.strptime(value, fmt))
+
+
+def format_time(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+
+
+class HotWindowStore:
+    def __init__(self, window_days=3, block_size=256, cache_blocks=32):
+        self.window_seconds = int(window_days * 86400)
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._reset()
+
+    def _reset(self):
+        self.blocks = deque()
+        self.head_ts = array('q')
+        self.head_ids = array('q')
+        self.head_values = {metric: array('d') for metric in METRICS}
+        self.decoded = OrderedDict()
+        self.last_id = 0
+        self.latest_ts = None
+        self.loaded = False
+
+    def sync(self, db):
+        """
+        从SQLite追加 id > last_id 的新数据（主键范围查询），首次调用时加载整个窗口
+        多个worker各自维护存储，靠同步保证能看到其他进程写入的数据；发现数据被清空时重新加载
+        """
+        with self.lock:
+            if not self.loaded:
+                rows = self._load_window(db)
+            else:
+                rows = db.get_numeric_series(after_id=self.last_id)
+                if not rows and self.last_id:
+                    latest = db.get_latest_data()
+                    if latest is None or latest.id < self.last_id:
+                        self._reset()
+                        rows = self._load_window(db)
+            for row in rows:
+                self._append(row)
+            self._evict()
+
+    def _load_window(self, db):
+        """窗口以最新一条数据的时间为终点"""
+        self.loaded = True
+        latest = db.get_latest_data()
+        if latest is None:
+            return []
+        start = format_time(parse_time(latest.created_at) - self.window_seconds)
+        return db.get_numeric_series(start_date=start)
+
+    def _append(self, row):
+        data_id, ts = row[0], row[1]
+        self.head_ids.append(data_id)
+        self.head_ts.append(ts)
+        for metric, value in zip(METRICS, row[2:]):
+            # 数组不能保存空值；旧数据的舵机角度可能为NULL，与 get_numeric_series 一样按0保存
+            self.head_values[metric].append(value if value is not None else 0)
+        self.last_id = data_id
+        self.latest_ts = ts if self.latest_ts is None else max(self.latest_ts, ts)
+        if len(self.head_ts) >= self.block_size:
+            self.blocks.append(Block(self.head_ts, self.head_ids, self.head_values))
+            self.head_ts = array('q')
+            self.head_ids = array('q')
+            self.head_values = {metric: array('d') for metric in METRICS}
+
+    def _evict(self):
+        """丢弃完全落在窗口之外的块"""
+        if self.latest_ts is None:
+            return
+        cutoff = self.latest_ts - self.window_seconds
+        while self.blocks and self.blocks[0].end < cutoff:
+            block = self.blocks.popleft()
+            self.decoded.pop(id(block), None)
+
+    def _decode(self, block):
+        key = id(block)
+        entry = self.decoded.get(key)
+        if entry is not None:
+            self.cache_hits += 1
+            self.decoded.move_to_end(key)
+            return entry
+        self.cache_misses += 1
+        entry = (
+            decode_integers(block.ts_data, block.count),
+            {metric: decode_floats(data, block.count) for metric, data in block.value_data.items()}
+        )
+        self.decoded[key] = entry
+        while len(self.decoded) > self.cache_blocks:
+            self.decoded.popitem(last=False)
+        return entry
+
+    def _segments(self, metric, start, end):
+        """返回与 [start, end] 相交的 (时间戳数组, 数值数组, 是否完全覆盖, 块) 序列"""
+        for block in self.blocks:
+            if block.end < start or block.start > end:
+                continue
+            covered = block.start >= start and block.end <= end
+            if covered:
+                yield None, None, True, block
+            else:
+                timestamps, columns = self._decode(block)
+                yield timestamps, columns[metric], False, block
+        if self.head_ts:
+            yield self.head_ts, self.head_values[metric], False, None
+
+    def _bounds(self, start, end):
+        lower = self.latest_ts - self.window_seconds if self.latest_ts is not None else 0
+        start = lower if start is None else max(start, lower)
+        end = (self.latest_ts or 0) if end is None else end
+        return start, end
+
+    def range(self, metric, start=None, end=None):
+        """窗口内原始点 (时间戳列表, 数值列表)"""
+        with self.lock:
+            start, end = self._bounds(start, end)
+            out_ts, out_values = [], []
+            for block in self.blocks:
+                if block.end < start or block.start > end:
+                    continue
+                timestamps, columns = self._decode(block)
+                self._slice_into(timestamps, columns[metric], start, end, out_ts, out_values)
+            self._slice_into(self.head_ts, self.head_values[metric], start, end, out_ts, out_values)
+            return out_ts, out_values
+
+    @staticmethod
+    def _slice_into(timestamps, values, start, end, out_ts, out_values):
+        for ts, value in zip(timestamps, values):
+            if start <= ts <= end:
+                out_ts.append(ts)
+                out_values.append(value)
+
+    def aggregate(self, metric, start=None, end=None):
+        """窗口内聚合：完全覆盖的块直接使用摘要，不解码"""
+        with self.lock:
+            start, end = self._bounds(start, end)
+            count, total = 0, 0.0
+            low = high = None
+            for timestamps, values, covered, block in self._segments(metric, start, end):
+                if covered:
+                    block_sum, block_min, block_max = block.summary[metric]
+                    count += block.count
+                    total += block_sum
+                    low = block_min if low is None else min(low, block_min)
+                    high = block_max if high is None else max(high, block_max)
+                    continue
+                for ts, value in zip(timestamps, values):
+                    if start <= ts <= end:
+                        count += 1
+                        total += value
+                        low = value if low is None else min(low, value)
+                        high = value if high is None else max(high, value)
+            return {
+                'count': count,
+                'sum': round(total, 4),
+                'mean': round(total / count, 4) if count else None,
+                'min': low,
+                'max': high
+            }
+
+    def downsample(self, metric, start=None, end=None, bucket=60, agg='mean'):
+        """按固定时间桶降采样，返回 [(桶起始时间戳, 值), ...]"""
+        if agg not in AGGREGATES:
+            raise ValueError(f'Unsupported aggregate: {agg}')
+        bucket = max(1, int(bucket))
+        ts_list, values = self.range(metric, start, end)
+
+        buckets = OrderedDict()
+        for ts, value in zip(ts_list, values):
+            key = ts - ts % bucket
+            state = buckets.get(key)
+            if state is None:
+                buckets[key] = [1, value, value, value, value]
+            else:
+                state[0] += 1
+                state[1] += value
+                state[2] = min(state[2], value)
+                state[3] = max(state[3], value)
+                state[4] = value
+
+        result = []
+        for key, (count, total, low, high, last) in buckets.items():
+            value = {
+                'mean': total / count,
+                'min': low,
+                'max': high,
+                'sum': total,
+                'count': count,
+                'last': last
+            }[agg]
+            result.append((key, round(value, 4)))
+        return result
+
+    def stats(self):
+        """内存占用和缓存情况"""
+        with self.lock:
+            sealed_points = sum(block.count for block in self.blocks)
+            compressed = sum(block.nbytes() for block in self.blocks)
+            return {
+                'window_days': self.window_seconds / 86400,
+                'blocks': len(self.blocks),
+                'sealed_points': sealed_points,
+                'head_points': len(self.head_ts),
+                'compressed_bytes': compressed,
+                'raw_bytes': sealed_points * 8 * (2 + len(METRICS)),
+                'decoded_blocks': len(self.decoded),
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+                'last_id': self.last_id,
+                'window_start': format_time(self.latest_ts - self.window_seconds) if self.latest_ts else None,
+                'window_end': format_time(self.latest_ts) if self.latest_ts else None
+            }
@@ -0,0 +1,205 @@
+"""
+重查询的后台任务
+导出、全量统计、整年/整月/时间范围查询、分析和备份提交到进程池执行：子进程用只读连接打开数据库，
+结果写成JSON文件，再由 /jobs/<id>/result 以文件流返回；请求worker只负责提交和查询状态，
+不会被长查询占住，也不和设备上传争抢同一批worker
+"""
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+JOB_KINDS = ('export', 'statistics', 'year', 'month', 'date_range', 'analytics', 'backup')
+
+
+def validate_params(kind, params):
+    """提交前检查参数，返回规范化后的参数，不合法时抛出 ValueError"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind: {kind} (supported: {', '.join(JOB_KINDS)})")
+    if not isinstance(params, dict):
+        raise ValueError('Job params must be an object')
+
+    if kind == 'year':
+        _require(params, 'year')
+        return {'year': int(params['year'])}
+    if kind == 'month':
+        _require(params, 'year', 'month')
+        month = int(params['month'])
+        if not 1 <= month <= 12:
+            raise ValueError('Month must be between 1 and 12')
+        return {'year': int(params['year']), 'month': month}
+    if kind == 'date_range':
+        _require(params, 'start', 'end')
+        return {'start': str(params['start']), 'end': str(params['end'])}
+    if kind == 'analytics':
+        end = params.get('end')
+        # 只给日期时包含结束当天全天（与 /sensor-data/analytics 一致）
+        if end and len(end) == 10:
+            end = f"{end} 23:59:59"
+        return {
+            'start': params.get('start'),
+            'end': end,
+            'window': int(params.get('window', 10)),
+            'z': float(params.get('z', 3.0)),
+            'max_points': int(params.get('max_points', 1000))
+        }
+    return {}
+
+
+def _require(params, *fields):
+    for field in fields:
+        if params.get(field) is None:
+            raise ValueError(f'Missing required param: {field}')
+
+
+def _run_job(kind, db_path, archive_dir, shard_dir, params, result_path):
+    """
+    在子进程中执行一个任务（模块级函数，便于进程池序列化）
+    结果先写临时文件再原子替换，返回不含数据的摘要
+    """
+    from database import SensorDatabase
+
+    db = SensorDatabase(db_path, archive_dir=archive_dir, read_only=True, shard_dir=shard_dir)
+    if kind == 'export':
+        data = db.get_all_data()
+        payload = {'count': len(data), 'data': data.to_dicts()}
+    elif kind == 'statistics':
+        payload = {'statistics': db.get_statistics()}
+    elif kind == 'year':
+        data = db.get_data_by_year(params['year'])
+        payload = {'year': params['year'], 'count': len(data), 'data': data.to_dicts()}
+    elif kind == 'month':
+        data = db.get_data_by_month(params['year'], params['month'])
+        payload = {'year': params['year'], 'month': params['month'], 'count': len(data), 'data': data.to_dicts()}
+    elif kind == 'date_range':
+        data = db.get_data_by_date_range(params['start'], params['end'])
+        payload = {'start': params['start'], 'end': params['end'], 'count': len(data), 'data': data.to_dicts()}
+    elif kind == 'analytics':
+        import analytics
+        rows = db.get_numeric_series(params['start'], params['end'])
+        payload = {
+            'start': params['start'],
+            'end': params['end'],
+            'analytics': analytics.analyze(rows, window=params['window'], z_threshold=params['z'],
+                                           max_points=params['max_points'])
+        }
+    elif kind == 'backup':
+        payload = {'backup_path': db.backup_database()}
+    else:
+        raise ValueError(f'Unknown job kind: {kind}')
+
+    payload = {'status': 'success', 'kind': kind, **payload}
+    tmp_path = result_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(payload, f, ensure_ascii=False)
+    os.replace(tmp_path, result_path)
+    return {key: payload[key] for key in ('count', 'backup_path') if key in payload}
+
+
+class JobManager:
+    def __init__(self, db_path, archive_dir=None, result_dir='job_results', max_workers=2, max_jobs=100,
+                 shard_dir=None):
+        """
+        max_workers: 进程池大小，同时执行的任务数
+        max_jobs: 保留的任务记录数，超出后删除最早结束的任务及其结果文件
+        """
+        self.db_path = os.path.abspath(db_path)
+        self.archive_dir = os.path.abspath(archive_dir) if archive_dir else None
+        self.shard_dir = os.path.abspath(shard_dir) if shard_dir else None
+        self.result_dir = os.path.abspath(result_dir)
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()       # job_id -> 任务记录
+        self.executor = None
+
+    def _get_executor(self):
+        # 首次提交时才创建进程池；用spawn启动子进程，不复制请求进程中正在运行的线程和锁
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def submit(self, kind, params=None):
+        """提交任务，返回任务记录；参数不合法时抛出 ValueError"""
+        params = validate_params(kind, params or {})
+        os.makedirs(self.result_dir, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'kind': kind,
+            'params': params,
+            'status': 'queued',
+            'submitted_at': time.time(),
+            'finished_at': None,
+            'summary': None,
+            'error': None,
+            'result_path': os.path.join(self.result_dir, f'{job_id}.json')
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            future = self._get_executor().submit(_run_job, kind, self.db_path, self.archive_dir, self.shard_dir,
+                                                 params, job['result_path'])
+            job['future'] = future
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        self._prune()
+        return self.status(job_id)
+
+    def _finish(self, job_id, future):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job['finished_at'] = time.time()
+            error = future.exception()
+            if error is None:
+                job['status'] = 'done'
+                job['summary'] = future.result()
+            else:
+                job['status'] = 'failed'
+                job['error'] = str(error)
+                print(f"Error running job {job_id} ({job['kind']}): {str(error)}")
+
+    def _prune(self):
+        """只淘汰已结束的任务，进行中的任务记录始终保留"""
+        with self.lock:
+            finished = [job_id for job_id, job in self.jobs.items() if job['finished_at'] is not None]
+            excess = len(self.jobs) - self.max_jobs
+            for job_id in finished[:max(0, excess)]:
+                job = self.jobs.pop(job_id)
+                try:
+                    os.remove(job['result_path'])
+                except OSError:
+                    pass
+
+    def status(self, job_id):
+        """任务状态（不含内部字段），不存在返回None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job['status'] == 'queued' and job['future'].running():
+                job['status'] = 'running'
+            return {key: value for key, value in job.items() if key not in ('future', 'result_path')}
+
+    def result_path(self, job_id):
+        """已完成任务的结果文件路径，未完成或不存在返回None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] != 'done':
+                return None
+            return job['result_path']
+
+    def list_jobs(self):
+        """全部任务状态，最近提交的在前"""
+        with self.lock:
+            job_ids = list(self.jobs)
+        return [job for job in (self.status(job_id) for job_id in reversed(job_ids)) if job]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,378 @@
+"""
+行协议入库监听
+网关和高频传感器可以不走HTTP，直接通过TCP或UDP发送按行分隔的读数，格式与 parse_sensor_string 相同：
+    Light:850,Humidity:65.2,Temperature:25.6,Servo_angle:90\n
+每个连接收到的数据按行切分、批量解析，攒够一批或超过刷新间隔后用一个事务写入数据库，
+省去每条读数一次HTTP请求、JSON解析和事务提交；不回复确认，格式错误的行只计数
+每批写入与HTTP入库经过同一个准入控制：被拒绝（过载、写锁冷却、备份/导出/归档）时按数据库忙处理，
+TCP暂停读取、UDP积压，稍后重试
+"""
+import math
+import socketserver
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from admission import is_busy_error
+
+# 单行最大长度，超过时丢弃该行（防止没有换行符的数据无限占用内存）
+MAX_LINE_BYTES = 1024
+# 保留的已断开连接统计条数
+CLOSED_CONNECTION_HISTORY = 50
+# UDP按来源地址统计，超过上限时淘汰最早出现的来源
+MAX_UDP_PEERS = 256
+
+# write_batch 的结果
+WRITTEN, BUSY, FAILED = 'written', 'busy', 'failed'
+
+
+class ConnectionStats:
+    """单个连接（UDP为单个来源地址）的计数"""
+
+    def __init__(self, protocol, peer):
+        self.protocol = protocol
+        self.peer = peer
+        self.connected_at = time.time()
+        self.closed_at = None
+        self.bytes = 0
+        self.lines = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.batches = 0
+        self.busy_retries = 0
+        self.dropped = 0
+        self.last_error = None
+
+    def to_dict(self):
+        elapsed = (self.closed_at or time.time()) - self.connected_at
+        return {
+            'protocol': self.protocol,
+            'peer': self.peer,
+            'connected_at': self.connected_at,
+            'closed_at': self.closed_at,
+            'bytes': self.bytes,
+            'lines': self.lines,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'batches': self.batches,
+            'busy_retries': self.busy_retries,
+            'dropped': self.dropped,
+            'readings_per_second': round(self.accepted / elapsed, 1) if elapsed > 0 else None,
+            'last_error': self.last_error
+        }
+
+
+def parse_lines(lines, parse):
+    """
+    批量解析一组行，返回 (读数列表, 失败行数, 最后一个错误)
+    lines: bytes 行列表（不含换行符）；空行忽略，含 nan/inf 的行计为失败
+    """
+    readings = []
+    rejected = 0
+    last_error = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            reading = parse(line.decode('utf-8'))
+            # nan/inf 能被 float() 解析，但SQLite把NaN存为NULL，会让整批写入因NOT NULL约束失败
+            for field, value in reading.items():
+                if isinstance(value, float) and not math.isfinite(value):
+                    raise ValueError(f'Non-finite value for {field}: {value}')
+            readings.append(reading)
+        except (UnicodeDecodeError, ValueError) as e:
+            rejected += 1
+            last_error = str(e)
+    return readings, rejected, last_error
+
+
+class LineBuffer:
+    """把收到的字节流切成完整的行，不完整的尾部留到下一次"""
+
+    def __init__(self):
+        self.tail = b''
+
+    def feed(self, data):
+        lines = (self.tail + data).split(b'\n')
+        self.tail = lines.pop()
+        if len(self.tail) > MAX_LINE_BYTES:
+            self.tail = b''
+            return lines, 1
+        return lines, 0
+
+    def flush(self):
+        lines, self.tail = [self.tail], b''
+        return lines
+
+
+class LineIngestServer:
+    def __init__(self, db, parse, host='0.0.0.0', tcp_port=None, udp_port=None,
+                 batch_size=2000, flush_interval=0.2, max_pending=50000, on_batch=None, admission=None):
+        """
+        parse: 单行解析函数（parse_sensor_string），不合法时抛出 ValueError
+        batch_size: 每个事务最多写入的读数条数
+        flush_interval: 未攒满一批时最长等待的秒数
+        max_pending: 数据库持续忙时UDP最多积压的读数，超出的丢弃并计数（TCP停止读取，由发送端阻塞）
+        on_batch: 每批写入后的回调 on_batch(读数列表)，用于自动化规则求值
+        admission: 与HTTP入库共用的 AdmissionController，每批写入占用一个处理名额
+        """
+        self.db = db
+        self.parse = parse
+        self.host = host
+        self.tcp_port = tcp_port
+        self.udp_port = udp_port
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.on_batch = on_batch
+        self.admission = admission
+        self.lock = threading.Lock()
+        self.connections = {}               # id(ConnectionStats) -> 活动连接
+        self.closed = deque(maxlen=CLOSED_CONNECTION_HISTORY)
+        self.servers = []
+        self.stop_event = threading.Event()
+
+    def _register(self, stats):
+        with self.lock:
+            self.connections[id(stats)] = stats
+
+    def _unregister(self, stats):
+        stats.closed_at = time.time()
+        with self.lock:
+            self.connections.pop(id(stats), None)
+            self.closed.append(stats)
+
+    def write_batch(self, readings):
+        """
+        一个事务写入一批读数，返回 (结果, 错误信息)
+        数据库忙或被准入控制拒绝时返回 BUSY，读数留给调用方重试；其他错误返回 FAILED，这一批丢弃
+        """
+        if self.admission:
+            rejection = self.admission.admit()
+            if rejection is not None:
+                return BUSY, f'rejected by admission control: {rejection[2]}'
+        try:
+            batch = self.db.add_sensor_data_batch(readings)
+        except sqlite3.OperationalError as e:
+            if is_busy_error(e):
+                if self.admission:
+                    self.admission.record_busy()
+                return BUSY, str(e)
+            print(f"Error writing line ingest batch: {str(e)}")
+            return FAILED, str(e)
+        except Exception as e:
+            print(f"Error writing line ingest batch: {str(e)}")
+            return FAILED, str(e)
+        finally:
+            if self.admission:
+                self.admission.release()
+
+        if self.on_batch:
+            try:
+                self.on_batch(batch)
+            except Exception as e:
+                print(f"Error in line ingest batch callback: {str(e)}")
+        return WRITTEN, None
+
+    def _make_tcp_handler(self):
+        server = self
+
+        class TCPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                peer = f"{self.client_address[0]}:{self.client_address[1]}"
+                stats = ConnectionStats('tcp', peer)
+                server._register(stats)
+                buffer = LineBuffer()
+                pending = []
+                first_pending_at = None
+                # 超时用于在没有新数据时也能按刷新间隔写入
+                self.request.settimeout(server.flush_interval)
+                try:
+                    while not server.stop_event.is_set():
+                        try:
+                            data = self.request.recv(65536)
+                        except TimeoutError:
+                            data = None
+                        except OSError as e:
+                            stats.last_error = str(e)
+                            break
+                        if data == b'':
+                            break
+
+                        if data:
+                            stats.bytes += len(data)
+                            lines, oversized = buffer.feed(data)
+                            readings, rejected, error = parse_lines(lines, server.parse)
+                            stats.lines += len(readings) + rejected + oversized
+                            stats.rejected += rejected + oversized
+                            if error:
+                                stats.last_error = error
+                            if readings and not pending:
+                                first_pending_at = time.monotonic()
+                            pending.extend(readings)
+
+                        if pending and (len(pending) >= server.batch_size or
+                                        time.monotonic() - first_pending_at >= server.flush_interval):
+                            pending = server._flush_blocking(pending, stats)
+                            first_pending_at = time.monotonic() if pending else None
+
+                    # 连接关闭：没有换行符结尾的最后一行也写入
+                    readings, rejected, error = parse_lines(buffer.flush(), server.parse)
+                    stats.lines += len(readings) + rejected
+                    stats.rejected += rejected
+                    pending.extend(readings)
+                    if pending:
+                        server._flush_blocking(pending, stats)
+                finally:
+                    server._unregister(stats)
+
+        return TCPHandler
+
+    def _flush_blocking(self, pending, stats):
+        """
+        按批大小写入积压的读数；数据库忙时等待后重试（期间不再从连接读取，发送端由TCP流控阻塞）
+        返回未写入的读数（正常为空）
+        """
+        while pending:
+            chunk = pending[:self.batch_size]
+            result, error = self.write_batch(chunk)
+            if result == WRITTEN:
+                stats.accepted += len(chunk)
+                stats.batches += 1
+            elif result == FAILED:
+                stats.dropped += len(chunk)
+                stats.last_error = error
+            else:
+                stats.busy_retries += 1
+                stats.last_error = error
+                if self.stop_event.is_set():
+                    # 服务停止，不再等待
+                    stats.dropped += len(pending)
+                    return []
+                time.sleep(self.flush_interval)
+                continue
+            pending = pending[self.batch_size:]
+        return pending
+
+    def _make_udp_server(self):
+        server = self
+
+        class UDPHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data = self.request[0]
+                peer = f"{self.client_address[0]}:{self.client_address[1]}"
+                stats = udp.peers.get(peer)
+                if stats is None:
+                    if len(udp.peers) >= MAX_UDP_PEERS:
+                        server._unregister(udp.peers.pop(next(iter(udp.peers))))
+                    stats = ConnectionStats('udp', peer)
+                    udp.peers[peer] = stats
+                    server._register(stats)
+                stats.bytes += len(data)
+                # 每个数据报包含完整的行，结尾的换行符可省略
+                readings, rejected, error = parse_lines(data.split(b'\n'), server.parse)
+                stats.lines += len(readings) + rejected
+                stats.rejected += rejected
+                if error:
+                    stats.last_error = error
+                if readings:
+                    if not udp.pending:
+                        udp.first_pending_at = time.monotonic()
+                    udp.pending.extend((stats, reading) for reading in readings)
+                    if len(udp.pending) >= server.batch_size:
+                        udp.flush()
+
+        class UDPServer(socketserver.UDPServer):
+            allow_reuse_address = True
+            max_packet_size = 65536
+
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.peers = {}             # 来源地址 -> ConnectionStats
+                self.pending = []           # (来源统计, 读数)
+                self.first_pending_at = None
+
+            def flush(self):
+                """写入积压的读数；数据库忙时保留，积压超过上限时丢弃最早的"""
+                while self.pending:
+                    chunk = self.pending[:server.batch_size]
+                    result, error = server.write_batch([reading for _, reading in chunk])
+                    # 一批中各来源的条数分别计入各自的统计
+                    counts = {}
+                    for stats, _ in chunk:
+                        counts[stats] = counts.get(stats, 0) + 1
+                    for stats, count in counts.items():
+                        if result == WRITTEN:
+                            stats.accepted += count
+                            stats.batches += 1
+                        elif result == FAILED:
+                            stats.dropped += count
+                            stats.last_error = error
+                        else:
+                            stats.busy_retries += 1
+                            stats.last_error = error
+                    if result == BUSY:
+                        overflow = len(self.pending) - server.max_pending
+                        if overflow > 0:
+                            for stats, _ in self.pending[:overflow]:
+                                stats.dropped += 1
+                            del self.pending[:overflow]
+                        self.first_pending_at = time.monotonic()
+                        return
+                    del self.pending[:len(chunk)]
+                self.first_pending_at = None
+
+            def service_actions(self):
+                # serve_forever 每轮（最长 poll_interval）调用一次，没攒满的批按刷新间隔写入
+                if self.pending and time.monotonic() - self.first_pending_at >= server.flush_interval:
+                    self.flush()
+
+        udp = UDPServer((self.host, self.udp_port), UDPHandler)
+        return udp
+
+    def start(self):
+        """在后台线程中启动已配置端口的监听"""
+        if self.tcp_port is not None:
+            tcp = socketserver.ThreadingTCPServer((self.host, self.tcp_port), self._make_tcp_handler(),
+                                                  bind_and_activate=False)
+            tcp.allow_reuse_address = True
+            tcp.daemon_threads = True
+            tcp.server_bind()
+            tcp.server_activate()
+            self.servers.append(tcp)
+        if self.udp_port is not None:
+            self.servers.append(self._make_udp_server())
+
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': self.flush_interval},
+                                      name=f'line-ingest-{type(server).__name__}', daemon=True)
+            thread.start()
+        return self
+
+    def addresses(self):
+        """实际监听的 (协议, 端口)，端口配置为0时由系统分配"""
+        return [('udp' if isinstance(server, socketserver.UDPServer) else 'tcp', server.server_address[1])
+                for server in self.servers]
+
+    def stats(self):
+        with self.lock:
+            active = [stats.to_dict() for stats in self.connections.values()]
+            closed = [stats.to_dict() for stats in self.closed]
+        totals = {key: sum(c[key] for c in active + closed)
+                  for key in ('bytes', 'lines', 'accepted', 'rejected', 'batches', 'dropped')}
+        return {
+            'listening': [{'protocol': protocol, 'port': port} for protocol, port in self.addresses()],
+            'batch_size': self.batch_size,
+            'flush_interval': self.flush_interval,
+            'totals': totals,
+            'active': active,
+            'recent_closed': closed
+        }
+
+    def stop(self):
+        self.stop_event.set()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
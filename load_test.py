@@ -0,0 +1,265 @@
+"""
+本地压力测试工具
+模拟 N 个 ESP8266 设备和若干个浏览器仪表盘，对本地运行的服务器施加负载
+
+设备: 按设定频率 POST /sensor-data，并轮询 GET /get-pending-command
+仪表盘: 轮询 GET /sensor-data/latest-id 和 GET /sensor-data
+
+用法:
+    python app_sqlite.py                      # 先在另一个终端启动服务器
+    python load_test.py --devices 20 --rate 1 --duration 60 --db sensor_data.db
+
+输出: 各端点吞吐量、p50/p99延迟、错误率，以及SQLite锁竞争情况
+"""
+import argparse
+import json
+import random
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+
+
+class EndpointStats:
+    """单个端点的统计信息（线程安全）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = defaultdict(int)
+        self.locked_errors = 0
+        self.requests = 0
+
+    def record(self, latency, error=None, locked=False):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if error:
+                self.errors[error] += 1
+            if locked:
+                self.locked_errors += 1
+
+    def summary(self, elapsed):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            error_count = sum(self.errors.values())
+            return {
+                'requests': self.requests,
+                'throughput': self.requests / elapsed if elapsed > 0 else 0,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': (latencies[-1] if latencies else 0) * 1000,
+                'error_rate': error_count / self.requests if self.requests else 0,
+                'errors': dict(self.errors),
+                'locked_errors': self.locked_errors
+            }
+
+
+def percentile(sorted_values, p):
+    """计算已排序列表的百分位数（最近秩法）"""
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class LoadTester:
+    def __init__(self, base_url, devices, rate, command_interval, dashboards,
+                 dashboard_interval, duration, db_path=None, timeout=15):
+        self.base_url = base_url.rstrip('/')
+        self.devices = devices
+        self.rate = rate
+        self.command_interval = command_interval
+        self.dashboards = dashboards
+        self.dashboard_interval = dashboard_interval
+        self.duration = duration
+        self.db_path = db_path
+        self.timeout = timeout
+
+        self.stats = defaultdict(EndpointStats)
+        self.stop_event = threading.Event()
+        self.lock_probe = {'samples': 0, 'busy': 0}
+
+    def request(self, name, method, path, payload=None):
+        """发送HTTP请求并记录延迟和错误，成功时返回响应体"""
+        url = self.base_url + path
+        data = None
+        headers = {}
+        if payload is not None:
+            data = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        req = urllib.request.Request(url, data=data, headers=headers, method=method)
+        start = time.perf_counter()
+        body = None
+        error = None
+        locked = False
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                body = resp.read()
+        except urllib.error.HTTPError as e:
+            error_body = e.read().decode('utf-8', errors='replace')
+            error = f'HTTP {e.code}'
+            # 500: 未经准入控制的写锁超时；503: 准入控制识别出的数据库忙
+            locked = 'database is locked' in error_body or 'database busy' in error_body
+        except Exception as e:
+            error = type(e).__name__
+        self.stats[name].record(time.perf_counter() - start, error, locked)
+        return body
+
+    def device_loop(self, device_index):
+        """模拟单个ESP8266设备：按频率上传数据并轮询指令"""
+        interval = 1.0 / self.rate if self.rate > 0 else None
+        # 错开各设备的启动时间，避免所有请求同时到达
+        next_upload = time.perf_counter() + random.uniform(0, interval or 1)
+        next_command_check = time.perf_counter() + random.uniform(0, self.command_interval)
+
+        while not self.stop_event.is_set():
+            now = time.perf_counter()
+            if interval and now >= next_upload:
+                self.request('POST /sensor-data', 'POST', '/sensor-data', {
+                    'humidity': round(random.uniform(30, 80), 1),
+                    'temperature': round(random.uniform(15, 35), 1),
+                    'light_intensity': random.randint(0, 1023),
+                    'servo_angle': random.choice((0, 30, 60, 90, 120, 150))
+                })
+                next_upload += interval
+            if now >= next_command_check:
+                self.request('GET /get-pending-command', 'GET', '/get-pending-command')
+                next_command_check += self.command_interval
+
+            wait = min(next_upload if interval else next_command_check, next_command_check) - time.perf_counter()
+            if wait > 0:
+                self.stop_event.wait(wait)
+
+    def dashboard_loop(self, dashboard_index):
+        """模拟浏览器仪表盘：轮询最新ID，ID变化时重新拉取数据列表"""
+        last_id = None
+        while not self.stop_event.is_set():
+            body = self.request('GET /sensor-data/latest-id', 'GET', '/sensor-data/latest-id')
+            latest_id = json.loads(body).get('id') if body else None
+            if latest_id != last_id:
+                self.request('GET /sensor-data', 'GET', '/sensor-data')
+                last_id = latest_id
+            self.stop_event.wait(self.dashboard_interval)
+
+    def lock_probe_loop(self):
+        """
+        定期尝试获取SQLite写锁（不等待），统计数据库被占用的比例
+        只读探测：获取锁后立即回滚，不修改数据
+        """
+        while not self.stop_event.is_set():
+            try:
+                conn = sqlite3.connect(self.db_path, timeout=0)
+                try:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.rollback()
+                    busy = False
+                except sqlite3.OperationalError:
+                    busy = True
+                finally:
+                    conn.close()
+                self.lock_probe['samples'] += 1
+                if busy:
+                    self.lock_probe['busy'] += 1
+            except sqlite3.Error:
+                pass
+            self.stop_event.wait(0.05)
+
+    def run(self):
+        threads = []
+        for i in range(self.devices):
+            threads.append(threading.Thread(target=self.device_loop, args=(i,), daemon=True))
+        for i in range(self.dashboards):
+            threads.append(threading.Thread(target=self.dashboard_loop, args=(i,), daemon=True))
+        if self.db_path:
+            threads.append(threading.Thread(target=self.lock_probe_loop, daemon=True))
+
+        print("=" * 60)
+        print(f"压力测试开始: {self.base_url}")
+        print(f"模拟设备: {self.devices} 个, 每个 {self.rate} 次/秒上传, 每 {self.command_interval}s 轮询指令")
+        print(f"模拟仪表盘: {self.dashboards} 个, 每 {self.dashboard_interval}s 轮询")
+        print(f"持续时间: {self.duration}s")
+        print("=" * 60)
+
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        try:
+            self.stop_event.wait(self.duration)
+        except KeyboardInterrupt:
+            print("\n已中断，输出当前结果...")
+        self.stop_event.set()
+        for t in threads:
+            t.join(timeout=self.timeout + 1)
+        elapsed = time.perf_counter() - start
+
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        results = {name: stats.summary(elapsed) for name, stats in sorted(self.stats.items())}
+
+        print(f"\n{'端点':<30}{'请求数':>8}{'吞吐/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'错误率':>9}{'锁错误':>8}")
+        print("-" * 95)
+        total_requests = 0
+        for name, s in results.items():
+            total_requests += s['requests']
+            print(f"{name:<30}{s['requests']:>8}{s['throughput']:>10.1f}{s['p50_ms']:>10.1f}"
+                  f"{s['p99_ms']:>10.1f}{s['max_ms']:>10.1f}{s['error_rate']:>9.2%}{s['locked_errors']:>8}")
+        print("-" * 95)
+        print(f"总计: {total_requests} 个请求, 用时 {elapsed:.1f}s, 总吞吐 {total_requests / elapsed:.1f} 请求/秒")
+
+        for name, s in results.items():
+            if s['errors']:
+                print(f"[ERROR] {name}: {s['errors']}")
+
+        if self.db_path:
+            samples = self.lock_probe['samples']
+            busy = self.lock_probe['busy']
+            ratio = busy / samples if samples else 0
+            print(f"SQLite写锁占用率: {ratio:.2%} ({busy}/{samples} 次探测时数据库正被写入)")
+
+        return {
+            'elapsed': elapsed,
+            'endpoints': results,
+            'lock_probe': dict(self.lock_probe)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟多个ESP8266设备对服务器进行压力测试')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='服务器地址')
+    parser.add_argument('--devices', type=int, default=10, help='模拟设备数量')
+    parser.add_argument('--rate', type=float, default=1.0, help='每个设备每秒上传次数')
+    parser.add_argument('--command-interval', type=float, default=2.0, help='设备轮询指令的间隔(秒)，与固件一致默认2秒')
+    parser.add_argument('--dashboards', type=int, default=2, help='模拟仪表盘数量')
+    parser.add_argument('--dashboard-interval', type=float, default=2.0, help='仪表盘轮询间隔(秒)')
+    parser.add_argument('--duration', type=float, default=30.0, help='测试持续时间(秒)')
+    parser.add_argument('--db', default=None, help='服务器使用的SQLite文件路径，提供时探测写锁竞争')
+    parser.add_argument('--timeout', type=float, default=15.0, help='请求超时(秒)，与固件一致默认15秒')
+    parser.add_argument('--json', default=None, help='将结果保存为JSON文件')
+    args = parser.parse_args()
+
+    tester = LoadTester(
+        base_url=args.url,
+        devices=args.devices,
+        rate=args.rate,
+        command_interval=args.command_interval,
+        dashboards=args.dashboards,
+        dashboard_interval=args.dashboard_interval,
+        duration=args.duration,
+        db_path=args.db,
+        timeout=args.timeout
+    )
+    results = tester.run()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.json}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+非阻塞日志管道
+热路径只把日志记录放入内存队列，由后台线程负责格式化和写出，请求处理过程中不做任何I/O
+
+环境变量配置:
+    LOG_LEVEL       日志级别，默认 INFO
+    LOG_FORMAT      text 或 json，默认 text
+    LOG_SAMPLE      按事件类型采样比例，例如 "command.poll=0.01,sensor.received=0.5"
+    LOG_RATE_LIMIT  按事件类型限速(条/秒)，例如 "sensor.received=5,*=20"，* 为默认值
+    LOG_QUEUE_SIZE  队列容量，队列满时直接丢弃并计数，默认 10000
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOGGER_NAME = 'huapen'
+
+# 默认采样/限速配置：设备轮询类事件量大，默认只保留少量
+DEFAULT_SAMPLE_RATES = {
+    'command.poll': 0.01,
+}
+DEFAULT_RATE_LIMITS = {
+    '*': 20,
+}
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def _parse_mapping(value, cast):
+    """解析 "a=1,b=2" 格式的配置"""
+    result = {}
+    if not value:
+        return result
+    for item in value.split(','):
+        if '=' not in item:
+            continue
+        key, val = item.split('=', 1)
+        try:
+            result[key.strip()] = cast(val.strip())
+        except ValueError:
+            continue
+    return result
+
+
+class EventFilter(logging.Filter):
+    """
+    按事件类型采样和限速（令牌桶）
+    被丢弃的记录数会附加到该事件下一条通过的记录上 (suppressed 字段)
+    """
+
+    def __init__(self, sample_rates=None, rate_limits=None):
+        super().__init__()
+        self.sample_rates = sample_rates or {}
+        self.rate_limits = rate_limits or {}
+        self.default_rate_limit = self.rate_limits.get('*')
+        self.buckets = {}
+        self.suppressed = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None or record.levelno >= logging.ERROR:
+            # 错误日志不采样也不限速
+            return True
+
+        with self.lock:
+            sample_rate = self.sample_rates.get(event)
+            if sample_rate is not None and random.random() >= sample_rate:
+                self.suppressed[event] = self.suppressed.get(event, 0) + 1
+                return False
+
+            limit = self.rate_limits.get(event, self.default_rate_limit)
+            if limit is not None:
+                now = time.monotonic()
+                tokens, last = self.buckets.get(event, (limit, now))
+                tokens = min(limit, tokens + (now - last) * limit)
+                if tokens < 1:
+                    self.buckets[event] = (tokens, now)
+                    self.suppressed[event] = self.suppressed.get(event, 0) + 1
+                    return False
+                self.buckets[event] = (tokens - 1, now)
+
+            suppressed = self.suppressed.pop(event, 0)
+            if suppressed:
+                record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    只入队不格式化：格式化推迟到后台线程
+    队列满时丢弃记录并计数，绝不阻塞请求线程
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    """输出 event 与结构化字段，text 格式为 key=value，json 格式为单行JSON"""
+
+    def __init__(self, fmt='text'):
+        super().__init__()
+        self.fmt = fmt
+
+    def format(self, record):
+        fields = dict(getattr(record, 'fields', None) or {})
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            fields['suppressed'] = suppressed
+        event = getattr(record, 'event', '-')
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created))
+
+        if self.fmt == 'json':
+            payload = {
+                'time': timestamp,
+                'level': record.levelname,
+                'event': event,
+                'message': record.getMessage(),
+            }
+            payload.update(fields)
+            if record.exc_info:
+                payload['exception'] = self.formatException(record.exc_info)
+            return json.dumps(payload, ensure_ascii=False, default=str)
+
+        line = f"{timestamp} {record.levelname} [{event}] {record.getMessage()}"
+        if fields:
+            line += ' ' + ' '.join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+def setup_logging():
+    """初始化日志管道（幂等），返回logger"""
+    global _listener
+
+    logger = logging.getLogger(LOGGER_NAME)
+    with _setup_lock:
+        if _listener is not None:
+            return logger
+
+        level = getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+        sample_rates = dict(DEFAULT_SAMPLE_RATES)
+        sample_rates.update(_parse_mapping(os.environ.get('LOG_SAMPLE'), float))
+        rate_limits = dict(DEFAULT_RATE_LIMITS)
+        rate_limits.update(_parse_mapping(os.environ.get('LOG_RATE_LIMIT'), float))
+        queue_size = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+        log_queue = queue.Queue(maxsize=queue_size)
+        handler = NonBlockingQueueHandler(log_queue)
+        handler.addFilter(EventFilter(sample_rates, rate_limits))
+
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(StructuredFormatter(os.environ.get('LOG_FORMAT', 'text')))
+
+        logger.setLevel(level)
+        logger.addHandler(handler)
+        logger.propagate = False
+
+        _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+    return logger
+
+
+def shutdown_logging():
+    """停止后台线程，写出队列中剩余的日志"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def log_event(event, message, level=logging.INFO, exc_info=None, **fields):
+    """
+    记录一条结构化日志
+    event: 事件类型（用于采样和限速），如 'sensor.received'
+    fields: 结构化字段，原样交给后台线程格式化
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, message, exc_info=exc_info, extra={'event': event, 'fields': fields})
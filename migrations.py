@@ -0,0 +1,233 @@
+"""
+数据库结构迁移
+以 PRAGMA user_version 记录已应用的版本，每个迁移在一个写事务内执行并同时更新版本号：
+中断时整步回滚，下次启动从这一步继续；步骤本身也写成幂等的，对旧版本代码建立的库重复执行不会出错
+多个worker同时启动时用文件锁串行化，只有一个进程执行迁移，数据库已是最新版本时只读取一次版本号
+"""
+import sqlite3
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，只依靠 BEGIN IMMEDIATE 串行化
+    fcntl = None
+
+
+def _table_exists(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+
+def _column_exists(cursor, table, column):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return any(row[1] == column for row in cursor.fetchall())
+
+
+def _create_sensor_data(cursor, db):
+    # 创建传感器数据表，添加年月日时字段
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            humidity REAL NOT NULL,
+            temperature REAL NOT NULL,
+            light_intensity INTEGER NOT NULL,
+            servo_angle INTEGER DEFAULT 0,
+            timestamp TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            hour INTEGER NOT NULL,
+            date_key TEXT NOT NULL,
+            datetime_key TEXT NOT NULL
+        )
+    ''')
+    # 早期版本的表没有servo_angle字段
+    if not _column_exists(cursor, 'sensor_data', 'servo_angle'):
+        cursor.execute('ALTER TABLE sensor_data ADD COLUMN servo_angle INTEGER DEFAULT 0')
+
+
+def _create_indexes(cursor, db):
+    # 创建索引以提高查询性能
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON sensor_data(timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON sensor_data(created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_year ON sensor_data(year)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_month ON sensor_data(year, month)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_day ON sensor_data(year, month, day)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_date_key ON sensor_data(date_key)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_hour ON sensor_data(year, month, day, hour)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_datetime_key ON sensor_data(datetime_key)')
+
+
+def _create_sketches(cursor, db):
+    # 每天每个指标的分位数草图 (t-digest)，入库时增量更新
+    exists = _table_exists(cursor, 'sensor_sketches')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_sketches (
+            date_key TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            sketch BLOB NOT NULL,
+            PRIMARY KEY (date_key, metric)
+        )
+    ''')
+    if not exists:
+        # 首次创建时为已有数据回填草图（已存在的表可能包含已归档日期，不能按热库重建）
+        db._rebuild_sketches(cursor)
+
+
+def _create_stats(cursor, db):
+    # 全表统计的累计值（单行），入库时增量更新，删除后标记为dirty并在下次读取时重算
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_count INTEGER NOT NULL DEFAULT 0,
+            sum_humidity REAL NOT NULL DEFAULT 0,
+            min_humidity REAL,
+            max_humidity REAL,
+            sum_temperature REAL NOT NULL DEFAULT 0,
+            min_temperature REAL,
+            max_temperature REAL,
+            sum_light REAL NOT NULL DEFAULT 0,
+            min_light INTEGER,
+            max_light INTEGER,
+            sum_servo REAL NOT NULL DEFAULT 0,
+            min_servo INTEGER,
+            max_servo INTEGER,
+            first_record TEXT,
+            last_record TEXT,
+            dirty INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # 新建时标记为dirty，首次读取时根据已有数据计算
+    cursor.execute('INSERT OR IGNORE INTO sensor_stats (id, dirty) VALUES (1, 1)')
+
+
+def _create_calendar(cursor, db):
+    # 日历索引：每个(日期, 小时)的记录数和id边界，入库时upsert，保留期删除时调整
+    exists = _table_exists(cursor, 'sensor_calendar')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_calendar (
+            date_key TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            PRIMARY KEY (date_key, hour)
+        )
+    ''')
+    if not exists:
+        db._rebuild_calendar(cursor)
+
+
+def _create_ingest_keys(cursor, db):
+    # 入库幂等键：设备重试同一条数据时返回原记录而不是重复插入
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_keys (
+            key TEXT PRIMARY KEY,
+            data_id INTEGER,
+            created_at TEXT NOT NULL
+        )
+    ''')
+
+
+def _create_command_history(cursor, db):
+    # 指令生命周期: queued → fetched → acked，未送达就被新指令覆盖的标记为 superseded
+    # 时间为epoch秒，便于直接计算延迟
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS command_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            command TEXT NOT NULL,
+            source TEXT,
+            status TEXT NOT NULL,
+            queued_at REAL NOT NULL,
+            fetched_at REAL,
+            acked_at REAL,
+            result TEXT
+        )
+    ''')
+
+
+def _create_gaps(cursor, db):
+    # 断线索引：相邻两条读数间隔超过阈值时记一条，入库时增量追加；liveness 为单行，记录最后一条读数
+    # 回填需要读取分片，由 SensorDatabase 在启用分片之后完成（gap_threshold 为空时重建）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_gaps (
+            start_id INTEGER PRIMARY KEY,
+            end_id INTEGER NOT NULL,
+            start_at TEXT NOT NULL,
+            end_at TEXT NOT NULL,
+            seconds INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_gaps_end_at ON sensor_gaps(end_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_liveness (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_id INTEGER,
+            last_seen TEXT,
+            gap_threshold INTEGER
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO sensor_liveness (id) VALUES (1)')
+
+
+# (版本号, 名称, 迁移函数)，只能在末尾追加，已发布的步骤不要修改
+MIGRATIONS = [
+    (1, 'sensor_data', _create_sensor_data),
+    (2, 'sensor_data_indexes', _create_indexes),
+    (3, 'sensor_sketches', _create_sketches),
+    (4, 'sensor_stats', _create_stats),
+    (5, 'sensor_calendar', _create_calendar),
+    (6, 'ingest_keys', _create_ingest_keys),
+    (7, 'command_history', _create_command_history),
+    (8, 'sensor_gaps', _create_gaps),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(db_path):
+    conn = sqlite3.connect(db_path)
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    conn.close()
+    return version
+
+
+def migrate(db):
+    """
+    执行 db (SensorDatabase) 尚未应用的迁移，返回本次应用的迁移名称列表
+    已是最新版本时不加锁、不执行任何DDL
+    """
+    if get_version(db.db_path) >= LATEST_VERSION:
+        return []
+
+    lock_file = open(db.db_path + '.migrate.lock', 'w')
+    try:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        applied = []
+        conn = sqlite3.connect(db.db_path, isolation_level=None, timeout=30)
+        cursor = conn.cursor()
+        try:
+            for version, name, step in MIGRATIONS:
+                cursor.execute('BEGIN IMMEDIATE')
+                # 拿到写锁后重新读取版本号，其他进程可能已经完成了这一步
+                current = cursor.execute('PRAGMA user_version').fetchone()[0]
+                if current >= version:
+                    cursor.execute('COMMIT')
+                    continue
+                try:
+                    step(cursor, db)
+                    cursor.execute(f'PRAGMA user_version = {version}')
+                    cursor.execute('COMMIT')
+                except Exception:
+                    cursor.execute('ROLLBACK')
+                    raise
+                applied.append(name)
+        finally:
+            conn.close()
+        return applied
+    finally:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
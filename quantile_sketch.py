@@ -0,0 +1,190 @@
+"""
+可合并的分位数草图 (t-digest, merging 变体)
+每天每个指标维护一个草图，入库时增量更新，查询任意日期范围时合并即可得到 p50/p90/p99
+持久化为紧凑的二进制格式 (头部 + float64 数组)，入库时的读写不需要逐元素解析
+"""
+import math
+import struct
+from array import array
+
+# 头部: compression, count, min, max, 质心数, 缓冲区长度
+_HEADER = struct.Struct('<dQddII')
+
+
+class TDigest:
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.centroids = []     # [[mean, weight], ...]，按mean升序
+        self.buffer = []        # 尚未合并的原始值
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight=1):
+        """添加一个值，缓冲区满时压缩"""
+        value = float(value)
+        if weight == 1:
+            self.buffer.append(value)
+        else:
+            self.centroids.append([value, weight])
+        self.count += weight
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.buffer) >= self.compression * 2:
+            self.compress()
+
+    def extend(self, values):
+        """批量添加一组值（权重为1），缓冲区满时只压缩一次"""
+        values = [float(value) for value in values]
+        if not values:
+            return
+        self.buffer.extend(values)
+        self.count += len(values)
+        low, high = min(values), max(values)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        if len(self.buffer) >= self.compression * 2:
+            self.compress()
+
+    def merge(self, other):
+        """合并另一个草图（原地修改并返回self）"""
+        if other.count == 0:
+            return self
+        self.centroids.extend([list(c) for c in other.centroids])
+        self.buffer.extend(other.buffer)
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.compress()
+        return self
+
+    def compress(self):
+        """将缓冲区和现有质心按 t-digest 大小约束重新合并"""
+        items = self.centroids + [[v, 1] for v in self.buffer]
+        self.buffer = []
+        if not items:
+            self.centroids = []
+            return
+        items.sort(key=lambda c: c[0])
+
+        total = self.count
+        merged = [list(items[0])]
+        cumulative = 0.0
+        for mean, weight in items[1:]:
+            current = merged[-1]
+            proposed = current[1] + weight
+            q = (cumulative + proposed / 2.0) / total
+            # 质心权重上限: 4 * N * q * (1 - q) / δ，两端更小以保证尾部精度
+            limit = max(1.0, 4.0 * total * q * (1.0 - q) / self.compression)
+            if proposed <= limit:
+                current[0] += (mean - current[0]) * weight / proposed
+                current[1] = proposed
+            else:
+                cumulative += current[1]
+                merged.append([mean, weight])
+        self.centroids = merged
+
+    def quantile(self, q):
+        """估算分位数，q取值0~1"""
+        if self.buffer:
+            self.compress()
+        if not self.centroids:
+            return None
+        if len(self.centroids) == 1 or q <= 0:
+            return self.min if q <= 0 else self.centroids[0][0]
+        if q >= 1:
+            return self.max
+
+        target = q * self.count
+        cumulative = 0.0
+        for i, (mean, weight) in enumerate(self.centroids):
+            center = cumulative + weight / 2.0
+            if target < center:
+                if i == 0:
+                    # 第一个质心之前，在最小值和质心中心之间插值
+                    return self._interpolate(self.min, 0.0, mean, center, target)
+                prev_mean, prev_weight = self.centroids[i - 1]
+                prev_center = cumulative - prev_weight / 2.0
+                return self._interpolate(prev_mean, prev_center, mean, center, target)
+            cumulative += weight
+        last_mean, last_weight = self.centroids[-1]
+        return self._interpolate(last_mean, self.count - last_weight / 2.0, self.max, self.count, target)
+
+    @staticmethod
+    def _interpolate(x0, y0, x1, y1, y):
+        if y1 <= y0:
+            return x1
+        return x0 + (x1 - x0) * (y - y0) / (y1 - y0)
+
+    def to_bytes(self):
+        means = array('d', (c[0] for c in self.centroids))
+        weights = array('d', (c[1] for c in self.centroids))
+        buffer = array('d', self.buffer)
+        header = _HEADER.pack(
+            self.compression,
+            int(self.count),
+            math.nan if self.min is None else self.min,
+            math.nan if self.max is None else self.max,
+            len(means),
+            len(buffer)
+        )
+        return header + means.tobytes() + weights.tobytes() + buffer.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        compression, count, min_value, max_value, n_centroids, n_buffer = _HEADER.unpack_from(data)
+        values = array('d')
+        values.frombytes(memoryview(data)[_HEADER.size:])
+
+        digest = cls(int(compression))
+        digest.count = count
+        digest.min = None if math.isnan(min_value) else min_value
+        digest.max = None if math.isnan(max_value) else max_value
+        means = values[:n_centroids]
+        weights = values[n_centroids:2 * n_centroids]
+        digest.centroids = [[m, w] for m, w in zip(means, weights)]
+        digest.buffer = values[2 * n_centroids:2 * n_centroids + n_buffer].tolist()
+        return digest
+
+
+def append_values(data, values, compression=100):
+    """
+    向序列化的草图追加一批值，返回新的序列化数据
+    缓冲区未满时只更新头部并拼接字节，不解码质心；满时才完整解码并压缩
+    """
+    if data is None:
+        digest = TDigest(compression)
+        digest.extend(values)
+        return digest.to_bytes()
+
+    d, count, min_value, max_value, n_centroids, n_buffer = _HEADER.unpack_from(data)
+    if n_buffer + len(values) >= d * 2:
+        digest = TDigest.from_bytes(data)
+        digest.extend(values)
+        return digest.to_bytes()
+
+    values = array('d', values)
+    low, high = min(values), max(values)
+    header = _HEADER.pack(
+        d,
+        count + len(values),
+        low if math.isnan(min_value) else min(min_value, low),
+        high if math.isnan(max_value) else max(max_value, high),
+        n_centroids,
+        n_buffer + len(values)
+    )
+    return header + memoryview(data)[_HEADER.size:].tobytes() + values.tobytes()
+
+
+def summarize(digest, quantiles=(0.5, 0.9, 0.99)):
+    """草图的统计摘要: count/min/max 及各分位数"""
+    result = {
+        'count': digest.count,
+        'min': digest.min,
+        'max': digest.max
+    }
+    for q in quantiles:
+        value = digest.quantile(q)
+        key = f"p{q * 100:g}".replace('.', '_')
+        result[key] = round(value, 2) if value is not None and not math.isnan(value) else None
+    return result
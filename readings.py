@@ -0,0 +1,98 @@
+"""
+传感器读数的紧凑表示
+查询结果不再为每行构造一个13键的字典：单条记录用 __slots__ 的 SensorReading，
+批量结果用按列存储的 ReadingBatch（数值列为 array，字符串列为元组），
+只在返回JSON或写文件时才按需要的字段转换为字典
+"""
+from array import array
+
+# 字段顺序与 SELECT id, humidity, ..., datetime_key 的列顺序一致
+FIELDS = ('id', 'humidity', 'temperature', 'light_intensity', 'servo_angle', 'timestamp', 'created_at',
+          'year', 'month', 'day', 'hour', 'date_key', 'datetime_key')
+
+# 数值列的数组类型；其余为字符串列
+COLUMN_TYPES = {
+    'id': 'q',
+    'humidity': 'd',
+    'temperature': 'd',
+    'light_intensity': 'q',
+    'servo_angle': 'q',
+    'year': 'q',
+    'month': 'q',
+    'day': 'q',
+    'hour': 'q',
+}
+
+# 大量重复的字符串列
+SHARED_COLUMNS = ('date_key', 'datetime_key')
+
+
+def _column(name, values):
+    """
+    把一列值打包为定长数组；SQLite是动态类型，列中出现NULL或小数（如带小数的光照）时
+    保留为元组，保证转换回JSON的值与数据库中的完全一致
+    """
+    typecode = COLUMN_TYPES.get(name)
+    if typecode is None:
+        if name in SHARED_COLUMNS:
+            # 每行都是新的字符串对象，同一天/同一小时的值只保留一份
+            shared = {}
+            return tuple([shared.setdefault(value, value) for value in values])
+        return values
+    try:
+        return array(typecode, values)
+    except (TypeError, OverflowError):
+        return values
+
+
+class SensorReading:
+    """一条传感器记录"""
+    __slots__ = FIELDS
+
+    def __init__(self, *values):
+        for name, value in zip(FIELDS, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"SensorReading(id={self.id}, created_at={self.created_at!r})"
+
+    def to_dict(self, fields=FIELDS):
+        return {name: getattr(self, name) for name in fields}
+
+
+class ReadingBatch:
+    """按列存储的一组传感器记录，顺序与查询结果一致"""
+    __slots__ = ('columns', 'count')
+
+    def __init__(self, rows=()):
+        """rows: 按 FIELDS 顺序的行元组列表"""
+        self.count = len(rows)
+        columns = zip(*rows) if rows else [() for _ in FIELDS]
+        self.columns = {name: _column(name, values) for name, values in zip(FIELDS, columns)}
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('ReadingBatch index out of range')
+        return SensorReading(*(self.columns[name][index] for name in FIELDS))
+
+    def __iter__(self):
+        for values in zip(*(self.columns[name] for name in FIELDS)):
+            yield SensorReading(*values)
+
+    def to_dicts(self, fields=FIELDS, reverse=False):
+        """
+        转换为字典列表，用于JSON响应和文件导出
+        fields: 输出的字段及顺序；reverse: 按相反顺序输出（查询为id降序，前端需要最新数据在后）
+        """
+        columns = [self.columns[name] for name in fields]
+        if reverse:
+            columns = [reversed(column) for column in columns]
+        return [dict(zip(fields, values)) for values in zip(*columns)]
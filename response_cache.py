@@ -0,0 +1,125 @@
+"""
+历史时段查询的响应缓存
+按查询路径缓存序列化后的JSON响应，条目数和总字节数都有上限 (LRU)
+已结束的日期/小时不会再变化，缓存到被淘汰为止；当前时段的条目在入库、保留期删除和清空时失效
+"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import pytz
+
+BEIJING_TZ = pytz.timezone('Asia/Shanghai')
+
+
+def period_closed(date_key, hour=None, now=None):
+    """按北京时间判断日期（或日期中的某个小时）是否已经结束"""
+    now = now or datetime.now(BEIJING_TZ)
+    today = now.strftime('%Y-%m-%d')
+    if hour is None:
+        return date_key < today
+    return date_key < today or (date_key == today and hour < now.hour)
+
+
+class ResponseCache:
+    def __init__(self, max_entries=256, max_bytes=16 * 1024 * 1024, open_ttl=5.0):
+        """
+        open_ttl: 当前时段条目的最长存活秒数；同一进程内入库会立即使其失效，
+        这个上限用于覆盖其他worker进程写入的情况
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.open_ttl = open_ttl
+        self.entries = OrderedDict()    # key -> (body, date_key, closed, stored_at)
+        self.open_keys = {}             # date_key -> 当前时段条目的key集合
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        # 每次失效递增；查询期间发生过失效（写入、删除、清空）时不缓存结果，避免写入过期数据
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                body, date_key, closed, stored_at = entry
+                if closed or time.monotonic() - stored_at < self.open_ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return body
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, body, date_key, closed, generation=None):
+        """
+        generation: 开始查询前读取的 self.generation，之后发生过失效时丢弃这次结果
+        closed: 按开始查询时的时间判断时段是否已结束
+        """
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (body, date_key, closed, time.monotonic())
+            self.total_bytes += len(body)
+            if not closed:
+                self.open_keys.setdefault(date_key, set()).add(key)
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        body, date_key, closed, _ = self.entries.pop(key)
+        self.total_bytes -= len(body)
+        if not closed:
+            keys = self.open_keys.get(date_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.open_keys[date_key]
+
+    def invalidate_date(self, date_key):
+        """使某天仍在进行中的条目失效（新数据写入该天时调用）"""
+        with self.lock:
+            self.generation += 1
+            for key in list(self.open_keys.get(date_key, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.open_keys.clear()
+            self.total_bytes = 0
+
+    def on_data_change(self, event, date_key=None):
+        """SensorDatabase 的数据变更回调：写入只影响当天，删除和清空使全部条目失效"""
+        if event == 'insert' and date_key is not None:
+            self.invalidate_date(date_key)
+        else:
+            self.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'open_entries': sum(len(keys) for keys in self.open_keys.values()),
+                'bytes': self.total_bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'invalidations': self.invalidations,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,156 @@
+"""
+自动化规则引擎
+每条规则编译为一个比较函数和少量状态，入库时对每条读数逐条规则求值，每条规则 O(1)
+规则示例（湿度低于30持续10分钟则浇水5秒，湿度回到35以上才重新生效，两次触发至少间隔30分钟）:
+    {
+        "name": "dry-soil",
+        "metric": "humidity",
+        "op": "<",
+        "threshold": 30,
+        "clear_threshold": 35,
+        "for_seconds": 600,
+        "cooldown_seconds": 1800,
+        "command": "Watering_5"
+    }
+"""
+import json
+import operator
+import os
+import threading
+import time
+
+METRICS = ('humidity', 'temperature', 'light_intensity', 'servo_angle')
+COMMAND_PREFIXES = ('Dataup_', 'Watering_', 'ServoTurnTo_')
+
+OPERATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge
+}
+
+
+class Rule:
+    """编译后的规则及其运行状态"""
+
+    def __init__(self, spec):
+        self.spec = self.validate(spec)
+        self.name = self.spec['name']
+        self.metric = self.spec['metric']
+        self.threshold = self.spec['threshold']
+        self.compare = OPERATORS[self.spec['op']]
+        # 回滞: 触发后数值要越过 clear_threshold 才重新生效，默认与 threshold 相同
+        clear = self.spec.get('clear_threshold', self.threshold)
+        below = self.spec['op'] in ('<', '<=')
+        self.cleared = (lambda v: v >= clear) if below else (lambda v: v <= clear)
+        self.for_seconds = self.spec.get('for_seconds', 0)
+        self.cooldown_seconds = self.spec.get('cooldown_seconds', 0)
+        self.command = self.spec['command']
+        self.enabled = self.spec.get('enabled', True)
+
+        self.active_since = None    # 条件开始连续成立的时间
+        self.armed = True           # 触发后置为False，越过回滞阈值后恢复
+        self.last_fired = None
+        self.fire_count = 0
+
+    @staticmethod
+    def validate(spec):
+        if not isinstance(spec, dict):
+            raise ValueError('Rule must be an object')
+        for field in ('name', 'metric', 'op', 'threshold', 'command'):
+            if field not in spec:
+                raise ValueError(f'Rule is missing required field: {field}')
+        if spec['metric'] not in METRICS:
+            raise ValueError(f"Unknown metric in rule {spec['name']}: {spec['metric']}")
+        if spec['op'] not in OPERATORS:
+            raise ValueError(f"Unsupported operator in rule {spec['name']}: {spec['op']}")
+        if not str(spec['command']).startswith(COMMAND_PREFIXES):
+            raise ValueError(f"Invalid command format in rule {spec['name']}: {spec['command']}")
+        for field in ('threshold', 'clear_threshold', 'for_seconds', 'cooldown_seconds'):
+            if field in spec and (isinstance(spec[field], bool) or not isinstance(spec[field], (int, float))):
+                raise ValueError(f"Field {field} in rule {spec['name']} must be a number")
+        return dict(spec)
+
+    def evaluate(self, value, now):
+        """用一条读数更新状态，需要触发时返回True"""
+        if not self.enabled or value is None:
+            return False
+        if not self.compare(value, self.threshold):
+            self.active_since = None
+            if not self.armed and self.cleared(value):
+                self.armed = True
+            return False
+
+        if self.active_since is None:
+            self.active_since = now
+        if not self.armed or now - self.active_since < self.for_seconds:
+            return False
+        if self.last_fired is not None and now - self.last_fired < self.cooldown_seconds:
+            return False
+
+        self.armed = False
+        self.last_fired = now
+        self.fire_count += 1
+        return True
+
+    def status(self):
+        return {
+            'rule': self.spec,
+            'armed': self.armed,
+            'active_since': self.active_since,
+            'last_fired': self.last_fired,
+            'fire_count': self.fire_count
+        }
+
+
+class RuleEngine:
+    def __init__(self, rules_path=None, dispatch=None):
+        """
+        rules_path: 规则文件（JSON数组），不存在时没有规则
+        dispatch: dispatch(command, rule_name)，规则触发时调用
+        """
+        self.rules_path = rules_path
+        self.dispatch = dispatch
+        self.rules = []
+        self.lock = threading.Lock()
+        if rules_path and os.path.exists(rules_path):
+            with open(rules_path, 'r', encoding='utf-8') as f:
+                self.set_rules(json.load(f), save=False)
+
+    def set_rules(self, specs, save=True):
+        """编译并替换全部规则；定义未变化的规则保留运行状态"""
+        if not isinstance(specs, list):
+            raise ValueError('Rules must be a list')
+        compiled = [Rule(spec) for spec in specs]
+        names = [rule.name for rule in compiled]
+        if len(set(names)) != len(names):
+            raise ValueError('Rule names must be unique')
+
+        with self.lock:
+            previous = {rule.name: rule for rule in self.rules}
+            self.rules = [
+                previous[rule.name] if rule.name in previous and previous[rule.name].spec == rule.spec else rule
+                for rule in compiled
+            ]
+        if save and self.rules_path:
+            tmp_path = self.rules_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump([rule.spec for rule in compiled], f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.rules_path)
+
+    def evaluate(self, reading, now=None):
+        """对一条读数求值所有规则，返回触发的 [(规则名, 指令), ...]"""
+        now = time.time() if now is None else now
+        fired = []
+        with self.lock:
+            for rule in self.rules:
+                if rule.evaluate(reading.get(rule.metric), now):
+                    fired.append((rule.name, rule.command))
+        if self.dispatch:
+            for name, command in fired:
+                self.dispatch(command, name)
+        return fired
+
+    def status(self):
+        with self.lock:
+            return [rule.status() for rule in self.rules]
@@ -0,0 +1,179 @@
+"""
+按月分片存储
+分片模式下传感器数据按北京时间月份写入各自的SQLite文件 (shards/sensor_data_YYYY-MM.db)，
+主库只保留统计、日历、草图、幂等键和指令历史；id仍由主库统一分配，全局递增。
+查询按月份依次在相关分片上执行并拼接结果；保留期清理直接删除整月的分片文件，
+备份时已结束月份的分片不再变化，只需复制一次
+"""
+import glob
+import os
+import re
+import shutil
+import sqlite3
+from urllib.request import pathname2url
+
+SHARD_PATTERN = re.compile(r'^sensor_data_(\d{4}-\d{2})\.db$')
+
+# 分片的表结构与主库的sensor_data一致；id由主库分配，不使用AUTOINCREMENT
+# 每个分片只有一个月的数据，年/月索引没有意义，只保留按时间和日期键查询用的索引
+SHARD_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS sensor_data (
+        id INTEGER PRIMARY KEY,
+        humidity REAL NOT NULL,
+        temperature REAL NOT NULL,
+        light_intensity INTEGER NOT NULL,
+        servo_angle INTEGER DEFAULT 0,
+        timestamp TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        month INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        hour INTEGER NOT NULL,
+        date_key TEXT NOT NULL,
+        datetime_key TEXT NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_created_at ON sensor_data(created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_date_key ON sensor_data(date_key)',
+    'CREATE INDEX IF NOT EXISTS idx_datetime_key ON sensor_data(datetime_key)',
+)
+
+
+def month_of(date_key):
+    """日期键 (YYYY-MM-DD) 或时间字符串所在的月份 (YYYY-MM)"""
+    return date_key[:7]
+
+
+class MonthlyShards:
+    def __init__(self, shard_dir):
+        self.shard_dir = os.path.abspath(shard_dir)
+        self.created = set()    # 本进程已确认建表的月份
+
+    def path_for(self, month):
+        return os.path.join(self.shard_dir, f"sensor_data_{month}.db")
+
+    def months(self, start=None, end=None):
+        """已存在的分片月份（升序），start/end 为月份或日期，含两端"""
+        months = []
+        for path in glob.glob(os.path.join(self.shard_dir, 'sensor_data_*.db')):
+            match = SHARD_PATTERN.match(os.path.basename(path))
+            if match:
+                months.append(match.group(1))
+        months.sort()
+        if start:
+            months = [m for m in months if m >= month_of(start)]
+        if end:
+            months = [m for m in months if m <= month_of(end)]
+        return months
+
+    def ensure(self, month):
+        """确保某月的分片文件和表结构存在，返回文件路径"""
+        path = self.path_for(month)
+        if month not in self.created or not os.path.exists(path):
+            os.makedirs(self.shard_dir, exist_ok=True)
+            conn = sqlite3.connect(path)
+            for statement in SHARD_SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            conn.close()
+            self.created.add(month)
+        return path
+
+    def connect(self, month, read_only=False):
+        path = self.path_for(month)
+        if read_only:
+            return sqlite3.connect(f"file:{pathname2url(path)}?mode=ro", uri=True)
+        return sqlite3.connect(path)
+
+    def query(self, sql, params=(), months=None, limit=None, descending=True, read_only=False):
+        """
+        在各月份分片上执行同一条查询并拼接结果
+        分片之间时间不重叠且id随时间递增，按月份顺序拼接即保持 ORDER BY id 的顺序
+        months: 只查询这些月份（不存在的忽略），默认全部分片
+        limit: 给定时sql必须以 LIMIT ? 结尾，每个分片只取还差的行数，取够即停
+        """
+        existing = self.months()
+        if months is not None:
+            wanted = set(months)
+            existing = [m for m in existing if m in wanted]
+
+        rows = []
+        for month in sorted(existing, reverse=descending):
+            if limit is not None and len(rows) >= limit:
+                break
+            conn = self.connect(month, read_only)
+            try:
+                shard_params = [*params, limit - len(rows)] if limit is not None else params
+                rows.extend(conn.execute(sql, shard_params).fetchall())
+            finally:
+                conn.close()
+        return rows
+
+    def iter_chunks(self, sql, params=(), months=None, descending=True, chunk_size=5000, read_only=False):
+        """与 query 相同的拼接顺序，但每个分片用 fetchmany 分批返回，不把全部结果读入内存"""
+        existing = self.months()
+        if months is not None:
+            wanted = set(months)
+            existing = [m for m in existing if m in wanted]
+
+        for month in sorted(existing, reverse=descending):
+            conn = self.connect(month, read_only)
+            try:
+                cursor = conn.execute(sql, params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                conn.close()
+
+    def count(self, month):
+        conn = self.connect(month, read_only=True)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM sensor_data').fetchone()[0]
+        finally:
+            conn.close()
+
+    def drop(self, month):
+        """删除整月的分片文件，返回其中的记录数"""
+        path = self.path_for(month)
+        if not os.path.exists(path):
+            return 0
+        count = self.count(month)
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+        self.created.discard(month)
+        return count
+
+    def backup(self, backup_dir, active_month):
+        """
+        备份分片到 backup_dir：已结束月份的分片不再写入，备份中已有大小和修改时间一致的副本时跳过；
+        当月分片用在线备份重新复制
+        返回本次复制的月份列表
+        """
+        os.makedirs(backup_dir, exist_ok=True)
+        copied = []
+        for month in self.months():
+            source_path = self.path_for(month)
+            target_path = os.path.join(backup_dir, os.path.basename(source_path))
+            if month < active_month:
+                if os.path.exists(target_path):
+                    source_stat, target_stat = os.stat(source_path), os.stat(target_path)
+                    if (source_stat.st_size, int(source_stat.st_mtime)) == (target_stat.st_size, int(target_stat.st_mtime)):
+                        continue
+                shutil.copy2(source_path, target_path)
+            else:
+                source = self.connect(month, read_only=True)
+                target = sqlite3.connect(target_path)
+                try:
+                    source.backup(target, pages=1024)
+                finally:
+                    target.close()
+                    source.close()
+            copied.append(month)
+        return copied
@@ -0,0 +1,98 @@
+"""
+已结束日期的预渲染快照
+北京时间某天结束后，该天 /sensor-data/date/<date_key> 的响应不再变化；
+后台线程把它写成 .json 和 .json.gz 文件，读请求直接用 send_file 发送，不再查询数据库
+"""
+import glob
+import gzip
+import os
+import re
+import threading
+
+from response_cache import period_closed
+
+DATE_KEY_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+class SnapshotStore:
+    def __init__(self, snapshot_dir, render, interval=300):
+        """
+        render: render(date_key) -> bytes，返回与接口完全一致的响应体
+        interval: 后台检查新结束日期的间隔秒数
+        """
+        self.snapshot_dir = os.path.abspath(snapshot_dir)
+        self.render = render
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def path_for(self, date_key, compressed=False):
+        """已存在的快照文件路径；日期未结束或尚未生成时返回None"""
+        if not DATE_KEY_PATTERN.match(date_key) or not period_closed(date_key):
+            return None
+        path = os.path.join(self.snapshot_dir, f"{date_key}.json.gz" if compressed else f"{date_key}.json")
+        return path if os.path.exists(path) else None
+
+    def write(self, date_key):
+        """写入一天的快照（先写临时文件再原子替换，多个worker同时写也不会读到半个文件）"""
+        body = self.render(date_key)
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        base = os.path.join(self.snapshot_dir, f"{date_key}.json")
+        suffix = f".{os.getpid()}.tmp"
+        with open(base + '.gz' + suffix, 'wb') as f:
+            # mtime固定为0，同一内容的压缩结果稳定
+            with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gz:
+                gz.write(body)
+        with open(base + suffix, 'wb') as f:
+            f.write(body)
+        os.replace(base + '.gz' + suffix, base + '.gz')
+        os.replace(base + suffix, base)
+
+    def run_once(self, db):
+        """为所有已结束但还没有快照的日期生成快照，返回生成的天数"""
+        written = 0
+        with self.lock:
+            for item in db.get_available_dates():
+                date_key = item['date_key']
+                if not period_closed(date_key):
+                    continue
+                if os.path.exists(os.path.join(self.snapshot_dir, f"{date_key}.json")):
+                    continue
+                self.write(date_key)
+                written += 1
+        return written
+
+    def prune(self):
+        """删除全部快照（数据被删除或清空时调用），后台任务会按剩余数据重新生成"""
+        with self.lock:
+            for path in glob.glob(os.path.join(self.snapshot_dir, '*.json*')):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def on_data_change(self, event, date_key=None):
+        """SensorDatabase 的数据变更回调：新写入只影响当天，不涉及快照"""
+        if event != 'insert':
+            self.prune()
+
+    def start(self, db):
+        """启动后台线程"""
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._loop, args=(db,), name='snapshot-writer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _loop(self, db):
+        while not self.stop_event.is_set():
+            try:
+                written = self.run_once(db)
+                if written:
+                    print(f"已生成 {written} 天的数据快照")
+            except Exception as e:
+                print(f"Error writing snapshots: {str(e)}")
+            self.stop_event.wait(self.interval)
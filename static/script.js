@@ -11,6 +11,12 @@ let currentLatestId = null; // 当前最新数据ID
 let isUpdating = false;     // 是否正在更新数据
 let updateAttempts = 0;     // 更新尝试次数
 
+// 本地缓存 (IndexedDB)：保存已下载的全部数据，刷新时只向服务器获取新增数据
+const CACHE_DB_NAME = 'sensorDataCache';
+const CACHE_STORE = 'readings';
+let cacheDbPromise = null;
+let cachedData = null;      // 缓存中的全部数据（按id升序），null表示尚未从IndexedDB读取
+
 // 轮询配置
 const POLLING_CONFIG = {
     initialDelay: 10000,    // 初始延迟10秒
@@ -129,7 +135,57 @@ function initializeChart() {
     });
 }
 
-// 加载数据
+// 打开本地缓存数据库，浏览器不支持或打开失败时返回null（退化为直接请求）
+function openCacheDb() {
+    if (!('indexedDB' in window)) {
+        return Promise.resolve(null);
+    }
+    if (!cacheDbPromise) {
+        cacheDbPromise = new Promise((resolve) => {
+            const request = indexedDB.open(CACHE_DB_NAME, 1);
+            request.onupgradeneeded = () => {
+                request.result.createObjectStore(CACHE_STORE, { keyPath: 'id' });
+            };
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => resolve(null);
+        });
+    }
+    return cacheDbPromise;
+}
+
+// 读取缓存的全部数据（按主键id升序）
+async function readCachedData() {
+    const cacheDb = await openCacheDb();
+    if (!cacheDb) {
+        return [];
+    }
+    return new Promise((resolve) => {
+        const request = cacheDb.transaction(CACHE_STORE, 'readonly').objectStore(CACHE_STORE).getAll();
+        request.onsuccess = () => resolve(request.result || []);
+        request.onerror = () => resolve([]);
+    });
+}
+
+// 写入缓存，replace为true时先清空（全量同步）
+async function writeCachedData(rows, replace = false) {
+    const cacheDb = await openCacheDb();
+    if (!cacheDb) {
+        return;
+    }
+    return new Promise((resolve) => {
+        const tx = cacheDb.transaction(CACHE_STORE, 'readwrite');
+        const store = tx.objectStore(CACHE_STORE);
+        if (replace) {
+            store.clear();
+        }
+        rows.forEach(row => store.put(row));
+        tx.oncomplete = () => resolve();
+        tx.onerror = () => resolve();
+        tx.onabort = () => resolve();
+    });
+}
+
+// 加载数据：本地缓存 + 增量同步 (?since_id=)
 async function loadData() {
     // 如果处于查询状态，不自动刷新
     if (currentQuery) {
@@ -140,13 +196,35 @@ async function loadData() {
         updateStatus('loading');
         addLog('info', '📡 开始获取ESP8266转发的Arduino Nano传感器数据');
 
-        const response = await fetch('/sensor-data');
+        if (cachedData === null) {
+            cachedData = await readCachedData();
+        }
+
+        const sinceId = cachedData.length > 0 ? cachedData[cachedData.length - 1].id : 0;
+        const response = await fetch(`/sensor-data?since_id=${sinceId}`);
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
         const result = await response.json();
-        sensorData = result.data || [];
+        const newRows = result.data || [];
+        cachedData = cachedData.concat(newRows);
+
+        if (result.count !== cachedData.length) {
+            // 服务器数据被删除、清空或归档，本地缓存与服务器不一致，重新全量同步
+            addLog('warning', `⚠️ 本地缓存 ${cachedData.length} 条与服务器 ${result.count} 条不一致，重新全量同步`);
+            const fullResponse = await fetch('/sensor-data');
+            if (!fullResponse.ok) {
+                throw new Error(`HTTP error! status: ${fullResponse.status}`);
+            }
+            const fullResult = await fullResponse.json();
+            cachedData = fullResult.data || [];
+            await writeCachedData(cachedData, true);
+        } else if (newRows.length > 0) {
+            await writeCachedData(newRows);
+        }
+
+        sensorData = cachedData;
 
         // 显示接收到的传感器数据
         if (sensorData.length > 0) {
@@ -158,6 +236,7 @@ async function loadData() {
                 数据流程: 'Arduino Nano (读取传感器) → ESP8266 (WiFi转发) → 网站 (显示)',
                 最新传感器数据: latestData,
                 数据库总记录数: sensorData.length,
+                本次新增记录数: newRows.length,
                 数据接收时间: new Date().toLocaleString('zh-CN')
             });
         } else {
@@ -528,23 +607,17 @@ async function queryByDate() {
         updateQueryStatus('loading');
         addLog('info', `开始按日期查询: ${year}年${month}月${day}日`);
 
-        // 使用通用API获取所有数据，然后在前端过滤
-        const response = await fetch('/sensor-data');
+        // 构建目标日期字符串 (YYYY-MM-DD)
+        const targetDate = `${year}-${month.padStart(2, '0')}-${day.padStart(2, '0')}`;
+
+        // 由服务器按日期（北京时间）过滤，只传输当天的数据
+        const response = await fetch(`/sensor-data/date/${targetDate}`);
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
         const result = await response.json();
-        const allData = result.data || [];
-
-        // 构建目标日期字符串 (YYYY-MM-DD)
-        const targetDate = `${year}-${month.padStart(2, '0')}-${day.padStart(2, '0')}`;
-
-        // 在前端过滤指定日期的数据
-        const filteredData = allData.filter(item => {
-            const itemDate = new Date(item.timestamp).toISOString().split('T')[0];
-            return itemDate === targetDate;
-        });
+        const filteredData = result.data || [];
 
         sensorData = filteredData;
 
@@ -590,26 +663,17 @@ async function queryByHour() {
     try {
         updateQueryStatus('loading');
 
-        // 使用通用API获取所有数据，然后在前端过滤
-        const response = await fetch('/sensor-data');
+        // 构建目标日期和小时字符串 (YYYY-MM-DD-HH)
+        const targetDateTime = `${year}-${month.padStart(2, '0')}-${day.padStart(2, '0')}-${String(parseInt(hour)).padStart(2, '0')}`;
+
+        // 由服务器按小时（北京时间）过滤，只传输该小时的数据
+        const response = await fetch(`/sensor-data/datetime/${targetDateTime}`);
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
         const result = await response.json();
-        const allData = result.data || [];
-
-        // 构建目标日期和小时字符串
-        const targetDate = `${year}-${month.padStart(2, '0')}-${day.padStart(2, '0')}`;
-        const targetHour = parseInt(hour);
-
-        // 在前端过滤指定日期和小时的数据
-        const filteredData = allData.filter(item => {
-            const itemDateTime = new Date(item.timestamp);
-            const itemDate = itemDateTime.toISOString().split('T')[0];
-            const itemHour = itemDateTime.getHours();
-            return itemDate === targetDate && itemHour === targetHour;
-        });
+        const filteredData = result.data || [];
 
         sensorData = filteredData;
 
@@ -0,0 +1,64 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """
+    导入 app_sqlite；模块在当前目录创建数据库、归档和快照目录，后台快照线程也按相对路径访问数据库，
+    所以测试期间一直留在临时目录中
+    """
+    os.chdir(tmp_path_factory.mktemp('app'))
+    import app_sqlite
+    return app_sqlite
+
+
+@pytest.fixture
+def client(app_module, tmp_path, monkeypatch):
+    """使用独立数据库的测试客户端"""
+    from database import SensorDatabase
+    monkeypatch.setattr(app_module, 'db', SensorDatabase(str(tmp_path / 'sensor_data.db'), write_timeout=1.0))
+    return app_module.app.test_client()
+
+
+# 迁移之前（未版本化）的表结构；servo_angle 可以通过JSON null写入NULL
+BASELINE_SCHEMA = '''
+    CREATE TABLE sensor_data (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        humidity REAL NOT NULL,
+        temperature REAL NOT NULL,
+        light_intensity INTEGER NOT NULL,
+        servo_angle INTEGER DEFAULT 0,
+        timestamp TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        month INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        hour INTEGER NOT NULL,
+        date_key TEXT NOT NULL,
+        datetime_key TEXT NOT NULL
+    )
+'''
+
+
+def create_baseline_db(path, rows):
+    """
+    按迁移之前的表结构创建数据库，rows: [(humidity, temperature, light_intensity, servo_angle, hour), ...]
+    全部写在 2026-01-02 这一天
+    """
+    conn = sqlite3.connect(path)
+    conn.execute(BASELINE_SCHEMA)
+    conn.executemany('''
+        INSERT INTO sensor_data (humidity, temperature, light_intensity, servo_angle, timestamp, created_at,
+                                 year, month, day, hour, date_key, datetime_key)
+        VALUES (?, ?, ?, ?, ?, ?, 2026, 1, 2, ?, '2026-01-02', ?)
+    ''', [(humidity, temperature, light, servo, f'2026-01-02T{hour:02d}:00:00+08:00', f'2026-01-02 {hour:02d}:00:00',
+           hour, f'2026-01-02-{hour:02d}') for humidity, temperature, light, servo, hour in rows])
+    conn.commit()
+    conn.close()
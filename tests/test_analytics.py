@@ -0,0 +1,12 @@
+from conftest import create_baseline_db
+from database import SensorDatabase
+
+
+def test_analytics_with_null_servo_rows(app_module, tmp_path, monkeypatch):
+    path = str(tmp_path / 'sensor_data.db')
+    create_baseline_db(path, [(60.0 + hour, 20.0, 800, None if hour % 3 == 0 else 90, hour) for hour in range(24)])
+    monkeypatch.setattr(app_module, 'db', SensorDatabase(path))
+
+    response = app_module.app.test_client().get('/sensor-data/analytics?start=2026-01-02&end=2026-01-02&window=3')
+    assert response.status_code == 200
+    assert [row[5] for row in app_module.db.get_numeric_series()][:4] == [0, 90, 90, 0]
@@ -0,0 +1,19 @@
+from archive import SensorArchive
+
+
+def _row(row_id, servo_angle, hour):
+    created_at = f'2026-01-02 {hour:02d}:00:00'
+    return (row_id, 60.0 + row_id, 20.0, 800, servo_angle, created_at, created_at, 2026, 1, 2, hour,
+            '2026-01-02', f'2026-01-02-{hour:02d}')
+
+
+def test_segment_stats_skip_null_values(tmp_path):
+    archive = SensorArchive(str(tmp_path / 'archive'))
+    archive.stage_segment('2026-01-02', [_row(1, 90, 1), _row(2, None, 2)])
+    archive.stage_segment('2026-01-03', [_row(3, None, 3)])
+    archive.publish(['2026-01-02', '2026-01-03'])
+
+    stats = archive.summary()['stats']
+    assert stats['servo_angle'] == {'sum': 90, 'min': 90, 'max': 90}
+    assert (stats['humidity']['min'], stats['humidity']['max']) == (61.0, 63.0)
+    assert archive.count() == 3
@@ -0,0 +1,19 @@
+from conftest import create_baseline_db
+from database import SensorDatabase
+from hot_store import HotWindowStore
+
+
+def test_window_loads_null_servo_rows(tmp_path):
+    path = str(tmp_path / 'sensor_data.db')
+    create_baseline_db(path, [(60.0, 20.0, 800, 90, 1), (70.0, 30.0, 900, None, 2)])
+    store = HotWindowStore(window_days=1)
+    store.sync(SensorDatabase(path))
+
+    timestamps, values = store.range('servo_angle')
+    assert list(values) == [90, 0]
+
+
+def test_append_normalises_null_values():
+    store = HotWindowStore(window_days=1)
+    store._append((1, 1767312000, 60.0, 20.0, 800, None))
+    assert list(store.head_values['servo_angle']) == [0]
@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+
+
+def test_bad_reading_rejected_and_next_stored(app_module, client):
+    response = client.post('/sensor-data', json={'humidity': 'wet', 'temperature': 25.6, 'light_intensity': 850})
+    assert response.status_code == 400
+
+    response = client.post('/sensor-data', json={'humidity': 65.2, 'temperature': 25.6, 'light_intensity': 850})
+    assert response.status_code == 200
+    assert app_module.db.get_data_count() == 1
+
+
+def test_null_servo_and_numeric_strings_accepted(app_module, client):
+    response = client.post('/sensor-data', json={'humidity': '50', 'temperature': '25.5', 'light_intensity': '850',
+                                                 'servo_angle': None})
+    assert response.status_code == 200
+    reading = app_module.db.get_latest_data()
+    assert (reading.humidity, reading.temperature, reading.light_intensity, reading.servo_angle) == (50, 25.5, 850, 0)
+    assert app_module.db.get_statistics()['total_count'] == 1
+
+
+def test_failed_insert_releases_write_lock(app_module, client):
+    db = app_module.db
+    with pytest.raises((TypeError, ValueError)):
+        db.add_sensor_data(65.2, 25.6, 850, servo_angle='not a number')
+
+    # 出错的事务已回滚，写锁已释放
+    conn = sqlite3.connect(db.db_path, timeout=0)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.rollback()
+    conn.close()
+    assert db.add_sensor_data(65.2, 25.6, 850)['id'] == 1
+
+
+def test_running_stats_skip_null_values(app_module, client):
+    db = app_module.db
+    db.add_sensor_data(60.0, 20.0, 800, servo_angle=90)
+    db.get_statistics()  # 新库的统计行为dirty，首次读取时重算
+    reading = {'date_key': '2026-01-02', 'hour': 3, 'created_at': '2026-01-02 03:00:00',
+               'humidity': 70.0, 'temperature': 30.0, 'light_intensity': 900, 'servo_angle': None}
+    conn = sqlite3.connect(db.db_path)
+    db._update_running_stats(conn.cursor(), [reading])
+    conn.commit()
+    conn.close()
+
+    stats = db.get_statistics()
+    assert stats['total_count'] == 2
+    assert (stats['servo_angle']['min'], stats['servo_angle']['max']) == (90, 90)
+    assert (stats['humidity']['min'], stats['humidity']['max']) == (60.0, 70.0)
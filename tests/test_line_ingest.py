@@ -0,0 +1,37 @@
+from admission import AdmissionController
+from database import SensorDatabase
+from line_ingest import BUSY, WRITTEN, LineIngestServer
+
+READING = {'humidity': 65.2, 'temperature': 25.6, 'light_intensity': 850, 'servo_angle': 90}
+
+
+def _server(tmp_path, admission):
+    db = SensorDatabase(str(tmp_path / 'sensor_data.db'))
+    return db, LineIngestServer(db, parse=None, admission=admission)
+
+
+def test_batches_wait_during_maintenance(tmp_path):
+    admission = AdmissionController()
+    db, server = _server(tmp_path, admission)
+
+    with admission.maintenance('backup'):
+        result, error = server.write_batch([READING])
+    assert result == BUSY and 'maintenance' in error
+    assert db.get_data_count() == 0
+
+    assert server.write_batch([READING]) == (WRITTEN, None)
+    assert db.get_data_count() == 1
+    assert admission.stats()['in_flight'] == 0
+
+
+def test_batches_share_in_flight_limit(tmp_path):
+    admission = AdmissionController(max_in_flight=1)
+    db, server = _server(tmp_path, admission)
+
+    assert admission.admit() is None       # 一个HTTP请求正在处理
+    result, _ = server.write_batch([READING])
+    assert result == BUSY
+    admission.release()
+
+    assert server.write_batch([READING])[0] == WRITTEN
+    assert admission.stats()['rejected_overload'] == 1
@@ -0,0 +1,19 @@
+from conftest import create_baseline_db
+from database import SensorDatabase
+
+
+def test_upgrade_baseline_db_with_null_servo(tmp_path):
+    path = str(tmp_path / 'sensor_data.db')
+    create_baseline_db(path, [(60.0, 20.0, 800, 90, 1), (70.0, 30.0, 900, None, 2)])
+
+    db = SensorDatabase(path)
+
+    assert db.get_data_count() == 2
+    stats = db.get_statistics()
+    assert stats['total_count'] == 2
+    assert (stats['servo_angle']['min'], stats['servo_angle']['max']) == (90, 90)
+    percentiles = db.get_percentiles('2026-01-02', '2026-01-02')['metrics']
+    assert percentiles['humidity']['count'] == 2
+    assert percentiles['servo_angle']['count'] == 1
+    # 升级后的库可以继续写入
+    assert db.add_sensor_data(65.0, 25.0, 850)['id'] == 3
@@ -0,0 +1,15 @@
+from conftest import create_baseline_db
+from database import SensorDatabase
+
+
+def test_stream_and_paginated_rows_match(app_module, tmp_path, monkeypatch):
+    path = str(tmp_path / 'sensor_data.db')
+    create_baseline_db(path, [(60.0, 20.0, 800, 90, 1), (70.0, 30.0, 900, None, 2)])
+    monkeypatch.setattr(app_module, 'db', SensorDatabase(path))
+    client = app_module.app.test_client()
+
+    streamed = client.get('/sensor-data').get_json()['data']
+    paginated = client.get('/sensor-data?limit=10').get_json()['data']
+    incremental = client.get('/sensor-data?since_id=0').get_json()['data']
+    assert streamed == paginated == incremental
+    assert streamed[1]['servo_angle'] is None